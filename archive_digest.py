@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+import sys, os, json, tarfile, gzip, hashlib, base64, sqlite3, datetime, calendar
+
+from scratch import Partial_fname_get, Partial_Commit, Remove
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Checksums of the BIDS data sets, computed while they are written, so that no later check has to read an archive again:
+#   - MD5 and SHA-256 of the compressed file (the bytes uploaded; the MD5 is the S3 ETag of a single-part upload),
+#   - SHA-256 of the uncompressed content of every member.
+# Archive_Open returns a tarfile whose close() leaves them in .digests; Digests_Store keeps them in table archive_digests of
+# metadata.sqlite and in a manifest next to the archive (<archive>.manifest.json), and the AWS-s3 upload sends them as
+# Content-MD5 and x-amz-checksum-sha256, so the receiving end verifies what it stored.
+# The archive is written under a temporary name and renamed into place on close() (scratch.py), so an archive that exists
+# is complete.
+# Archives are reproducible: the gzip header and the members carry the acquisition time of the series (Series_mtime_get) and
+# no owner (uid/gid 0, no user or group name), so building the data set of a run again gives the same bytes, and the same MD5,
+# as the object already in the bucket (s3_reconcile.py).
+# ---------------------------------------------------------------------------------------------------------------------------------
+Digests_table = 'archive_digests'
+
+Manifest_suffix = '.manifest.json'
+
+Read_block = 2**20
+
+Member_mtime = 0        # Time of members and gzip header when none is given
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+class Digest_Writer:
+    # Output file that hashes what goes through it, written as fname once closed
+    def __init__( self, fname ):
+        self.fname   = fname
+        self.partial = Partial_fname_get( fname )
+        self.f      = open( self.partial, 'wb' )
+        self.md5    = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.size   = 0
+
+    def write( self, data ):
+        self.md5.update( data )
+        self.sha256.update( data )
+        self.size += len(data)
+        return self.f.write( data )
+
+    def flush( self ):
+        self.f.flush()
+
+    def close( self ):
+        self.f.close()
+        Partial_Commit( self.partial, self.fname )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+class Digest_Reader:
+    # Input file that hashes what is read from it (tarfile reads each member once, in blocks)
+    def __init__( self, fobj ):
+        self.fobj   = fobj
+        self.sha256 = hashlib.sha256()
+
+    def read( self, size=-1 ):
+        data = self.fobj.read( size )
+        self.sha256.update( data )
+        return data
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+class Digest_TarFile( tarfile.TarFile ):
+    # TarFile that records the SHA-256 of each member as it is added, and the digests of the compressed output on close()
+    def addfile( self, tarinfo, fileobj=None ):
+        tarinfo.mtime = self.member_mtime
+        tarinfo.uid   = tarinfo.gid   = 0
+        tarinfo.uname = tarinfo.gname = ''
+        if fileobj is None:
+            return super().addfile( tarinfo )
+        reader = Digest_Reader( fileobj )
+        super().addfile( tarinfo, reader )
+        self.members_sha256[ tarinfo.name ] = reader.sha256.hexdigest()
+
+    def close( self ):
+        if self.closed:
+            return
+        super().close()
+        self.gzip_file.close()
+        out = self.digest_writer
+        out.close()
+        self.digests = {'size':    out.size,
+                        'md5':     out.md5.hexdigest(),
+                        'sha256':  out.sha256.hexdigest(),
+                        'members': dict( self.members_sha256 )}
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Series_mtime_get( series_date, series_time, fname='' ):
+    # Time of the archive of a run: its series' acquisition (YYYYMMDD, HHMMSS, taken as UTC), or else the modification time of
+    # fname (its minimally-processed image); both stay the same when the data set of the run is built again
+    try:
+        return calendar.timegm( datetime.datetime.strptime( str(series_date)[:8] + str(series_time)[:6], '%Y%m%d%H%M%S' ).timetuple() )
+    except ValueError:
+        pass
+    try:
+        return int( os.stat( fname ).st_mtime )
+    except OSError:
+        return Member_mtime
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Archive_Open( outtarname, mtime=Member_mtime ):
+    # Same output as  tarfile.open( outtarname, 'w:gz' ), with every member and the gzip header dated mtime and without
+    # owners, plus .digests after close()
+    out = Digest_Writer( outtarname )
+    try:
+        gz  = gzip.GzipFile( os.path.basename(outtarname), 'wb', 9, out, mtime=mtime )
+        tar = Digest_TarFile( outtarname, 'w', fileobj=gz )
+    except Exception:
+        out.f.close()
+        Remove( out.partial )
+        raise
+    tar.gzip_file      = gz
+    tar.member_mtime   = mtime
+    tar.digest_writer  = out
+    tar.members_sha256 = {}
+    tar.digests        = {}
+    return tar
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def base64_get( hexdigest ):
+    # Digest as sent in Content-MD5 and x-amz-checksum-sha256 headers
+    return base64.b64encode( bytes.fromhex(hexdigest) ).decode('ascii')
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Manifest_fname_get( outtarname ):
+    return outtarname + Manifest_suffix
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Digests_Store( metadatadir, outtarname, digests, test_mode=False ):
+    # Write the manifest of the archive, and add its digests to table archive_digests of metadata.sqlite
+    record = {'archive':  os.path.basename( outtarname ),
+              'size':     digests['size'],
+              'md5':      digests['md5'],
+              'sha256':   digests['sha256'],
+              'members':  digests['members'],
+              'created':  datetime.datetime.now().isoformat( timespec='seconds' )}
+
+    if test_mode:
+        print()
+        print('Here I would record archive digests:')
+        print( json.dumps( record, indent=2 ) )
+        return record
+
+    with open( Manifest_fname_get(outtarname), 'w' ) as f:
+        json.dump( record, f, indent=2 )
+
+    sqlite_file = ''.join([metadatadir, '/', 'metadata.sqlite'])
+    try:
+        conn = sqlite3.connect( sqlite_file, timeout=30 )
+        with conn:
+            conn.execute( 'CREATE TABLE IF NOT EXISTS %s (archive TEXT, size INTEGER, md5 TEXT, sha256 TEXT, members TEXT, created TEXT)'
+                          % Digests_table )
+            conn.execute( 'INSERT INTO %s VALUES (?,?,?,?,?,?)' % Digests_table,
+                          (record['archive'], record['size'], record['md5'], record['sha256'], json.dumps(record['members']),
+                           record['created']) )
+        conn.close()
+    except sqlite3.Error as err:
+        print('Warning: unable to record archive digests in', sqlite_file, err )
+
+    return record
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Digests_Remove( outtarname ):
+    # Manifest of an archive that is being removed (failed upload)
+    try:
+        os.remove( Manifest_fname_get(outtarname) )
+    except OSError:
+        pass
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Archive_Verify( outtarname ):
+    # Full re-read of an archive against its manifest; returns (ok, msg). For spot checks: the share path never needs it.
+    try:
+        with open( Manifest_fname_get(outtarname), 'r' ) as f:
+            manifest = json.load( f )
+    except (IOError, OSError, ValueError) as err:
+        return False, 'no readable manifest: %s' % err
+
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    with open( outtarname, 'rb' ) as f:
+        for block in iter( lambda: f.read(Read_block), b'' ):
+            md5.update( block )
+            sha256.update( block )
+    if md5.hexdigest() != manifest['md5'] or sha256.hexdigest() != manifest['sha256']:
+        return False, 'compressed file differs from manifest'
+
+    members = {}
+    with tarfile.open( outtarname, 'r|gz' ) as tar:
+        for m in tar:
+            if m.isfile():
+                h = hashlib.sha256()
+                f = tar.extractfile(m)
+                for block in iter( lambda: f.read(Read_block), b'' ):
+                    h.update( block )
+                members[ m.name ] = h.hexdigest()
+    if members != manifest['members']:
+        differ = sorted( set( name  for name, digest in set(members.items()) ^ set(manifest['members'].items()) ) )
+        return False, 'members differ from manifest: %s' % ', '.join( differ )
+    return True, ''
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    # Verify archives against their manifests
+    if len(sys.argv) < 2:
+        print('Usage:  ./archive_digest.py  Archive.tgz  [Archive2.tgz ...]   (re-reads each archive and compares it with its manifest)')
+        sys.exit()
+
+    n_bad = 0
+    for fname in sys.argv[1:]:
+        ok, msg = Archive_Verify( fname )
+        n_bad += not ok
+        print('%s  %s  %s' % ('ok  ' if ok else 'FAIL', fname, msg) )
+    if n_bad:
+        sys.exit(1)
+# ========================================================================================================================================================
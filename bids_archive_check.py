@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+import sys, os, getopt, json, re, struct, tarfile, gzip, time
+from concurrent.futures import ProcessPoolExecutor
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# BIDS checks of the .tgz data sets written by share_min_proc_fMRI_dMRI_BOLD_T1T2.py, streamed from the archive: tar headers are
+# read in order, small members (.json, .tsv, .bval, .bvec) are read in memory, and only the 348-byte header of the image is read.
+# Nothing is extracted to disk. Checked:
+#   - names:     dataset_description.json, and  sub-<S>/ses-<V>/<type>/sub-<S>_ses-<V>[_task-<T>]_run-<N>_<suffix>.<ext>
+#                with type/suffix pairs  anat: T1w, T2w;  func: bold, events, motion;  dwi: dwi
+#   - sidecars:  an image and a .json per run; RepetitionTime in every .json, TaskName (= task entity) for bold;
+#                events (onset, duration columns) for task runs; .bval and .bvec together in dwi, one value per volume
+#   - NIfTI:     NIfTI-1 magic; 4-D bold and dwi images; bold pixdim[4] equal to RepetitionTime
+# ---------------------------------------------------------------------------------------------------------------------------------
+Name_pattern = re.compile( r'^sub-(?P<sub>[A-Za-z0-9]+)/ses-(?P<ses>[A-Za-z0-9]+)/(?P<type>[a-z]+)/'
+                           r'sub-(?P=sub)_ses-(?P=ses)(_task-(?P<task>[A-Za-z0-9]+))?_run-(?P<run>[0-9]+)'
+                           r'_(?P<suffix>[A-Za-z0-9]+)\.(?P<ext>nii|nii\.gz|json|tsv|bval|bvec)$' )
+
+Suffixes_for_type = {'anat': ['T1w', 'T2w'], 'func': ['bold', 'events', 'motion'], 'dwi': ['dwi']}
+
+Image_suffix_for_type = {'anat': None, 'func': 'bold', 'dwi': 'dwi'}    # anat: the T1w or T2w present
+
+Rest_tasks = ['rest']
+
+Small_member_max = 16 * 2**20     # Larger non-image members are reported, not read
+
+TR_tolerance = 1e-3               # s
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Check BIDS naming, sidecars and NIfTI headers of minimally-processed data sets (.tgz), without extracting them')
+    print()
+    print('Usage:')
+    print('  ./bids_archive_check.py  [--workers N]  [--json Results]  [--quiet]  Path1  [Path2 ...]')
+    print()
+    print('where:')
+    print('  Path       A .tgz data set, or a directory whose .tgz files are checked')
+    print('  N          Archives checked in parallel (default: number of CPUs)')
+    print('  Results    Write the issues of every archive to this .json file')
+    print('  --quiet    Report only archives with errors')
+    print()
+    print('Exit status is 1 if any archive has errors')
+    print()
+    print('Example:')
+    print('  ./bids_archive_check.py  --workers 16  /mproc/chla  /mproc/yale')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def command_line_get_variables():
+    workers    = os.cpu_count() or 1
+    json_fname = ''
+    quiet      = False
+
+    try:
+        opts,args = getopt.getopt(sys.argv[1:], "hn:j:q", ["workers=", "json=", "quiet"])
+    except getopt.GetoptError as err:
+        print("Error parsing arguments: %s" % str(err))
+        program_description()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            program_description()
+            sys.exit()
+        elif opt in ("-n", "--workers"):
+            workers = max( 1, int(arg) )
+        elif opt in ("-j", "--json"):
+            json_fname = arg
+        elif opt in ("-q", "--quiet"):
+            quiet = True
+
+    if not args:
+        program_description()
+        sys.exit()
+
+    return args, workers, json_fname, quiet
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def NIfTI_header_read( fobj ):
+    # Fields of a NIfTI-1 header relevant to BIDS consumers; {} if fobj does not start with one
+    hdr = fobj.read( 348 )
+    if len(hdr) < 348 or struct.unpack('<i', hdr[0:4])[0] != 348:
+        return {}
+    return {'dim':        list( struct.unpack('<8h', hdr[40:56]) ),
+            'datatype':   struct.unpack('<h', hdr[70:72])[0],
+            'bitpix':     struct.unpack('<h', hdr[72:74])[0],
+            'pixdim':     [ round(v, 6) for v in struct.unpack('<8f', hdr[76:108]) ],
+            'vox_offset': struct.unpack('<f', hdr[108:112])[0],
+            'xyzt_units': hdr[123],
+            'magic':      hdr[344:347].decode('latin-1')}
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def TR_seconds_get( hdr ):
+    # pixdim[4] in seconds, from the time units of xyzt_units (8: s, 16: ms, 24: us)
+    units = hdr['xyzt_units'] & 0x38
+    return hdr['pixdim'][4] * {8: 1.0, 16: 1e-3, 24: 1e-6}.get( units, 1.0 )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Archive_Read( tgz ):
+    # One pass over the archive: names, headers of images, and contents of small members
+    members = {}     # name -> {'size', 'data' (bytes, small members), 'nifti' (header, images)}
+    issues  = []
+    try:
+        with tarfile.open( tgz, 'r|gz' ) as tar:
+            for m in tar:
+                if not m.isfile():
+                    continue
+                entry = {'size': m.size}
+                if m.name.endswith('.nii') or m.name.endswith('.nii.gz'):
+                    f = tar.extractfile(m)
+                    if m.name.endswith('.nii.gz'):
+                        f = gzip.GzipFile( fileobj=f )
+                    entry['nifti'] = NIfTI_header_read( f )
+                elif m.size <= Small_member_max:
+                    entry['data'] = tar.extractfile(m).read()
+                else:
+                    issues.append( ('error', '%s: unexpectedly large sidecar (%d bytes)' % (m.name, m.size)) )
+                members[ m.name ] = entry
+    except (tarfile.TarError, IOError, OSError, EOFError) as err:
+        issues.append( ('error', 'unable to read archive: %s' % err) )
+    return members, issues
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Archive_Check( tgz ):
+    # Returns {'archive', 'issues': [(level, message), ...], 'runs', 'elapsed_s'}
+    t0 = time.time()
+    members, issues = Archive_Read( tgz )
+    def error( msg ):
+        issues.append( ('error', msg) )
+
+    # ------------------------------------------- dataset_description -------------------------------------------
+    if 'dataset_description.json' not in members:
+        error('dataset_description.json missing')
+    else:
+        try:
+            desc = json.loads( members['dataset_description.json'].get('data', b'').decode('utf8') )
+            for field in ['Name', 'BIDSVersion']:
+                if field not in desc:
+                    error('dataset_description.json lacks %s' % field )
+        except ValueError:
+            error('dataset_description.json is not valid JSON')
+
+    # ---------------------------------------------- file names -------------------------------------------------
+    runs = {}        # (sub, ses, type, task, run) -> {suffix.ext: member name}
+    for name in members:
+        if name == 'dataset_description.json':
+            continue
+        m = Name_pattern.match( name )
+        if not m:
+            error('%s: name does not follow sub-<S>/ses-<V>/<type>/sub-<S>_ses-<V>[_task-<T>]_run-<N>_<suffix>.<ext>' % name )
+            continue
+        dtype, task, suffix = m.group('type'), m.group('task'), m.group('suffix')
+        if dtype not in Suffixes_for_type:
+            error('%s: unknown data type directory %s' % (name, dtype) )
+            continue
+        if suffix not in Suffixes_for_type[dtype]:
+            error('%s: suffix _%s not valid in %s' % (name, suffix, dtype) )
+        if (dtype == 'func') != (task is not None):
+            error('%s: task entity %s' % (name, 'required in func' if dtype == 'func' else 'only valid in func') )
+        key = (m.group('sub'), m.group('ses'), dtype, task, m.group('run'))
+        runs.setdefault( key, {} )[ suffix + '.' + m.group('ext') ] = name
+
+    # ------------------------------------------- sidecars, per run ---------------------------------------------
+    for (sub, ses, dtype, task, run), files in sorted( runs.items(), key=lambda x: str(x[0]) ):
+        label = 'sub-%s ses-%s %s%s run-%s' % (sub, ses, dtype, ' task-%s' % task if task else '', run)
+
+        images = [ k  for k in files  if k.endswith('.nii') or k.endswith('.nii.gz') ]
+        if len(images) != 1:
+            error('%s: %d images' % (label, len(images)) )
+            continue
+        suffix = images[0].split('.')[0]
+        if Image_suffix_for_type[dtype] and suffix != Image_suffix_for_type[dtype]:
+            error('%s: image suffix _%s' % (label, suffix) )
+        hdr = members[ files[images[0]] ].get('nifti', {})
+
+        sidecar = {}
+        if suffix + '.json' not in files:
+            error('%s: %s.json sidecar missing' % (label, suffix) )
+        else:
+            try:
+                sidecar = json.loads( members[ files[suffix + '.json'] ].get('data', b'').decode('utf8') )
+            except ValueError:
+                error('%s: %s.json is not valid JSON' % (label, suffix) )
+        if sidecar and 'RepetitionTime' not in sidecar:
+            error('%s: RepetitionTime missing from %s.json' % (label, suffix) )
+
+        if not hdr:
+            error('%s: image is not NIfTI-1' % label )
+        elif hdr['magic'] not in ['n+1', 'ni1']:
+            error('%s: NIfTI magic %r' % (label, hdr['magic']) )
+
+        if dtype == 'func':
+            if sidecar and sidecar.get('TaskName') != task:
+                error('%s: TaskName %r does not match task entity' % (label, sidecar.get('TaskName')) )
+            if task not in Rest_tasks:
+                if 'events.tsv' not in files:
+                    error('%s: events.tsv missing for task run' % label )
+                else:
+                    header = members[ files['events.tsv'] ].get('data', b'').split(b'\n')[0].decode('utf8', 'replace')
+                    header = header.rstrip('\r').split('\t')
+                    for col in ['onset', 'duration']:
+                        if col not in header:
+                            error('%s: events.tsv lacks column %s' % (label, col) )
+            if hdr:
+                if hdr['dim'][0] != 4:
+                    error('%s: bold image is %d-D' % (label, hdr['dim'][0]) )
+                if sidecar.get('RepetitionTime') is not None and abs( TR_seconds_get(hdr) - sidecar['RepetitionTime'] ) > TR_tolerance:
+                    error('%s: NIfTI TR %.4f s differs from RepetitionTime %.4f s' % (label, TR_seconds_get(hdr), sidecar['RepetitionTime']) )
+
+        if dtype == 'dwi':
+            if ('dwi.bval' in files) != ('dwi.bvec' in files):
+                error('%s: .bval and .bvec must come together' % label )
+            elif 'dwi.bval' not in files:
+                error('%s: .bval and .bvec missing' % label )
+            else:
+                try:
+                    bvals = members[ files['dwi.bval'] ]['data'].split()
+                    bvecs = [ line.split()  for line in members[ files['dwi.bvec'] ]['data'].splitlines()  if line.strip() ]
+                except KeyError:
+                    bvals, bvecs = [], []
+                if len(bvecs) != 3 or any( len(row) != len(bvals)  for row in bvecs ):
+                    error('%s: .bvec must have 3 rows of %d values (one per b-value)' % (label, len(bvals)) )
+                if hdr and hdr['dim'][0] >= 4 and hdr['dim'][4] != len(bvals):
+                    error('%s: %d b-values for %d volumes' % (label, len(bvals), hdr['dim'][4]) )
+            if hdr and hdr['dim'][0] != 4:
+                error('%s: dwi image is %d-D' % (label, hdr['dim'][0]) )
+
+    if not runs and members:
+        error('no BIDS runs in archive')
+
+    return {'archive': tgz, 'issues': issues, 'runs': len(runs), 'elapsed_s': time.time() - t0}
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Archives_get( paths ):
+    archives = []
+    for p in paths:
+        if os.path.isdir( p ):
+            archives += sorted( os.path.join(p, f)  for f in os.listdir(p)  if f.endswith('.tgz') )
+        else:
+            archives.append( p )
+    return archives
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Archives_Check( archives, workers ):
+    # Check archives in parallel; results in the order of archives
+    if workers <= 1 or len(archives) <= 1:
+        return [ Archive_Check(a)  for a in archives ]
+    with ProcessPoolExecutor( max_workers=workers ) as pool:
+        return list( pool.map( Archive_Check, archives, chunksize=8 ) )
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    paths, workers, json_fname, quiet  =  command_line_get_variables()
+
+    archives = Archives_get( paths )
+    t0 = time.time()
+    results = Archives_Check( archives, workers )
+
+    n_bad = 0
+    for r in results:
+        errors = [ msg  for level, msg in r['issues']  if level == 'error' ]
+        n_bad += bool( errors )
+        if errors or not quiet:
+            print('%s  %s' % ('FAIL' if errors else 'ok  ', r['archive']) )
+            for msg in errors:
+                print('      ', msg )
+
+    print()
+    print('Archives: %d,  with errors: %d,  elapsed: %.1f s' % (len(results), n_bad, time.time() - t0) )
+
+    if json_fname:
+        with open(json_fname, 'w') as f:
+            json.dump( results, f, indent=2 )
+        print('Results written to', json_fname )
+
+    if n_bad:
+        sys.exit(1)
+# ========================================================================================================================================================
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+import sys, os, getopt, time, math, io
+
+import series_process_info_get as spi
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Batch resolution of a whole list of participants against pcinfo, /fast-track and the NDA image03 package, as table joins
+# instead of per-participant loops:
+#
+#   subjects  x  pcinfo series (SeriesType -> modality)      -> time order of each series (t_ord) per participant and modality
+#             -> guessed fast-track basename (NDAR<subj>_<event>_ABCD-<type>_<date><time>.tgz, as FasTrk_files_names_get)
+#             x  /fast-track listing (one directory scan)     -> FasTrk_file
+#             x  NDA image03 rows on (subjectkey, basename)   -> image03_id, dataset_id, interview_date, interview_age, ...
+#
+# The result is one table with a row per run. Run_Table_Index turns it into a dictionary from (pGUID, fast-track basename)
+# to row number, so the per-run NDA lookup of the share script is an index into the table (see NDA_Records_from_Run_Table).
+#
+# Date and time of the guessed name come from pcinfo (StudyDate, SeriesTime); the per-participant path takes them from
+# ContainerInfo. Runs whose two names differ are not found in the table, and the share script then looks them up as before.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Modality_for_SeriesType = dict( [(m, m) for m in spi.modality_list] + [('T1_NORM', 'T1'), ('T2_NORM', 'T2')] )
+
+Run_columns = ['subject', 'pGUID', 'modality', 't_ord', 'bids_run', 'SeriesType', 'SeriesInstanceUID', 'EventName', 'SiteName',
+               'Manufacturer', 'series_date', 'series_time', 'FasTrk_file_Guessed_Name', 'FasTrk_file', 'FasTrk_files_found',
+               'nda_matches', 'image03_id', 'dataset_id', 'interview_date', 'interview_age', 'gender', 'image_file',
+               'image_description', 'experiment_id', 'visit']
+
+NDA_integer_columns = ['image03_id', 'dataset_id', 'interview_age']
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Resolve all participants of a subjects file, at once, against pcinfo, /fast-track and a downloaded NDA image03 package,')
+    print('and write the resulting run-level table (one row per participant, modality and run)')
+    print()
+    print('Usage:')
+    print('  ./bulk_resolution.py  --demog SubjsFile  --NDAdb DB  --out RunTable  [--modality M1,M2,...]  [--site Site]  [--fasttrack]')
+    print()
+    print('where:')
+    print('  SubjsFile   Table (.csv) listing pGUIDs, anonymized dob, gender')
+    print('  DB          NDA-downloaded database package (image03.txt)')
+    print('  RunTable    Output table (.csv)')
+    print('  M1,M2,...   Modalities (default all):', spi.modality_list )
+    print('  Site        Only the lines of SubjsFile containing Site, as in run_mproc_share.sh')
+    print('  --fasttrack Also list the /fast-track directories (FasTrk_root in share_config.json) and resolve the fast-track files')
+    print()
+    print('Example:')
+    print('  ./bulk_resolution.py  --demog Subjs_Year1_patch.csv  --NDAdb /home/oruiz/ABCD_Inventory/NDA_downloaded_packages/image03.txt  --out runs_chla.csv  --site chla  --fasttrack')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def command_line_get_variables():
+    o = {'demog': '', 'db_fname': '', 'out': '', 'modalities': spi.modality_list, 'site': '', 'fasttrack': False}
+
+    try:
+        opts,args = getopt.getopt(sys.argv[1:], "hd:n:o:m:s:f", ["demog=", "NDAdb=", "out=", "modality=", "site=", "fasttrack"])
+    except getopt.GetoptError as err:
+        print("Error parsing arguments: %s" % str(err))
+        program_description()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            program_description()
+            sys.exit()
+        elif opt in ("-d", "--demog"):
+            o['demog'] = arg
+        elif opt in ("-n", "--NDAdb"):
+            o['db_fname'] = arg
+        elif opt in ("-o", "--out"):
+            o['out'] = arg
+        elif opt in ("-m", "--modality"):
+            o['modalities'] = arg.split(',')
+        elif opt in ("-s", "--site"):
+            o['site'] = arg
+        elif opt in ("-f", "--fasttrack"):
+            o['fasttrack'] = True
+
+    if not (o['demog'] and o['db_fname'] and o['out']):
+        program_description()
+        sys.exit()
+
+    for m in o['modalities']:
+        if m not in spi.modality_list:
+            print('Error: Modality must be one of', spi.modality_list )
+            sys.exit()
+
+    return o
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Subjects_get( subjs_fname, site='' ):
+    # pGUIDs of the subjects file (lines containing site, if given)
+    pd = spi.pandas_get()
+    with open(subjs_fname, 'r') as f:
+        lines = f.read().splitlines()
+    if site:
+        lines = lines[:1] + [ line  for line in lines[1:]  if site in line ]
+    subjs = pd.read_csv( io.StringIO( '\n'.join(lines) ), dtype=str )
+    return subjs['pGUID'].drop_duplicates()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def FasTrk_Listing_get( fastrk_root ):
+    # One scan of fastrk_root/*/ ; returns a table of fast-track files with their subject and date-time stamp
+    pd = spi.pandas_get()
+    paths = []
+    try:
+        for site_dir in os.scandir( fastrk_root ):
+            if site_dir.is_dir():
+                paths += [ e.path  for e in os.scandir( site_dir.path )  if e.name.startswith('NDAR') ]
+    except OSError as err:
+        print('Warning: unable to list', fastrk_root, err )
+
+    ft = pd.DataFrame( {'FasTrk_file': paths} )
+    names = ft['FasTrk_file'].str.rsplit('/', n=1).str[-1]
+    ft['subject']   = names.str.extract( r'^NDAR(INV[^_]+)_', expand=False )
+    ft['datetime']  = names.str.extract( r'_(\d{14})[^_]*$', expand=False )
+    ft['NORM']      = names.str.contains( 'NORM' )
+    return ft.dropna( subset=['subject', 'datetime'] )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Bulk_Resolve( pGUIDs, modalities, pcinfo_fname, db_fname, fastrk_root='' ):
+    # Run-level table (columns Run_columns) of all pGUIDs and modalities
+    pd = spi.pandas_get()
+
+    # -------------------------------------- subjects x pcinfo series ---------------------------------------
+    subjects = pd.DataFrame( {'pGUID': pGUIDs} )
+    subjects['subject'] = subjects['pGUID'].str.split('_').str[-1]
+
+    PCInfo = pd.read_csv( pcinfo_fname, low_memory=False,
+                          usecols=['pGUID', 'EventName', 'SiteName', 'Manufacturer', 'SeriesType', 'SeriesInstanceUID',
+                                   'StudyDate', 'SeriesTime'] )
+    PCInfo['subject']  = PCInfo['pGUID'].str.split('_').str[-1]
+    PCInfo['modality'] = PCInfo['SeriesType'].map( Modality_for_SeriesType )
+    PCInfo = PCInfo[ PCInfo['modality'].isin( modalities ) ].drop( columns='pGUID' )
+
+    runs = subjects.merge( PCInfo, on='subject', how='inner' )
+
+    # Time order of the series of each participant and modality, as PCInfo_get
+    runs = runs.sort_values( ['subject', 'modality', 'StudyDate', 'SeriesTime'], kind='mergesort' ).reset_index( drop=True )
+    runs['t_ord']    = runs.groupby( ['subject', 'modality'] ).cumcount() + 1
+    runs['bids_run'] = 'run-' + runs['t_ord'].map( '{:02d}'.format )
+
+    # ------------------------------- guessed fast-track names (vectorized) ---------------------------------
+    runs['series_date'] = runs['StudyDate'].astype('int64').astype(str)
+    runs['series_time'] = runs['SeriesTime'].astype(float).astype('int64').astype(str).str.zfill(6)
+    event_names = { e: e.split('_')[0] + ''.join( [s.capitalize() for s in e.split('_')[1:]] )  for e in runs['EventName'].unique() }
+    runs['FasTrk_file_Guessed_Name'] = ( 'NDAR' + runs['subject'] + '_' + runs['EventName'].map( event_names ) + '_ABCD-'
+                                         + runs['modality'].map( spi.fstktype_for_modality ) + '_'
+                                         + runs['series_date'] + runs['series_time'] + '.tgz' )
+
+    # ------------------------------------ x /fast-track listing --------------------------------------------
+    runs['FasTrk_file']        = ''
+    runs['FasTrk_files_found'] = 0
+    if fastrk_root:
+        ft = FasTrk_Listing_get( fastrk_root )
+        runs['datetime'] = runs['series_date'] + runs['series_time']
+        m = runs[['subject', 'modality', 't_ord', 'datetime']].merge( ft, on=['subject', 'datetime'], how='inner' )
+        # Structural series: prefer files with NORM in their name, as FasTrk_files_names_get
+        struct_norm = m['modality'].isin(['T1', 'T2']) & m.groupby(['subject', 'modality', 't_ord'])['NORM'].transform('any')
+        m = m[ ~struct_norm | m['NORM'] ]
+        found = m.groupby( ['subject', 'modality', 't_ord'] )['FasTrk_file'].agg( ['first', 'size'] ).reset_index()
+        runs = runs.drop( columns=['FasTrk_file', 'FasTrk_files_found', 'datetime'] ).merge( found, on=['subject', 'modality', 't_ord'], how='left' )
+        runs = runs.rename( columns={'first': 'FasTrk_file', 'size': 'FasTrk_files_found'} )
+        runs['FasTrk_file']        = runs['FasTrk_file'].fillna('')
+        runs['FasTrk_files_found'] = runs['FasTrk_files_found'].fillna(0).astype(int)
+
+    # ---------------------------- x NDA image03 rows on (subjectkey, basename) -----------------------------
+    NDA = pd.read_csv( db_fname, header=0, sep='\t', skiprows=[1], low_memory=False,
+                       usecols=['image03_id', 'dataset_id', 'subjectkey', 'interview_date', 'interview_age', 'gender',
+                                'image_file', 'image_description', 'experiment_id', 'visit'] )
+    NDA['FasTrk_file_Guessed_Name'] = NDA['image_file'].astype(str).str.rsplit('/', n=1).str[-1]
+    NDA = NDA.rename( columns={'subjectkey': 'pGUID'} )
+    NDA['nda_matches'] = NDA.groupby( ['pGUID', 'FasTrk_file_Guessed_Name'] )['image03_id'].transform('size')
+    NDA = NDA.drop_duplicates( subset=['pGUID', 'FasTrk_file_Guessed_Name'], keep='last' )    # Last entry, as NDA_db_Metadata_Get
+
+    runs = runs.merge( NDA, on=['pGUID', 'FasTrk_file_Guessed_Name'], how='left' )
+    runs['nda_matches'] = runs['nda_matches'].fillna(0).astype(int)
+
+    dates = pd.to_datetime( runs['interview_date'], format='%m/%d/%Y', errors='coerce' )
+    runs['interview_date'] = dates.dt.strftime( '%m/%d/%Y %H:%M:%S' ).where( dates.notna(), '' )
+
+    return runs[ Run_columns ].reset_index( drop=True )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Run_Table_Index( runs ):
+    # (pGUID, fast-track basename) -> row number, for runs with an NDA record
+    matched = runs[ runs['nda_matches'] > 0 ]
+    return dict( zip( zip(matched['pGUID'], matched['FasTrk_file_Guessed_Name']), matched.index ) )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def NDA_value( col, v ):
+    # numpy scalars -> Python values; missing -> ''; whole numbers in integer columns -> int (as read from lookup_index)
+    if hasattr( v, 'item' ):
+        v = v.item()
+    if isinstance( v, float ):
+        if math.isnan( v ):
+            return ''
+        if col in NDA_integer_columns and v.is_integer():
+            return int( v )
+    return v
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def NDA_Records_from_Run_Table( runs ):
+    # (pGUID, fast-track basename) -> (NDA record, number of matching image03 rows); the record as NDA_db_Metadata_Get returns it
+    cols = ['image03_id', 'dataset_id', 'interview_date', 'interview_age', 'gender', 'image_file', 'image_description',
+            'experiment_id', 'visit']
+    values = { c: runs[c].values  for c in cols + ['pGUID', 'nda_matches'] }
+    records = {}
+    for key, j in Run_Table_Index( runs ).items():
+        rec = { c: NDA_value( c, values[c][j] )  for c in cols }
+        rec['subjectkey'] = values['pGUID'][j]
+        records[ key ] = (rec, int( values['nda_matches'][j] ))
+    return records
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    o = command_line_get_variables()
+
+    start_time = time.time()
+    pGUIDs = Subjects_get( o['demog'], o['site'] )
+    runs = Bulk_Resolve( pGUIDs, o['modalities'], spi.PCInfo_fname, o['db_fname'], spi.FasTrk_root if o['fasttrack'] else '' )
+    runs.to_csv( o['out'], index=False )
+
+    print('Participants: %d,  runs: %d,  with NDA record: %d (more than one: %d)'
+          % (len(pGUIDs), len(runs), (runs['nda_matches'] > 0).sum(), (runs['nda_matches'] > 1).sum()) )
+    if o['fasttrack']:
+        print('Fast-track file found: %d,  more than one: %d' % ((runs['FasTrk_files_found'] == 1).sum(), (runs['FasTrk_files_found'] > 1).sum()) )
+    print('Run table written to %s in %.1f s' % (o['out'], time.time() - start_time) )
+# ========================================================================================================================================================
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+import sys, os, getopt, time, queue
+import multiprocessing
+from collections import deque
+
+import series_process_info_get as spi
+import share_pool
+from share_pool import Task_run, Worker_Pool_Preload
+from share_plan import Plan_Tasks_get
+from task_schedule import Tasks_get
+from share_progress import Runs_Expected_get, Progress_Report
+from share_config import Share_Config_Get
+from share_log import Quiet_Set
+from share_errors import Share_Error
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Campaign: all sites and modalities of a release in one worker pool (share_pool.py), instead of one run_mproc_share.sh or
+# share_pool.py per site and modality.
+#
+# Every task reads the processed-data root of its modality (proc, proc_dti or proc_bold, from MMIL_ProjInfo.csv) and the
+# fast-track root, and writes the output directory of its site (OutRoot/<site>, as /mproc/<site> of run_mproc_share.sh).
+# These live on different NFS servers, so the parent caps the tasks running at once on each root ("Campaign_fs_tasks" in
+# share_config.json: root -> most tasks; a path is counted under the longest listed root that contains it; roots not listed
+# take "Campaign_fs_tasks_default", 0 = no cap).
+#
+# Workers do not belong to a site. Each (site, modality) has its queue of tasks, and a free worker is given the next task,
+# taking sites in turn and the modalities of a site in turn, whose roots are below their caps: a site whose roots are busy,
+# or that has no tasks left, does not hold workers, which go to the other sites' work.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Site_dirs = {'ucsd': 'daic', 'umb': 'oahu', 'wustl': 'washu'}    # Output directory of a site, where it is not the site's name
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Share minimally-processed data of many sites and modalities in one pool of workers (share_pool.py), with a cap')
+    print('on the tasks that use each file-system root at once ("Campaign_fs_tasks" in share_config.json)')
+    print()
+    print('Usage:')
+    print('  ./campaign.py  --demog SubjsFile  --site S1,S2,...  --modality M1,M2,...  --NDAdb DB  --outroot OutRoot  [--workers N]')
+    print('                 [--logdir LogDir]  [--tasks-per-worker T]  [--bulk]  [--plan PlanFile]  [--nowrite]  [--quiet]')
+    print()
+    print('where:')
+    print('  SubjsFile   Table (.csv) listing pGUIDs, anonymized dob, gender; participants of a site are the lines containing it')
+    print('  M1,M2,...   Modalities, from:', spi.modality_list )
+    print('  DB          NDA-downloaded database package (image03.txt)')
+    print('  OutRoot     Output directories of the sites are OutRoot/<site> (ucsd: daic, umb: oahu, wustl: washu)')
+    print('  N           Worker processes (default: number of CPUs)')
+    print('  PlanFile    Share the runs of this share plan (share_plan.py), of the given sites and modalities, without discovery')
+    print('  other options as in share_pool.py')
+    print()
+    print('Example:')
+    print('  ./campaign.py  --demog Subjs_Year1_patch.csv  --site chla,ucsd,umb,yale  --modality T1,T2,dMRI,rsfMRI  --NDAdb image03.txt  --outroot /mproc  --workers 32  --logdir logs')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def command_line_get_variables():
+    o = {'demog': '', 'sites': [], 'modalities': [], 'db_fname': '', 'outroot': '', 'workers': os.cpu_count() or 1,
+         'logdir': '', 'tasks_per_worker': 0, 'bulk': False, 'plan': '', 'test_mode': False, 'quiet': False}
+
+    try:
+        opts,args = getopt.getopt(sys.argv[1:], "hd:s:m:n:o:p:l:t:bP:wq",
+                                  ["demog=", "site=", "modality=", "NDAdb=", "outroot=", "workers=", "logdir=",
+                                   "tasks-per-worker=", "bulk", "plan=", "nowrite", "quiet"])
+    except getopt.GetoptError as err:
+        print("Error parsing arguments: %s" % str(err))
+        program_description()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            program_description()
+            sys.exit()
+        elif opt in ("-d", "--demog"):
+            o['demog'] = arg
+        elif opt in ("-s", "--site"):
+            o['sites'] = arg.split(',')
+        elif opt in ("-m", "--modality"):
+            o['modalities'] = arg.split(',')
+        elif opt in ("-n", "--NDAdb"):
+            o['db_fname'] = arg
+        elif opt in ("-o", "--outroot"):
+            o['outroot'] = arg
+        elif opt in ("-p", "--workers"):
+            o['workers'] = max( 1, int(arg) )
+        elif opt in ("-l", "--logdir"):
+            o['logdir'] = arg
+        elif opt in ("-t", "--tasks-per-worker"):
+            o['tasks_per_worker'] = int(arg)
+        elif opt in ("-b", "--bulk"):
+            o['bulk'] = True
+        elif opt in ("-P", "--plan"):
+            o['plan'] = arg
+        elif opt in ("-w", "--nowrite"):
+            o['test_mode'] = True
+        elif opt in ("-q", "--quiet"):
+            o['quiet'] = True
+
+    if not (o['demog'] and o['sites'] and o['modalities'] and o['db_fname'] and o['outroot']):
+        program_description()
+        sys.exit()
+
+    for m in o['modalities']:
+        if m not in spi.modality_list:
+            print('Error: Modality must be one of', spi.modality_list )
+            sys.exit()
+
+    return o
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Root_get( path, caps, default_cap ):
+    # (root, cap) that path counts under: the longest root of caps that contains it, or path itself with default_cap
+    path = os.path.normpath( path )
+    best = ''
+    for root in caps:
+        r = os.path.normpath( root )
+        if (path == r or path.startswith( r.rstrip('/') + '/' )) and len(r) > len(best):
+            best = r
+            cap = int( caps[root] )
+    return (best, cap)  if best  else (path, int(default_cap))
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Task_Roots_get( sites, modalities, outdirs, caps, default_cap ):
+    # {(site, modality): [(root, cap), ...]}: the roots each (site, modality) reads and writes
+    fasttrack = Root_get( Share_Config_Get().get('FasTrk_root', '/fast-track'), caps, default_cap )
+    roots = {}
+    for modality in modalities:
+        try:
+            proc = Root_get( spi.Scantype_and_Path_get( modality )[1], caps, default_cap )
+        except (OSError, KeyError) as err:
+            print('Warning: unable to find the processed-data root of %s (%s); its reads are not capped' % (modality, err) )
+            proc = ('', 0)
+        for site in sites:
+            roots[ (site, modality) ] = [proc, fasttrack, Root_get( outdirs[site], caps, default_cap )]
+    return roots
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Task_Next( queues, turn, busy, roots ):
+    # Next task that can start: sites in turn from turn['site'], and the modalities of each site in turn; a task can start
+    # if all the roots of its (site, modality) are below their caps. Takes it from its queue; None if no task can start.
+    sites = list( queues )
+    for i in range(len(sites)):
+        site = sites[ (turn['site'] + i) % len(sites) ]
+        modalities = list( queues[site] )
+        for j in range(len(modalities)):
+            modality = modalities[ (turn.get(site, 0) + j) % len(modalities) ]
+            q = queues[site][modality]
+            if q and all( cap <= 0 or busy.get(root, 0) < cap  for root, cap in roots[(site, modality)] ):
+                turn['site'] = (turn['site'] + i + 1) % len(sites)
+                turn[site]   = (turn.get(site, 0) + j + 1) % len(modalities)
+                return q.popleft()
+    return None
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Campaign_Status( queues, running, results, busy, roots ):
+    # One line per site (tasks done, running, queued), and the tasks on each capped root
+    print('Campaign  %s:  done %d,  running %d,  queued %d' % (time.strftime('%Y-%m-%d %H:%M:%S'), len(results), len(running),
+                                                             sum( len(q)  for s in queues.values()  for q in s.values() )) )
+    for site in queues:
+        print('  %-10s done %6d   running %4d   queued %6d' % (site, sum( 1  for r in results  if r['site'] == site ),
+                                                             sum( 1  for t in running  if t[2] == site ),
+                                                             sum( len(q)  for q in queues[site].values() )) )
+    caps = dict( rc  for rr in roots.values()  for rc in rr  if rc[1] > 0 )
+    for root, cap in sorted( caps.items() ):
+        print('  %-40s %4d of %d tasks' % (root, busy.get(root, 0), cap) )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Campaign_Run( queues, roots, workers, tasks_per_worker=0, report=None, interval=0 ):
+    # Share the tasks of queues {site: {modality: deque of (subject, modality, site)}} in a pool of forked workers, starting
+    # each task when a worker is free and its roots are below their caps (Task_Next). report(queues, running, results, busy)
+    # is called every interval seconds, and once at the end. Returns the results of Task_run.
+    ctx = multiprocessing.get_context( 'fork' )
+    done = queue.Queue()
+    busy = {}
+    turn = {'site': 0}
+    running = []
+    results = []
+    with ctx.Pool( processes=workers, maxtasksperchild=(tasks_per_worker or None) ) as pool:
+        last_report = time.time()
+        while True:
+            while len(running) < workers:
+                task = Task_Next( queues, turn, busy, roots )
+                if task is None:
+                    break
+                for root, cap in roots[ (task[2], task[1]) ]:
+                    busy[root] = busy.get(root, 0) + 1
+                running.append( task )
+                pool.apply_async( Task_run, (task,), callback=done.put,
+                                  error_callback=lambda err, t=task: done.put( {'subject': t[0], 'modality': t[1], 'site': t[2], 'status': 'error',
+                                                                                'runs': 0, 'runs_ok': 0, 'pid': 0, 'elapsed_s': 0.0} ) )
+            if not running:
+                break
+
+            try:
+                r = done.get( timeout=(max( 0.1, last_report + interval - time.time() )  if report  else None) )
+            except queue.Empty:
+                r = None
+            if r:
+                task = (r['subject'], r['modality'], r['site'])
+                running.remove( task )
+                for root, cap in roots[ (r['site'], r['modality']) ]:
+                    busy[root] -= 1
+                print('%-10s %-14s %-16s %-16s %3d/%-3d runs %7.1f s   (worker %d)' % (r['site'], r['subject'], r['modality'], r['status'],
+                                                                                r['runs_ok'], r['runs'], r['elapsed_s'], r['pid']) )
+                results.append( r )
+            if report and time.time() - last_report >= interval:
+                report( queues, running, results, busy )
+                last_report = time.time()
+    if report:
+        report( queues, running, results, busy )
+    return results
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    o = command_line_get_variables()
+    if o['quiet']:
+        Quiet_Set( True )    # Inherited by the workers
+
+    outdirs = { site: os.path.join( o['outroot'], Site_dirs.get(site, site) )  for site in o['sites'] }
+    for d in list( outdirs.values() ) + ([o['logdir']]  if o['logdir']  else []):
+        if not os.path.isdir( d ):
+            os.makedirs( d )
+
+    # Queues of tasks by site and modality, from the subjects file or from a share plan
+    queues = { site: { modality: deque()  for modality in o['modalities'] }  for site in o['sites'] }
+    plan_sizes = {}
+    if o['plan']:
+        try:
+            plan = Plan_Tasks_get( o['plan'], o['sites'], o['modalities'] )
+        except Share_Error as err:
+            print( err )
+            sys.exit()
+        for subj, modality, site, recs, sizes in plan:
+            queues[site][modality].append( (subj, modality, site) )
+            plan_sizes[ (subj, modality, site) ] = sizes
+        o['plan_runs'] = { (subj, modality, site): recs  for subj, modality, site, recs, sizes in plan }    # As the tasks, by site
+    else:
+        for site in o['sites']:
+            for subj, modality in Tasks_get( o['demog'], site, o['modalities'] ):
+                queues[site][modality].append( (subj, modality, site) )
+    tasks = [ t  for s in queues.values()  for q in s.values()  for t in q ]
+
+    Config = Share_Config_Get()
+    roots = Task_Roots_get( o['sites'], o['modalities'], outdirs, Config.get('Campaign_fs_tasks', {}) or {},
+                            Config.get('Campaign_fs_tasks_default', 0) or 0 )
+
+    share_pool.Pool_options.update( o, outdir='', site='', outdirs=outdirs )    # Inherited by the workers
+    print('Tasks (participant, modality): %d,  sites: %d,  workers: %d' % (len(tasks), len(o['sites']), o['workers']) )
+    print()
+
+    t0 = time.time()
+    Worker_Pool_Preload( o['demog'], o['db_fname'], [ t[:2]  for t in tasks ], o['bulk'] )
+    print('Preload time: %.2f s' % (time.time() - t0) )
+    print()
+
+    # Status of the campaign and, with a plan (whose runs are known), progress of each site (share_progress.py)
+    interval = float( Config.get('Progress_interval_s', 60) or 0 )
+    report = None
+    if interval:
+        expected = {}
+        for site in o['sites']:
+            site_tasks = [ t  for t in tasks  if t[2] == site ]
+            expected[site] = Runs_Expected_get( [ t[:2]  for t in site_tasks ], [ plan_sizes[t]  for t in site_tasks ] )  if o['plan']  else None
+        def campaign_report( queues, running, results, busy ):
+            Campaign_Status( queues, running, results, busy, roots )
+            for site in o['sites']:
+                if expected[site]:
+                    Progress_Report( site, outdirs[site], expected[site], t0, Config.get('Progress_textfile_dir', '') )
+        report = campaign_report
+
+    results = Campaign_Run( queues, roots, o['workers'], o['tasks_per_worker'], report, interval )
+
+    print()
+    print('Tasks: %d,  ok: %d,  with failed runs: %d,  stopped by an error: %d,  crashed: %d;  runs shared: %d of %d;  elapsed: %.1f s'
+          % (len(results), sum(1 for r in results if r['status'] == 'ok'), sum(1 for r in results if r['status'] == 'runs failed'),
+             sum(1 for r in results if r['status'].endswith('_Error') or r['status'].startswith('exit')),
+             sum(1 for r in results if r['status'] == 'error'),
+             sum(r['runs_ok'] for r in results), sum(r['runs'] for r in results), time.time() - t0) )
+# ========================================================================================================================================================
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import sys, os, json, hashlib, shutil, sqlite3, time
+
+from share_config import Share_Config_Get
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Converted NIfTI images, kept on a local disk ("Conversion_cache_dir" in share_config.json; '' = no cache) so that rerunning
+# a series (after a miNDA failure, a metadata fix, a new bucket) does not call mri_convert again. An entry is keyed by the
+# SHA-256 of the source file's identity (absolute path, size, modification time) and of the conversion command and its
+# parameters (mri_convert, TR, TE, TI, flip angle); a changed source or parameter is a different entry.
+#
+# Entries are hard-linked (or copied, across file systems) into the run's scratch directory, so the run can remove its copy,
+# and the cache evict its entry, independently. The cache is kept under "Conversion_cache_bytes" by removing the least
+# recently used entries (index.sqlite in the cache directory, shared by all processes).
+# ---------------------------------------------------------------------------------------------------------------------------------
+Index_fname = 'index.sqlite'
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Cache_dir_get():
+    return Share_Config_Get().get('Conversion_cache_dir', '')
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Cache_Open( cache_dir ):
+    os.makedirs( cache_dir, exist_ok=True )
+    conn = sqlite3.connect( os.path.join(cache_dir, Index_fname), timeout=60, isolation_level=None )
+    conn.execute( 'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, last_used REAL, source TEXT)' )
+    return conn
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Conversion_Key_get( source, cmnd_and_args ):
+    # Key of the conversion of source by cmnd_and_args (with the output file name left out); '' if source is unreadable
+    try:
+        st = os.stat( source )
+    except OSError:
+        return ''
+    ident = {'source': os.path.abspath(source), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'command': cmnd_and_args}
+    return hashlib.sha256( json.dumps( ident, sort_keys=True ).encode('utf8') ).hexdigest()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def link_or_copy( src, dst ):
+    try:
+        os.link( src, dst )
+    except OSError:
+        shutil.copyfile( src, dst )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Conversion_Cache_get( key, fname_image ):
+    # Place the cached conversion at fname_image; returns True on a hit
+    cache_dir = Cache_dir_get()
+    if not cache_dir or not key:
+        return False
+    entry = os.path.join( cache_dir, key + '.nii' )
+    try:
+        link_or_copy( entry, fname_image )
+    except OSError:
+        return False
+    try:
+        conn = Cache_Open( cache_dir )
+        conn.execute( 'UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key) )
+        conn.close()
+    except sqlite3.Error:
+        pass
+    return True
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Conversion_Cache_put( key, fname_image, source='' ):
+    # Add a fresh conversion to the cache, then evict least recently used entries beyond Conversion_cache_bytes
+    cache_dir = Cache_dir_get()
+    if not cache_dir or not key:
+        return
+    budget = int( Share_Config_Get().get('Conversion_cache_bytes', 0) or 0 )
+    entry = os.path.join( cache_dir, key + '.nii' )
+    try:
+        os.makedirs( cache_dir, exist_ok=True )
+        partial = '%s.part-%d' % (entry, os.getpid())
+        link_or_copy( fname_image, partial )
+        os.replace( partial, entry )
+
+        conn = Cache_Open( cache_dir )
+        conn.execute( 'BEGIN IMMEDIATE' )
+        conn.execute( 'INSERT OR REPLACE INTO entries VALUES (?,?,?,?)', (key, os.path.getsize(entry), time.time(), source) )
+        evicted = []
+        if budget:
+            total = conn.execute( 'SELECT COALESCE(SUM(size), 0) FROM entries' ).fetchone()[0]
+            for old_key, size in conn.execute( 'SELECT key, size FROM entries WHERE key != ? ORDER BY last_used', (key,) ).fetchall():
+                if total <= budget:
+                    break
+                evicted.append( old_key )
+                total -= size
+            conn.executemany( 'DELETE FROM entries WHERE key = ?', [ (k,) for k in evicted ] )
+        conn.execute( 'COMMIT' )
+        conn.close()
+    except (OSError, sqlite3.Error) as err:
+        print('Warning: unable to add conversion to cache %s: %s' % (cache_dir, err) )
+        return
+
+    for old_key in evicted:
+        try:
+            os.remove( os.path.join( cache_dir, old_key + '.nii' ) )
+        except OSError:
+            pass
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    # Show the contents of the cache
+    cache_dir = Cache_dir_get()
+    if not cache_dir:
+        print('No conversion cache ("Conversion_cache_dir" is empty in share_config.json)')
+        sys.exit()
+
+    conn = Cache_Open( cache_dir )
+    rows = conn.execute( 'SELECT key, size, last_used, source FROM entries ORDER BY last_used DESC' ).fetchall()
+    conn.close()
+    print('Conversion cache %s:  %d entries,  %.1f of %.1f GB' % (cache_dir, len(rows), sum(r[1] for r in rows) / 2**30,
+                                                                  int(Share_Config_Get().get('Conversion_cache_bytes', 0) or 0) / 2**30) )
+    for key, size, last_used, source in rows:
+        print('  %s  %10.1f MB  %s  %s' % (key[:12], size / 2**20, time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used)), source) )
+# ========================================================================================================================================================
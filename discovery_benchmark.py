@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+import sys, os, getopt, json, csv, time, random, io, contextlib
+
+import series_process_info_get as spi
+import share_min_proc_fMRI_dMRI_BOLD_T1T2 as share
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Discovery micro-benchmarks against a synthetic data set (see synthetic_dataset_create.py):
+# times each discovery step, per participant and modality, and summarizes the distribution per step.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Steps = ['PCInfo_get', 'Sers_from_ContainerInfo_and_PCinfo', 'T1T2_file_names_get', 'BOLD_file_names_get',
+         'DTI_file_names_and_RegMtx_get', 'FasTrk_files_names_get', 'NDA_db_Metadata_Get', 'Get_File_Names_and_Process_Info']
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Time discovery functions of series_process_info_get.py and share_min_proc_fMRI_dMRI_BOLD_T1T2.py')
+    print('against a synthetic data set created with synthetic_dataset_create.py')
+    print()
+    print('Usage:')
+    print('  ./discovery_benchmark.py  --root Root  [--sample N]  [--modality M1,M2,...]  [--seed Seed]  [--json Results]')
+    print()
+    print('where:')
+    print('  Root       Synthetic data set root')
+    print('  N          Number of randomly chosen participants (default 50)')
+    print('  M1,M2,...  Modalities to benchmark (default all):', spi.modality_list )
+    print('  Results    Write per-step statistics, and all timings, to this .json file')
+    print()
+    print('Example:')
+    print('  ./discovery_benchmark.py  --root /scratch/abcd_synth_10k  --sample 200  --modality T1,dMRI,fMRI_MID_task')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def command_line_get_variables():
+    root       = ''
+    sample     = 50
+    modalities = spi.modality_list
+    seed       = 1
+    json_fname = ''
+
+    try:
+        opts,args = getopt.getopt(sys.argv[1:], "hr:n:m:e:j:", ["root=", "sample=", "modality=", "seed=", "json="])
+    except getopt.GetoptError as err:
+        print("Error parsing arguments: %s" % str(err))
+        program_description()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            program_description()
+            sys.exit()
+        elif opt in ("-r", "--root"):
+            root = arg
+        elif opt in ("-n", "--sample"):
+            sample = int(arg)
+        elif opt in ("-m", "--modality"):
+            modalities = arg.split(',')
+        elif opt in ("-e", "--seed"):
+            seed = int(arg)
+        elif opt in ("-j", "--json"):
+            json_fname = arg
+
+    if not root:
+        program_description()
+        sys.exit()
+
+    for m in modalities:
+        if m not in spi.modality_list:
+            print('Error: Modality must be one of', spi.modality_list )
+            sys.exit()
+
+    return os.path.abspath(root), sample, modalities, seed, json_fname
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Synthetic_Root_Set( root ):
+    # Point discovery at a synthetic data set
+    spi.Dirs_Loc_fname = root + '/ProjInfo/MMIL_ProjInfo.csv'
+    spi.PCInfo_fname   = root + '/MetaData/DAL_ABCD/DAL_ABCD_pcinfo.csv'
+    spi.FasTrk_root    = root + '/fast-track'
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def timed( timings, step, fn, *args ):
+    # Call fn(*args) with its printed output discarded; append elapsed seconds to timings[step].
+    # Returns (result, ok); helpers that give up call sys.exit, which is counted as a failure
+    t0 = time.perf_counter()
+    ok = True
+    res = None
+    try:
+        with contextlib.redirect_stdout( io.StringIO() ):
+            res = fn( *args )
+    except (SystemExit, Exception):
+        ok = False
+    timings.setdefault( step, {'t': [], 'fail': 0} )
+    timings[step]['t'].append( time.perf_counter() - t0 )
+    if not ok:
+        timings[step]['fail'] += 1
+    return res, ok
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Discovery_Benchmark( root, subjects, modalities ):
+    Synthetic_Root_Set( root )
+    db_fname = root + '/image03.txt'
+    timings  = {}
+
+    for modality in modalities:
+        scantype, fpath = spi.Scantype_and_Path_get( modality )
+
+        for subj in subjects:
+            timed( timings, 'PCInfo_get', spi.PCInfo_get, subj, modality )
+
+            res, ok = timed( timings, 'Sers_from_ContainerInfo_and_PCinfo', spi.Sers_from_ContainerInfo_and_PCinfo,
+                             subj, modality, scantype, fpath )
+            if not ok:
+                continue
+            Series, fdir, manuf = res
+            scan_number = Series.index.tolist()
+
+            if scantype in ['MPR', 'XetaT2']:
+                timed( timings, 'T1T2_file_names_get', spi.T1T2_file_names_get, fdir, scantype, scan_number )
+            elif scantype == 'BOLD':
+                timed( timings, 'BOLD_file_names_get', spi.BOLD_file_names_get,
+                       fdir, scan_number, spi.task_for_modality[modality], Series['t_ord'].tolist() )
+            elif scantype == 'DTI':
+                timed( timings, 'DTI_file_names_and_RegMtx_get', spi.DTI_file_names_and_RegMtx_get, fdir, manuf, scan_number )
+
+            FasTrk_files, ok = timed( timings, 'FasTrk_files_names_get', spi.FasTrk_files_names_get, Series, scan_number, subj, modality )
+            if ok:
+                for run in FasTrk_files.values():
+                    timed( timings, 'NDA_db_Metadata_Get', share.NDA_db_Metadata_Get,
+                           db_fname, 'NDAR_' + subj, run['FasTrk_file_Guessed_Name'] )
+
+            timed( timings, 'Get_File_Names_and_Process_Info', spi.Get_File_Names_and_Process_Info, subj, modality )
+
+    return timings
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Timings_Summary( timings ):
+    summary = {}
+    for step in Steps:
+        if step not in timings:
+            continue
+        t = sorted( timings[step]['t'] )
+        n = len(t)
+        summary[step] = {'n':         n,
+                         'fail':      timings[step]['fail'],
+                         'mean_ms':   1000*sum(t)/n,
+                         'median_ms': 1000*t[n//2],
+                         'p95_ms':    1000*t[ min(n-1, int(0.95*n)) ],
+                         'max_ms':    1000*t[-1],
+                         'total_s':   sum(t)}
+    return summary
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Timings_Summary_print( summary ):
+    hdr = '%-36s %6s %5s %10s %10s %10s %10s %9s' % ('step', 'n', 'fail', 'mean_ms', 'median_ms', 'p95_ms', 'max_ms', 'total_s')
+    print( hdr )
+    print( '-' * len(hdr) )
+    for step, r in summary.items():
+        print( '%-36s %6d %5d %10.1f %10.1f %10.1f %10.1f %9.1f' % (step, r['n'], r['fail'], r['mean_ms'], r['median_ms'],
+                                                                   r['p95_ms'], r['max_ms'], r['total_s']) )
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Synthetic_Subjects_get( root ):
+    with open(root + '/Subjs_synthetic.csv', 'r', newline='') as f:
+        return [ row['pGUID'].split('_')[1]  for row in csv.DictReader(f) ]
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    root, sample, modalities, seed, json_fname  =  command_line_get_variables()
+
+    subjects = Synthetic_Subjects_get( root )
+    subjects = random.Random( seed ).sample( subjects, min(sample, len(subjects)) )
+
+    print('Benchmarking discovery on %d of the participants in %s, modalities: %s' % (len(subjects), root, ', '.join(modalities)) )
+    print()
+
+    timings = Discovery_Benchmark( root, subjects, modalities )
+    summary = Timings_Summary( timings )
+    Timings_Summary_print( summary )
+
+    if json_fname:
+        with open(json_fname, 'w') as f:
+            json.dump( {'root': root, 'subjects': subjects, 'modalities': modalities,
+                        'summary': summary, 'timings': timings}, f, indent=2 )
+        print('Results written to', json_fname )
+# ========================================================================================================================================================
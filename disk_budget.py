@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import os, time, sqlite3, struct, atexit
+
+from share_config import Share_Config_Get, Host_db_fname_get
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Byte budgets for the space the share script stages: uncompressed NIfTI files in scratch, and BIDS archives in the output
+# directory until their upload is confirmed. Before converting or archiving, a run reserves the space it will need (estimated
+# from the size of its input file) in a sqlite file shared by all processes of the host ("Budget_db_fname", under
+# "Scratch_root" unless the name is absolute); when the pool is exhausted it waits, up to "Budget_wait_s", for other runs to
+# release theirs. Reservations of processes that no longer exist are dropped, and a reservation larger than the whole budget
+# is granted when the pool is empty, so that it cannot wait forever.
+#
+# Budgets ("Scratch_budget_bytes", "Outdir_budget_bytes" in share_config.json) are off (0) by default. With an output-directory
+# budget, archives are removed (evicted) once their upload is confirmed; their manifests (archive_digest.py) stay.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Budget_keys = {'scratch': 'Scratch_budget_bytes', 'outdir': 'Outdir_budget_bytes'}
+
+Poll_interval = 2.0    # s between attempts while waiting for space
+
+Archive_overhead = 2**20    # Sidecars and tar headers added to the image in an archive
+
+Reserved = {}    # Reservations held by this process: id -> (pool, bytes, label)
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Budget_get( pool ):
+    # Bytes allowed in pool; 0 = no limit (no reservations are recorded)
+    return int( Share_Config_Get().get( Budget_keys[pool], 0 ) or 0 )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Budget_db_Open():
+    conn = sqlite3.connect( Host_db_fname_get('Budget_db_fname'), timeout=60, isolation_level=None )
+    conn.execute( 'CREATE TABLE IF NOT EXISTS reservations (id INTEGER PRIMARY KEY, pool TEXT, bytes INTEGER, pid INTEGER, label TEXT, created REAL)' )
+    return conn
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def pid_alive( pid ):
+    try:
+        os.kill( pid, 0 )
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Reserve( pool, nbytes, label='' ):
+    # Reserve nbytes of pool, waiting for space if needed. Returns the reservation id (0 when the pool has no budget),
+    # or None if no space became available within Budget_wait_s.
+    budget = Budget_get( pool )
+    if not budget:
+        return 0
+
+    wait_max = float( Share_Config_Get().get('Budget_wait_s', 3600) )
+    t0 = time.time()
+    announced = False
+    while True:
+        conn = Budget_db_Open()
+        try:
+            conn.execute( 'BEGIN IMMEDIATE' )
+            dead = [ (rid,)  for rid, pid in conn.execute('SELECT id, pid FROM reservations')  if not pid_alive(pid) ]
+            conn.executemany( 'DELETE FROM reservations WHERE id = ?', dead )
+            used = conn.execute( 'SELECT COALESCE(SUM(bytes), 0) FROM reservations WHERE pool = ?', (pool,) ).fetchone()[0]
+
+            if used == 0 or used + nbytes <= budget:
+                rid = conn.execute( 'INSERT INTO reservations (pool, bytes, pid, label, created) VALUES (?,?,?,?,?)',
+                                    (pool, nbytes, os.getpid(), label, time.time()) ).lastrowid
+                conn.execute( 'COMMIT' )
+                Reserved[ rid ] = (pool, nbytes, label)
+                if announced:
+                    print('Disk budget: %s space for %s available after %.1f s' % (pool, label, time.time() - t0) )
+                return rid
+            conn.execute( 'COMMIT' )
+        finally:
+            conn.close()
+
+        if time.time() - t0 > wait_max:
+            print('Error: no %s space for %s (%d bytes) within %.0f s: %d of %d bytes reserved' % (pool, label, nbytes, wait_max, used, budget) )
+            return None
+        if not announced:
+            print('Disk budget: waiting for %d bytes of %s space for %s (%d of %d bytes reserved)' % (nbytes, pool, label, used, budget) )
+            announced = True
+        time.sleep( Poll_interval )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Resize( rid, nbytes ):
+    # Replace the estimate of a reservation by the actual size (never waits)
+    if not rid:
+        return
+    conn = Budget_db_Open()
+    conn.execute( 'UPDATE reservations SET bytes = ? WHERE id = ?', (nbytes, rid) )
+    conn.close()
+    pool, _, label = Reserved[ rid ]
+    Reserved[ rid ] = (pool, nbytes, label)
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Release( rid ):
+    if not rid or rid not in Reserved:
+        return
+    try:
+        conn = Budget_db_Open()
+        conn.execute( 'DELETE FROM reservations WHERE id = ?', (rid,) )
+        conn.close()
+    except sqlite3.Error as err:
+        print('Warning: unable to release disk reservation:', err )
+    del Reserved[ rid ]
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Release_All():
+    # Everything this process holds: at the end of a task (share_pool.py) and at exit
+    for rid in list( Reserved ):
+        Release( rid )
+
+atexit.register( Release_All )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Converted_size_estimate( fname ):
+    # Bytes of the uncompressed NIfTI converted from fname: for gzip-compressed input (.mgz, .nii.gz), the uncompressed size
+    # recorded in the gzip trailer (modulo 4 GiB, so never less than the compressed size); otherwise the size of fname
+    try:
+        size = os.path.getsize( fname )
+        if fname.endswith('.mgz') or fname.endswith('.gz'):
+            with open(fname, 'rb') as f:
+                f.seek( -4, os.SEEK_END )
+                isize = struct.unpack( '<I', f.read(4) )[0]
+            while isize < size:
+                isize += 2**32
+            size = isize
+    except (OSError, struct.error):
+        return 0
+    return size + 352
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Evict_uploaded():
+    # Remove archives once uploaded, to keep the output directory within its budget
+    return Budget_get('outdir') > 0
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    # Show budgets and current reservations
+    for pool in Budget_keys:
+        print('%-8s budget: %s' % (pool, Budget_get(pool) or 'none') )
+    conn = Budget_db_Open()
+    print()
+    for rid, pool, nbytes, pid, label, created in conn.execute( 'SELECT * FROM reservations ORDER BY id' ):
+        print('%6d  %-8s %14d bytes  pid %-7d %s  %s  %s' % (rid, pool, nbytes, pid, 'alive' if pid_alive(pid) else 'gone ',
+                                                             time.strftime('%H:%M:%S', time.localtime(created)), label) )
+    conn.close()
+# ========================================================================================================================================================
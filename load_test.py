@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+import sys, os, getopt, json, csv, time, shutil, subprocess, sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from standin_services import Standin_Services_Start, Standin_Services_Stop
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# End-to-end throughput test: runs whole site batches through share_min_proc_fMRI_dMRI_BOLD_T1T2.py, as run_mproc_share.sh does,
+# against a synthetic data set (synthetic_dataset_create.py) and the local miNDA and S3 stand-ins (standin_services.py).
+# Reports participants/hour, runs shared, MB/s received by the S3 stand-in, and per-stage latency from table stage_usage.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Share_script = os.path.dirname(os.path.abspath(__file__)) + '/share_min_proc_fMRI_dMRI_BOLD_T1T2.py'
+Converter    = os.path.dirname(os.path.abspath(__file__)) + '/mri_convert_standin.py'
+
+Outdir_for_site = {'ucsd': 'daic', 'umb': 'oahu', 'wustl': 'washu'}     # As in run_mproc_share.sh
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Run site batches through the whole sharing pipeline against local miNDA and S3 stand-ins, and report throughput')
+    print()
+    print('Usage:')
+    print('  ./load_test.py  --root Root  --work Work  [--sites S1,S2]  [--modality M1,M2]  [--workers N]  [--subjects K]')
+    print('                  [--latency L]  [--error-rate E]  [--s3-error-rate F]  [--tls]  [--mri-convert Cmd]  [--aws Cmd]  [--json Results]')
+    print()
+    print('where:')
+    print('  Root     Synthetic data set (synthetic_dataset_create.py)')
+    print('  Work     Empty working directory: configuration, outdirs /mproc/<site>, stand-in state, and one log per job')
+    print('  S1,S2    Sites to run (default: all sites in the data set)')
+    print('  M1,M2    Modalities (default: all)')
+    print('  N        Concurrent share processes (default 1, like run_mproc_share.sh)')
+    print('  K        At most K participants per site (default: all)')
+    print('  L, E, F  Stand-in miNDA latency (s) and error rate, and S3 error rate (defaults 0.2, 0, 0)')
+    print('  Cmd      mri_convert to use (default: mri_convert_standin.py), and AWS CLI (default: aws in PATH)')
+    print()
+    print('Example:')
+    print('  ./load_test.py  --root /scratch/abcd_synth_1k  --work /scratch/lt1  --sites chla,yale  --workers 4  --json lt1.json')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def command_line_get_variables():
+    o = {'root': '', 'work': '', 'sites': [], 'modalities': ['T1', 'T2', 'dMRI', 'fMRI_MID_task', 'fMRI_SST_task', 'fMRI_nBack_task', 'rsfMRI'],
+         'workers': 1, 'subjects': 0, 'latency': 0.2, 'error_rate': 0.0, 's3_error_rate': 0.0, 'tls': False,
+         'mri_convert': Converter, 'aws': shutil.which('aws') or 'aws', 'json': ''}
+    try:
+        opts,args = getopt.getopt(sys.argv[1:], "hr:w:s:m:n:k:l:e:f:tc:a:j:",
+                                  ["root=", "work=", "sites=", "modality=", "workers=", "subjects=", "latency=", "error-rate=",
+                                   "s3-error-rate=", "tls", "mri-convert=", "aws=", "json="])
+    except getopt.GetoptError as err:
+        print("Error parsing arguments: %s" % str(err))
+        program_description()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            program_description()
+            sys.exit()
+        elif opt in ("-r", "--root"):          o['root'] = os.path.abspath(arg)
+        elif opt in ("-w", "--work"):          o['work'] = os.path.abspath(arg)
+        elif opt in ("-s", "--sites"):         o['sites'] = arg.split(',')
+        elif opt in ("-m", "--modality"):      o['modalities'] = arg.split(',')
+        elif opt in ("-n", "--workers"):       o['workers'] = int(arg)
+        elif opt in ("-k", "--subjects"):      o['subjects'] = int(arg)
+        elif opt in ("-l", "--latency"):       o['latency'] = float(arg)
+        elif opt in ("-e", "--error-rate"):    o['error_rate'] = float(arg)
+        elif opt in ("-f", "--s3-error-rate"): o['s3_error_rate'] = float(arg)
+        elif opt in ("-t", "--tls"):           o['tls'] = True
+        elif opt in ("-c", "--mri-convert"):   o['mri_convert'] = arg
+        elif opt in ("-a", "--aws"):           o['aws'] = arg
+        elif opt in ("-j", "--json"):          o['json'] = arg
+
+    if not o['root'] or not o['work']:
+        program_description()
+        sys.exit()
+
+    if os.path.isdir(o['work']) and os.listdir(o['work']):
+        print('Error: working directory must be empty:', o['work'] )
+        sys.exit()
+
+    return o
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Work_Dir_Setup( root, work, services_config, mri_convert, aws, bucket='s3://abcd-mproc-loadtest/' ):
+    # Configuration and files the share script expects in its current directory
+    os.makedirs( work + '/logs', exist_ok=True )
+    for fname in ['dataset_description.json', 'login_credentials.json']:
+        shutil.copy( root + '/' + fname, work + '/' + fname )
+
+    Config = {'Dirs_Loc_fname':  root + '/ProjInfo/MMIL_ProjInfo.csv',
+              'PCInfo_fname':    root + '/MetaData/DAL_ABCD/DAL_ABCD_pcinfo.csv',
+              'FasTrk_root':     root + '/fast-track',
+              'mri_convert_cmd': mri_convert,
+              'AWS_cmd':         aws,
+              'AWS_bucket':      bucket}
+    Config.update( services_config )
+    with open(work + '/share_config.json', 'w') as f:
+        json.dump( Config, f, indent=2 )
+    return work + '/share_config.json'
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Jobs_get( root, sites, modalities, max_subjects ):
+    # (site, subject, modality), site by site as run_mproc_share.sh would be called
+    by_site = {}
+    with open(root + '/Subjs_synthetic.csv', 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            by_site.setdefault( row['site'], [] ).append( row['pGUID'].split('_')[1] )
+
+    if not sites:
+        sites = sorted( by_site.keys() )
+
+    jobs = []
+    for site in sites:
+        subjects = by_site.get( site, [] )
+        if max_subjects:
+            subjects = subjects[:max_subjects]
+        for modality in modalities:
+            for subj in subjects:
+                jobs.append( (site, subj, modality) )
+    return jobs
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Job_run( job, root, work, env ):
+    site, subj, modality = job
+    outdir = work + '/mproc/' + Outdir_for_site.get(site, site)
+    os.makedirs( outdir, exist_ok=True )
+
+    cmnd_and_args = [sys.executable, Share_script, '--subject', subj, '--demog', root + '/Subjs_synthetic.csv',
+                     '--modality', modality, '--NDAdb', root + '/image03.txt', '--outdir', outdir]
+    log_fname = '%s/logs/%s_%s_%s.log' % (work, site, subj, modality)
+    t0 = time.time()
+    with open(log_fname, 'w') as flog:
+        rs = subprocess.run( cmnd_and_args, cwd=work, env=env, stdout=flog, stderr=subprocess.STDOUT )
+    elapsed = time.time() - t0
+
+    runs, errors = Job_Log_get( log_fname )
+    return {'site': site, 'subject': subj, 'modality': modality, 'returncode': rs.returncode, 'runs': runs, 'errors': errors,
+            'elapsed_s': elapsed}
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Job_Log_get( log_fname ):
+    # Runs the share script attempted ('bids_run =' lines) and the errors it printed (of the participant or of a run, which
+    # the script reports without exiting non-zero)
+    runs = errors = 0
+    with open(log_fname, 'r', errors='replace') as f:
+        for line in f:
+            if line.startswith('bids_run ='):
+                runs += 1
+            elif line.startswith('Traceback') or line.startswith('Error') or 'share_min_proc_data.py: Error' in line:
+                errors += 1
+    return runs, errors
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def percentile( values, q ):
+    values = sorted( values )
+    return values[ min(len(values)-1, int(q*len(values))) ] if values else float('nan')
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Outdir_Results_get( work ):
+    # Runs recorded in fmriresults01 and stage timings from stage_usage, over all site outdirs
+    runs   = {'recorded': 0, 'miNDA_ok': 0, 's3_ok': 0}
+    stages = {}
+    mproc = work + '/mproc'
+    for site in (os.listdir(mproc) if os.path.isdir(mproc) else []):
+        sqlite_file = mproc + '/' + site + '/metadata.sqlite'
+        if not os.path.isfile( sqlite_file ):
+            continue
+        conn = sqlite3.connect( sqlite_file )
+        tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        if 'fmriresults01' in tables:
+            for miNDA_ok, s3_ok in conn.execute('SELECT miNDA_ok, s3_ok FROM fmriresults01'):
+                runs['recorded'] += 1
+                runs['miNDA_ok'] += (miNDA_ok == 'True')
+                runs['s3_ok']    += (s3_ok == 'True')
+        if 'stage_usage' in tables:
+            for modality, stage, wall_s in conn.execute('SELECT modality, stage, wall_s FROM stage_usage'):
+                stages.setdefault( (modality, stage), [] ).append( wall_s )
+        conn.close()
+    return runs, stages
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Load_Test( o ):
+    services = Standin_Services_Start( o['work'] + '/standin', 0, 0, o['latency'], o['latency']/2, o['error_rate'],
+                                       o['s3_error_rate'], o['tls'] )
+    config_fname = Work_Dir_Setup( o['root'], o['work'], services['config'], o['mri_convert'], o['aws'] )
+
+    env = dict( os.environ )
+    env.update( {'MPROC_SHARE_CONFIG': config_fname, 'AWS_ACCESS_KEY_ID': 'standin', 'AWS_SECRET_ACCESS_KEY': 'standin',
+                 'AWS_DEFAULT_REGION': 'us-east-1'} )
+
+    jobs = Jobs_get( o['root'], o['sites'], o['modalities'], o['subjects'] )
+    print('Running %d jobs (site, participant, modality) with %d worker(s)' % (len(jobs), o['workers']) )
+
+    t0 = time.time()
+    with ThreadPoolExecutor( max_workers=o['workers'] ) as pool:
+        results = list( pool.map( lambda job: Job_run(job, o['root'], o['work'], env), jobs ) )
+    elapsed = time.time() - t0
+
+    minda_counts = dict( services['minda'].counts )
+    s3_counts    = dict( services['s3'].counts )
+    Standin_Services_Stop( services )
+
+    runs, stages = Outdir_Results_get( o['work'] )
+    runs['attempted'] = sum( r['runs'] for r in results )
+    subjects = set( (r['site'], r['subject']) for r in results )
+
+    report = {'jobs':            len(results),
+              'jobs_failed':     sum(1 for r in results if r['returncode'] != 0 or r['errors'] > 0),
+              'participants':    len(subjects),
+              'elapsed_s':       elapsed,
+              'participants_per_hour': 3600 * len(subjects) / elapsed if elapsed else 0,
+              'runs':            runs,
+              'runs_per_hour':   3600 * runs['s3_ok'] / elapsed if elapsed else 0,
+              'MB_uploaded':     s3_counts['bytes_stored'] / 2**20,
+              'MB_per_s':        s3_counts['bytes_stored'] / 2**20 / elapsed if elapsed else 0,
+              'miNDA':           minda_counts,
+              'S3':              s3_counts,
+              'job_latency_s':   {'p50': percentile([r['elapsed_s'] for r in results], 0.5),
+                                  'p95': percentile([r['elapsed_s'] for r in results], 0.95)},
+              'stage_latency_s': {'%s/%s' % k: {'n': len(v), 'mean': sum(v)/len(v), 'p50': percentile(v, 0.5), 'p95': percentile(v, 0.95)}
+                                  for k, v in sorted(stages.items())} }
+    return report, results
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Load_Test_Report_print( report ):
+    print()
+    print('Jobs:                 %d  (%d failed or reported errors)' % (report['jobs'], report['jobs_failed']) )
+    print('Elapsed:              %.1f s' % report['elapsed_s'] )
+    print('Participants/hour:    %.1f' % report['participants_per_hour'] )
+    print('Runs recorded:        %d of %d attempted;  miNDA ok: %d;  S3 ok: %d  (%.1f runs/hour)' % (report['runs']['recorded'],
+                                    report['runs']['attempted'], report['runs']['miNDA_ok'], report['runs']['s3_ok'], report['runs_per_hour']) )
+    print('Uploaded:             %.1f MB,  %.2f MB/s' % (report['MB_uploaded'], report['MB_per_s']) )
+    print('miNDA stand-in:       ', json.dumps(report['miNDA']) )
+    print('Job latency:          p50 %.1f s,  p95 %.1f s' % (report['job_latency_s']['p50'], report['job_latency_s']['p95']) )
+    print()
+    print('%-34s %6s %9s %9s %9s' % ('modality/stage', 'n', 'mean_s', 'p50_s', 'p95_s') )
+    for k, v in report['stage_latency_s'].items():
+        print('%-34s %6d %9.2f %9.2f %9.2f' % (k, v['n'], v['mean'], v['p50'], v['p95']) )
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    o = command_line_get_variables()
+
+    report, results = Load_Test( o )
+    Load_Test_Report_print( report )
+
+    if o['json']:
+        with open(o['json'], 'w') as f:
+            json.dump( {'options': o, 'report': report, 'jobs': results}, f, indent=2 )
+        print('Results written to', o['json'] )
+
+    # Jobs that failed or reported errors, or runs attempted but not recorded, fail the load test
+    if report['jobs_failed'] or report['runs']['recorded'] < report['runs']['attempted']:
+        sys.exit(1)
+# ========================================================================================================================================================
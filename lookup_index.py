@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+import sys, os, csv, time, sqlite3, shutil, hashlib
+
+from share_config import Share_Config_Get
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Prebuilt lookup indexes, so that per-participant lookups do not re-read whole tables with pandas:
+#
+#   pcinfo   DAL_ABCD_pcinfo.csv  ->  rows by participant (columns used by series_process_info_get.PCInfo_get)
+#   nda      image03.txt          ->  rows by subjectkey  (columns used by NDA_db_Metadata_Get)
+#
+# An index is a sqlite file named after its source, <source>.index.sqlite, next to the source or in the directory given by
+# "Index_dir" in share_config.json. It records the size and modification time of the source it was built from;
+# a lookup ignores (returns None for) a missing or stale index, and callers then read the source as before.
+# Indexes are built into a temporary file and renamed into place, so running lookups always see a complete one.
+#
+# NDA packages are downloaded again as they grow. The nda index keeps a hash of each row, and  ./lookup_index.py refresh
+# applies to a copy of the index only the rows of the new image03.txt that are new, changed or gone (by image03_id and row
+# hash), then renames the copy into place: processes that opened the index before keep reading the snapshot they opened.
+# An index without row hashes, or a package whose image03_id are not unique, is built again instead.
+# ---------------------------------------------------------------------------------------------------------------------------------
+PCInfo_index_columns = ['pGUID', 'EventName', 'SiteName', 'Manufacturer', 'SeriesType', 'SeriesInstanceUID', 'StudyDate', 'SeriesTime']
+
+NDA_index_columns    = ['image03_id', 'dataset_id', 'subjectkey', 'interview_date', 'interview_age', 'gender',
+                        'image_file', 'image_description', 'experiment_id', 'visit']
+
+# Same types pandas infers for these columns; everything else is kept as text
+Column_types = {'StudyDate': 'INTEGER', 'SeriesTime': 'REAL', 'image03_id': 'INTEGER', 'dataset_id': 'INTEGER', 'interview_age': 'INTEGER'}
+
+Index_kinds = {'pcinfo': {'columns': PCInfo_index_columns, 'key': 'subject',    'delimiter': ',',  'skip_rows': 0},
+               'nda':    {'columns': NDA_index_columns,    'key': 'subjectkey', 'delimiter': '\t', 'skip_rows': 1}}
+
+csv.field_size_limit( 2**30 )
+
+Preloaded = {}    # Source file name -> Preloaded_Index, filled by Index_Preload
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Build the lookup index of a pcinfo table or of a downloaded NDA image03 package')
+    print()
+    print('Usage:')
+    print('  ./lookup_index.py  pcinfo  [PCInfoFile]')
+    print('  ./lookup_index.py  nda     Image03File')
+    print('  ./lookup_index.py  refresh Image03File      (apply only what changed in Image03File to its index)')
+    print()
+    print('PCInfoFile defaults to PCInfo_fname in share_config.json. The index is written to <file>.index.sqlite, next to the file')
+    print('or in Index_dir (share_config.json), and is used by the share scripts while it matches its source file.')
+    print()
+    print('Examples:')
+    print('  ./lookup_index.py  pcinfo')
+    print('  ./lookup_index.py  nda  /home/oruiz/ABCD_Inventory/NDA_downloaded_packages/image03.txt')
+    print('  ./lookup_index.py  refresh  /home/oruiz/ABCD_Inventory/NDA_downloaded_packages/image03.txt')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Index_fname_get( source_fname ):
+    index_dir = Share_Config_Get().get('Index_dir', '')
+    if index_dir:
+        return os.path.join( index_dir, os.path.basename(source_fname) + '.index.sqlite' )
+    return source_fname + '.index.sqlite'
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Subject_from_pGUID( pGUID ):
+    # NDAR_INV028D3ELL -> INV028D3ELL, as run_mproc_share.sh does
+    return pGUID.split('_')[-1]
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Rows_read( source_fname, kind ):
+    # Values of the index columns of each row of source_fname, followed by the key of the row (subject, or image file
+    # basename) and, for nda, the hash of the whole row
+    spec = Index_kinds[kind]
+    cols = spec['columns']
+    with open(source_fname, 'r', newline='') as f:
+        reader = csv.reader( f, delimiter=spec['delimiter'] )
+        header = next( reader )
+        for k in range( spec['skip_rows'] ):
+            next( reader )
+        pos = [ header.index(c) for c in cols ]
+
+        for line in reader:
+            if len(line) < len(header):
+                line = line + ['']*(len(header) - len(line))
+            values = [ line[p] for p in pos ]
+            if kind == 'pcinfo':
+                values.append( Subject_from_pGUID(values[0]) )
+            else:
+                values.append( os.path.basename(values[ cols.index('image_file') ]) )
+                values.append( Row_hash( line ) )
+            yield values
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Row_hash( line ):
+    return int.from_bytes( hashlib.blake2b( '\x1f'.join(line).encode(), digest_size=8 ).digest(), 'big', signed=True )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Meta_Update( conn, st ):
+    # Size and modification time of the source (st: its os.stat before it was read)
+    conn.execute( 'UPDATE meta SET size = ?, mtime_ns = ?, built = ?', (st.st_size, st.st_mtime_ns, time.strftime('%Y-%m-%d %H:%M:%S')) )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Index_Build( source_fname, kind ):
+    # Returns the index file name
+    spec = Index_kinds[kind]
+    cols = spec['columns']
+    index_fname = Index_fname_get( source_fname )
+    tmp_fname   = '%s.%d.tmp' % (index_fname, os.getpid())
+    st = os.stat( source_fname )
+
+    conn = sqlite3.connect( tmp_fname )
+    conn.execute( 'PRAGMA journal_mode=OFF' )
+    conn.execute( 'PRAGMA synchronous=OFF' )
+    conn.execute( 'CREATE TABLE meta (source TEXT, kind TEXT, size INTEGER, mtime_ns INTEGER, built TEXT)' )
+    conn.execute( 'INSERT INTO meta (source, kind) VALUES (?,?)', (os.path.abspath(source_fname), kind) )
+    Meta_Update( conn, st )
+    extra = ['subject TEXT'] if kind == 'pcinfo' else ['image_basename TEXT', 'row_hash INTEGER']
+    conn.execute( 'CREATE TABLE rows (%s)' % ', '.join( ["'%s' %s" % (c, Column_types.get(c, 'TEXT')) for c in cols] + extra ) )
+
+    conn.executemany( 'INSERT INTO rows VALUES (%s)' % ','.join(['?']*(len(cols)+len(extra))), Rows_read( source_fname, kind ) )
+
+    conn.execute( 'CREATE INDEX rows_key ON rows (%s)' % spec['key'] )
+    if kind == 'nda':
+        conn.execute( 'CREATE INDEX rows_id ON rows (image03_id)' )
+    conn.commit()
+    conn.close()
+
+    os.replace( tmp_fname, index_fname )
+    return index_fname
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Id_key( value ):
+    # image03_id as the index stores it (INTEGER affinity)
+    value = value.strip()  if isinstance( value, str )  else value
+    return int( value )  if isinstance( value, str ) and value.isdigit()  else value
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Index_Refresh( source_fname ):
+    # Bring the nda index of source_fname up to date with only the rows that changed. Returns (index file name,
+    # {'new', 'changed', 'removed', 'unchanged'} row counts), or (index file name, None) if the index was built again.
+    cols = NDA_index_columns
+    index_fname = Index_fname_get( source_fname )
+    id_pos = cols.index('image03_id')
+    st = os.stat( source_fname )
+
+    old = {}
+    try:
+        conn = sqlite3.connect( 'file:%s?mode=ro' % index_fname, uri=True )
+        kind = conn.execute( 'SELECT kind FROM meta' ).fetchone()[0]
+        for image03_id, row_hash, rowid in conn.execute( 'SELECT image03_id, row_hash, rowid FROM rows' ):
+            if image03_id in old:
+                raise ValueError('image03_id %s is not unique' % image03_id)
+            old[ image03_id ] = (row_hash, rowid)
+        conn.close()
+        if kind != 'nda':
+            raise ValueError('not an nda index')
+    except (sqlite3.Error, TypeError, ValueError) as err:
+        print('Building the index again (%s)' % err )
+        return Index_Build( source_fname, 'nda' ), None
+
+    new     = []
+    changed = []
+    seen    = set()
+    for values in Rows_read( source_fname, 'nda' ):
+        image03_id = Id_key( values[id_pos] )
+        if image03_id in seen:
+            print('Building the index again (image03_id %s is not unique in %s)' % (image03_id, source_fname) )
+            return Index_Build( source_fname, 'nda' ), None
+        seen.add( image03_id )
+        if image03_id not in old:
+            new.append( values )
+        elif old[image03_id][0] != values[-1]:
+            changed.append( values + [old[image03_id][1]] )
+    removed = [ (rowid,)  for image03_id, (row_hash, rowid) in old.items()  if image03_id not in seen ]
+
+    # Apply the delta to a copy, and rename it into place
+    tmp_fname = '%s.%d.tmp' % (index_fname, os.getpid())
+    shutil.copyfile( index_fname, tmp_fname )
+    conn = sqlite3.connect( tmp_fname )
+    conn.execute( 'PRAGMA journal_mode=OFF' )
+    conn.execute( 'PRAGMA synchronous=OFF' )
+    names = ', '.join( "'%s'" % c  for c in cols + ['image_basename', 'row_hash'] )
+    conn.executemany( 'DELETE FROM rows WHERE rowid = ?', removed )
+    conn.executemany( 'UPDATE rows SET (%s) = (%s) WHERE rowid = ?' % (names, ','.join(['?']*(len(cols)+2))), changed )
+    conn.executemany( 'INSERT INTO rows (%s) VALUES (%s)' % (names, ','.join(['?']*(len(cols)+2))), new )
+    Meta_Update( conn, st )
+    conn.commit()
+    conn.close()
+
+    os.replace( tmp_fname, index_fname )
+    return index_fname, {'new': len(new), 'changed': len(changed), 'removed': len(removed), 'unchanged': len(seen) - len(new) - len(changed)}
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Index_Open( source_fname ):
+    # Read-only connection to the index of source_fname, or None if there is none or it does not match the source.
+    # An index preloaded by this process (Index_Preload) is returned instead of a connection
+    if source_fname in Preloaded:
+        return Preloaded[ source_fname ]
+
+    index_fname = Index_fname_get( source_fname )
+    if not os.path.isfile( index_fname ):
+        return None
+    try:
+        conn = sqlite3.connect( 'file:%s?mode=ro' % index_fname, uri=True )
+        size, mtime_ns = conn.execute( 'SELECT size, mtime_ns FROM meta' ).fetchone()
+        st = os.stat( source_fname )
+    except (sqlite3.Error, OSError, TypeError):
+        return None
+    if (size, mtime_ns) != (st.st_size, st.st_mtime_ns):
+        print('Warning: lookup index %s is out of date; reading %s' % (index_fname, source_fname) )
+        conn.close()
+        return None
+    return conn
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+class Preloaded_Index:
+    # All rows of an index in memory, by key; used like a connection by the lookups below.
+    # Loaded in a parent process before forking workers, whose lookups then share its pages copy-on-write.
+    def __init__( self, conn ):
+        self.kind = conn.execute( 'SELECT kind FROM meta' ).fetchone()[0]
+        spec = Index_kinds[ self.kind ]
+        self.rows = {}
+        for r in conn.execute( 'SELECT %s, %s FROM rows ORDER BY rowid' % (spec['key'], ','.join(spec['columns'])) ):
+            self.rows.setdefault( r[0], [] ).append( r[1:] )
+
+    def close( self ):
+        pass
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Index_Preload( source_fname ):
+    # Load the index of source_fname in memory; returns the number of keys, or 0 if there is no current index
+    conn = Index_Open( source_fname )
+    if conn is None:
+        return 0
+    if not isinstance( conn, Preloaded_Index ):
+        Preloaded[ source_fname ] = Preloaded_Index( conn )
+        conn.close()
+    return len( Preloaded[ source_fname ].rows )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def PCInfo_Index_Lookup( conn, subj ):
+    # pcinfo rows of participant subj (without NDAR_ prefix), as lists in PCInfo_index_columns order
+    if isinstance( conn, Preloaded_Index ):
+        return [ list(r)  for r in conn.rows.get( subj, [] ) ]
+    return [ list(r) for r in conn.execute( 'SELECT %s FROM rows WHERE subject = ? ORDER BY rowid'
+                                            % ','.join(PCInfo_index_columns), (subj,) ) ]
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def NDA_Index_Lookup( conn, subjectkey ):
+    # image03 rows of subjectkey (NDAR_INV...), in package order, as dictionaries
+    if isinstance( conn, Preloaded_Index ):
+        return [ dict(zip(NDA_index_columns, r))  for r in conn.rows.get( subjectkey, [] ) ]
+    return [ dict(zip(NDA_index_columns, r)) for r in conn.execute( 'SELECT %s FROM rows WHERE subjectkey = ? ORDER BY rowid'
+                                                                     % ','.join(NDA_index_columns), (subjectkey,) ) ]
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2 or sys.argv[1] not in list(Index_kinds) + ['refresh'] or (sys.argv[1] in ['nda', 'refresh'] and len(sys.argv) != 3):
+        program_description()
+        sys.exit()
+
+    if sys.argv[1] == 'refresh':
+        start_time = time.time()
+        index_fname, counts = Index_Refresh( sys.argv[2] )
+        if counts is not None:
+            print('Index %s refreshed in %.1f s:  %d rows new,  %d changed,  %d removed,  %d unchanged'
+                  % (index_fname, time.time() - start_time, counts['new'], counts['changed'], counts['removed'], counts['unchanged']) )
+        else:
+            print('Index of %s written to %s in %.1f s' % (sys.argv[2], index_fname, time.time() - start_time) )
+        sys.exit()
+
+    kind = sys.argv[1]
+    if len(sys.argv) == 3:
+        source_fname = sys.argv[2]
+    else:
+        source_fname = Share_Config_Get()['PCInfo_fname']
+
+    start_time = time.time()
+    index_fname = Index_Build( source_fname, kind )
+    print('Index of %s written to %s in %.1f s' % (source_fname, index_fname, time.time() - start_time) )
+# ========================================================================================================================================================
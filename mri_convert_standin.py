@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import sys, gzip, struct
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Stand-in for FreeSurfer's mri_convert, for load tests on hosts without FreeSurfer (set "mri_convert_cmd" in share_config.json).
+# Accepts the arguments used by share_min_proc_fMRI_dMRI_BOLD_T1T2.py:
+#   mri_convert_standin.py  -i In  -o Out  -tr TR  -te TE  [-TI TI]  -flip_angle FA
+# If In is a NIfTI-1 file (plain or gzipped; synthetic_dataset_create.py writes those, also under .mgz names), Out receives
+# the same image with the repetition time set to TR (ms -> s, pixdim[4]), as mri_convert does; any other input is copied.
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def args_get( argv ):
+    args = {}
+    j = 1
+    while j < len(argv) - 1:
+        if argv[j].startswith('-'):
+            args[ argv[j].lstrip('-') ] = argv[j+1]
+            j += 2
+        else:
+            j += 1
+    return args
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    args = args_get( sys.argv )
+    if 'i' not in args or 'o' not in args:
+        print('Usage:  mri_convert_standin.py  -i In  -o Out  [-tr TR]  [-te TE]  [-TI TI]  [-flip_angle FA]')
+        sys.exit(1)
+
+    print('mri_convert (stand-in): reading from', args['i'] )
+    try:
+        with open(args['i'], 'rb') as f:
+            data = f.read()
+    except (IOError, OSError) as err:
+        print('ERROR:', err )
+        sys.exit(1)
+
+    if data[0:2] == b'\x1f\x8b':
+        data = gzip.decompress( data )
+
+    if len(data) >= 348 and struct.unpack('<i', data[0:4])[0] == 348 and data[344:347] == b'n+1':
+        data = bytearray( data )
+        if 'tr' in args:
+            data[92:96] = struct.pack( '<f', float(args['tr']) / 1000 )
+            data[123] = (data[123] & 0xC7) | 8                  # time units: seconds
+        data = bytes( data )
+
+    if args['o'].endswith('.gz'):
+        data = gzip.compress( data, 1 )
+
+    print('mri_convert (stand-in): writing to', args['o'] )
+    with open(args['o'], 'wb') as f:
+        f.write( data )
+# ---------------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import sys, os, time, sqlite3, atexit
+
+from share_config import Share_Config_Get, Host_db_fname_get
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Limits shared by all sharing processes of a host (a sqlite file, "Limits_db_fname", under "Scratch_root" unless the name is
+# absolute), so that concurrent workers neither saturate the uplink nor trigger NDA's API throttling:
+#
+#   s3_admit_bytes  Token bucket in bytes/s admitting AWS-s3 uploads ("S3_admit_bytes_per_s")
+#   minda_requests  Token bucket in requests/s for miNDA imports ("miNDA_requests_per_s")
+#   minda           Most miNDA imports in flight at once ("miNDA_max_concurrent")
+#
+# A limit of 0 means no limit. s3_admit_bytes is admission control, not a bandwidth limit: the aws CLI sends an archive
+# whole, at full link speed, so the bucket lets an upload start once it holds a burst's worth of tokens (Burst_s seconds of
+# rate, or the whole upload if smaller), and takes all of its bytes, possibly going negative. Later uploads wait until the
+# debt is repaid, so the average rate over many uploads is kept, but not the rate of an upload in flight.
+#
+# Limits are read from share_config.json, and can be changed while a batch runs:  ./rate_limit.py --set s3_admit_bytes=50e6
+# (stored in the database, and taken by every waiting process within a second). Time spent waiting on each limiter is
+# accumulated in table waits and shown by  ./rate_limit.py
+#
+# A limiter that has no limit (0 in the configuration, and none set at runtime) is not taken at all: the check reads the
+# database without locking it, so workers are not serialized on its write lock, and its uses are not counted in waits.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Limiters = {'s3_admit_bytes': 'S3_admit_bytes_per_s',
+            'minda_requests': 'miNDA_requests_per_s',
+            'minda':          'miNDA_max_concurrent'}
+
+Burst_s = 1.0
+
+Poll_max = 1.0         # s; longest sleep between attempts, so runtime changes of limits are noticed
+
+Slots = {}             # Concurrency slots held by this process: id -> name
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Limits_db_Open():
+    conn = sqlite3.connect( Host_db_fname_get('Limits_db_fname'), timeout=60, isolation_level=None )
+    conn.execute( 'CREATE TABLE IF NOT EXISTS limits  (name TEXT PRIMARY KEY, value REAL)' )
+    conn.execute( 'CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL)' )
+    conn.execute( 'CREATE TABLE IF NOT EXISTS slots   (id INTEGER PRIMARY KEY, name TEXT, pid INTEGER, started REAL)' )
+    conn.execute( 'CREATE TABLE IF NOT EXISTS waits   (name TEXT PRIMARY KEY, acquisitions INTEGER, units REAL, waited INTEGER, wait_s REAL)' )
+    return conn
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Limit_get( conn, name ):
+    # Limit in effect: set at runtime (table limits), or from the configuration
+    row = conn.execute( 'SELECT value FROM limits WHERE name = ?', (name,) ).fetchone()
+    if row:
+        return float( row[0] )
+    return float( Share_Config_Get().get( Limiters[name], 0 ) or 0 )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Unlimited( name ):
+    # True if name has no limit in the configuration nor at runtime; read only, so it takes no lock
+    if float( Share_Config_Get().get( Limiters[name], 0 ) or 0 ) > 0:
+        return False
+    fname = Host_db_fname_get('Limits_db_fname')
+    if not os.path.isfile( fname ):
+        return True
+    try:
+        conn = sqlite3.connect( 'file:%s?mode=ro' % os.path.abspath(fname), uri=True, timeout=60 )
+        try:
+            row = conn.execute( 'SELECT value FROM limits WHERE name = ?', (name,) ).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False    # Let Acquire open (and create) the database and read the limit there
+    return row is None or float( row[0] ) <= 0
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Wait_Record( conn, name, units, wait_s ):
+    conn.execute( 'INSERT OR IGNORE INTO waits VALUES (?, 0, 0, 0, 0)', (name,) )
+    conn.execute( 'UPDATE waits SET acquisitions = acquisitions + 1, units = units + ?, waited = waited + ?, wait_s = wait_s + ? WHERE name = ?',
+                  (units, 1 if wait_s > 0 else 0, wait_s, name) )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Acquire( name, units=1 ):
+    # Take units from the token bucket of name, waiting for them; returns the time waited (s)
+    if Unlimited( name ):
+        return 0.0
+    t0 = time.time()
+    slept = False
+    while True:
+        conn = Limits_db_Open()
+        try:
+            conn.execute( 'BEGIN IMMEDIATE' )
+            rate = Limit_get( conn, name )
+            now  = time.time()
+            if rate <= 0:
+                wait = 0
+            else:
+                burst = rate * Burst_s
+                row = conn.execute( 'SELECT tokens, updated FROM buckets WHERE name = ?', (name,) ).fetchone()
+                tokens = burst  if row is None  else min( burst, row[0] + (now - row[1]) * rate )
+                need = min( units, burst )
+                wait = 0  if tokens >= need  else (need - tokens) / rate
+                conn.execute( 'INSERT OR REPLACE INTO buckets VALUES (?,?,?)', (name, tokens - units if not wait else tokens, now) )
+            if not wait:
+                Wait_Record( conn, name, units, now - t0  if slept  else 0.0 )
+            conn.execute( 'COMMIT' )
+        finally:
+            conn.close()
+
+        if not wait:
+            return now - t0  if slept  else 0.0
+        time.sleep( min( wait, Poll_max ) )
+        slept = True
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def pid_alive( pid ):
+    try:
+        os.kill( pid, 0 )
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Slot_Acquire( name ):
+    # One of the concurrency slots of name, waiting for one; returns (slot id, time waited). Slot id 0: no limit.
+    if Unlimited( name ):
+        return 0, 0.0
+    t0 = time.time()
+    slept = False
+    while True:
+        conn = Limits_db_Open()
+        try:
+            conn.execute( 'BEGIN IMMEDIATE' )
+            limit = int( Limit_get( conn, name ) )
+            rid = 0
+            if limit > 0:
+                dead = [ (sid,)  for sid, pid in conn.execute('SELECT id, pid FROM slots WHERE name = ?', (name,))  if not pid_alive(pid) ]
+                conn.executemany( 'DELETE FROM slots WHERE id = ?', dead )
+                used = conn.execute( 'SELECT COUNT(*) FROM slots WHERE name = ?', (name,) ).fetchone()[0]
+                if used < limit:
+                    rid = conn.execute( 'INSERT INTO slots (name, pid, started) VALUES (?,?,?)', (name, os.getpid(), time.time()) ).lastrowid
+            waited = time.time() - t0  if slept  else 0.0
+            if limit <= 0 or rid:
+                Wait_Record( conn, name, 1, waited )
+            conn.execute( 'COMMIT' )
+        finally:
+            conn.close()
+
+        if limit <= 0 or rid:
+            if rid:
+                Slots[ rid ] = name
+            return rid, waited
+        time.sleep( Poll_max / 4 )
+        slept = True
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Slot_Release( rid ):
+    if not rid or rid not in Slots:
+        return
+    try:
+        conn = Limits_db_Open()
+        conn.execute( 'DELETE FROM slots WHERE id = ?', (rid,) )
+        conn.close()
+    except sqlite3.Error as err:
+        print('Warning: unable to release %s slot: %s' % (Slots[rid], err) )
+    del Slots[ rid ]
+
+atexit.register( lambda: [ Slot_Release(rid)  for rid in list(Slots) ] )
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    # Show limits and waits;  --set name=value  changes a limit for all running processes,  --reset name  returns it to
+    # the configuration value,  --clear-waits  restarts the wait counters
+    conn = Limits_db_Open()
+    args = sys.argv[1:]
+    while args:
+        opt = args.pop(0)
+        if opt == '--set' and args:
+            name, _, value = args.pop(0).partition('=')
+            if name not in Limiters:
+                print('Error: limiter must be one of', list(Limiters) )
+                sys.exit(1)
+            conn.execute( 'INSERT OR REPLACE INTO limits VALUES (?,?)', (name, float(value)) )
+        elif opt == '--reset' and args:
+            conn.execute( 'DELETE FROM limits WHERE name = ?', (args.pop(0),) )
+        elif opt == '--clear-waits':
+            conn.execute( 'DELETE FROM waits' )
+        else:
+            print('Usage:  ./rate_limit.py  [--set Limiter=Value]  [--reset Limiter]  [--clear-waits]     Limiters:', ', '.join(Limiters) )
+            sys.exit()
+
+    waits = dict( (r[0], r[1:])  for r in conn.execute( 'SELECT * FROM waits' ) )
+    print('%-16s %14s %8s %12s %14s %8s %10s' % ('limiter', 'limit', 'source', 'acquisitions', 'units', 'waited', 'wait_s') )
+    for name in Limiters:
+        source = 'runtime'  if conn.execute( 'SELECT 1 FROM limits WHERE name = ?', (name,) ).fetchone()  else 'config'
+        acquisitions, units, waited, wait_s = waits.get( name, (0, 0, 0, 0.0) )
+        print('%-16s %14g %8s %12d %14g %8d %10.1f' % (name, Limit_get(conn, name), source, acquisitions, units, waited, wait_s) )
+    conn.close()
+# ========================================================================================================================================================
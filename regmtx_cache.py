@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import sys, os, json, sqlite3
+
+from share_config import Share_Config_Get
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Registration matrices (RegInfo.M_T1_to_T2 of the *_regT1.mat files of DTI and BOLD containers), read once and kept by
+# file path, size and modification time:
+#   - in memory, for all runs and stages of a process (discovery of DTI runs, packaging of BOLD runs),
+#   - and in a sqlite file shared by all processes and invocations ("RegMtx_cache_fname" in share_config.json;
+#     empty to keep the matrices in memory only), so each file is parsed once per release.
+# A file that changes (new size or modification time) is read again.
+# ---------------------------------------------------------------------------------------------------------------------------------
+RegMtx_memo = {}      # (path, size, mtime_ns) -> matrix (list of rows)
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def RegMtx_Cache_Open():
+    # Connection to the persistent cache, or None if it is disabled or unusable
+    fname = Share_Config_Get().get('RegMtx_cache_fname', '')
+    if not fname:
+        return None
+    try:
+        conn = sqlite3.connect( fname, timeout=30 )
+        conn.execute( 'CREATE TABLE IF NOT EXISTS regmtx (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, matrix TEXT)' )
+        return conn
+    except sqlite3.Error as err:
+        print('Warning: unable to use registration-matrix cache %s: %s' % (fname, err) )
+        return None
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def RegMtx_read( fname ):
+    # RegInfo.M_T1_to_T2 from a .mat file, as a list of rows
+    from scipy.io import loadmat
+    data = loadmat( fname, squeeze_me=True, struct_as_record=True, variable_names=['RegInfo'] )
+    return data['RegInfo']['M_T1_to_T2'].item().tolist()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def RegMtx_get( fname ):
+    # Registration matrix of fname (list of rows), or None if the file cannot be read
+    path = os.path.abspath( fname )
+    try:
+        st = os.stat( path )
+    except OSError:
+        return None
+    key = (path, st.st_size, st.st_mtime_ns)
+
+    if key in RegMtx_memo:
+        return RegMtx_memo[key]
+
+    conn = RegMtx_Cache_Open()
+    if conn:
+        try:
+            row = conn.execute( 'SELECT matrix FROM regmtx WHERE path = ? AND size = ? AND mtime_ns = ?', key ).fetchone()
+        except sqlite3.Error:
+            row = None
+        if row:
+            RegMtx_memo[key] = json.loads( row[0] )
+            conn.close()
+            return RegMtx_memo[key]
+
+    try:
+        matrix = RegMtx_read( path )
+    except Exception:
+        if conn:
+            conn.close()
+        return None
+
+    RegMtx_memo[key] = matrix
+    if conn:
+        try:
+            with conn:
+                conn.execute( 'INSERT OR REPLACE INTO regmtx VALUES (?,?,?,?)', key + (json.dumps(matrix),) )
+        except sqlite3.Error as err:
+            print('Warning: unable to store registration matrix in cache:', err )
+        conn.close()
+    return matrix
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    # Show (and cache) the registration matrix of the given files
+    if len(sys.argv) < 2:
+        print('Usage:  ./regmtx_cache.py  RegFile.mat  [RegFile2.mat ...]')
+        sys.exit()
+
+    for fname in sys.argv[1:]:
+        print( fname, json.dumps( RegMtx_get( fname ) ) )
+# ========================================================================================================================================================
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+import sys, os, getopt, json, tarfile, hashlib
+
+from synthetic_dataset_create import Synthetic_Dataset_Create
+from load_test import Load_Test, Converter
+from bids_archive_check import NIfTI_header_read
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Performance-regression and output-equivalence check for the share path.
+#
+# Runs a fixed synthetic campaign (same seed, participants, sites and modalities every time) through the whole pipeline against
+# the local miNDA and S3 stand-ins, then compares with a golden directory created earlier with --update:
+#   - archive member lists (names, in order, and sizes of all members but the image),
+#   - sidecar contents (.json parsed and compared exactly; .tsv, .bval, .bvec by SHA-256),
+#   - NIfTI header fields of the image (dim, datatype, bitpix, pixdim including TR, vox_offset, units),
+#   - miNDA fmriresults01 packages, per derived_files,
+#   - throughput and per-stage mean time, against the stored baselines; slower by more than the threshold is a failure.
+# Exit status is 0 when everything matches, 1 otherwise.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Campaign = {'subjects':    8,
+            'sites':       ['chla', 'yale'],
+            'seed':        2018,
+            'image_bytes': 65536,
+            'modalities':  ['T1', 'T2', 'dMRI', 'fMRI_MID_task', 'fMRI_SST_task', 'fMRI_nBack_task', 'rsfMRI']}
+
+Stage_time_min_s = 0.05      # Stages faster than this in the baseline are too noisy to compare
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Run a fixed synthetic sharing campaign and compare archives, sidecars, NIfTI headers, miNDA packages and timings')
+    print('against golden outputs and stored baselines')
+    print()
+    print('Usage:')
+    print('  ./regression_check.py  --golden GoldenDir  --work Work  [--update]  [--threshold T]  [--workers N]  [--mri-convert Cmd]  [--aws Cmd]')
+    print()
+    print('where:')
+    print('  GoldenDir  Directory with golden_outputs.json and baseline_timings.json')
+    print('  Work       Empty working directory for the synthetic data set and the campaign')
+    print('  --update   Record the current outputs and timings as golden, instead of comparing')
+    print('  T          Allowed slow-down before failing, as a fraction (default 0.2, i.e. 20%)')
+    print('  N          Concurrent share processes (default 2)')
+    print()
+    print('Example:')
+    print('  ./regression_check.py  --golden regression_golden  --work /scratch/reg_$$  --update')
+    print('  ./regression_check.py  --golden regression_golden  --work /scratch/reg_$$')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def command_line_get_variables():
+    o = {'golden': '', 'work': '', 'update': False, 'threshold': 0.2, 'workers': 2, 'mri_convert': Converter, 'aws': 'aws'}
+    try:
+        opts,args = getopt.getopt(sys.argv[1:], "hg:w:ut:n:c:a:", ["golden=", "work=", "update", "threshold=", "workers=", "mri-convert=", "aws="])
+    except getopt.GetoptError as err:
+        print("Error parsing arguments: %s" % str(err))
+        program_description()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            program_description()
+            sys.exit()
+        elif opt in ("-g", "--golden"):      o['golden'] = os.path.abspath(arg)
+        elif opt in ("-w", "--work"):        o['work'] = os.path.abspath(arg)
+        elif opt in ("-u", "--update"):      o['update'] = True
+        elif opt in ("-t", "--threshold"):   o['threshold'] = float(arg)
+        elif opt in ("-n", "--workers"):     o['workers'] = int(arg)
+        elif opt in ("-c", "--mri-convert"): o['mri_convert'] = arg
+        elif opt in ("-a", "--aws"):         o['aws'] = arg
+
+    if not o['golden'] or not o['work']:
+        program_description()
+        sys.exit()
+
+    return o
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+#                                                       Output collection
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Archive_Contents_get( tgz ):
+    contents = {'members': [], 'json': {}, 'sha256': {}, 'nifti': {}}
+    with tarfile.open( tgz, 'r:gz' ) as tar:
+        for m in tar:
+            if m.name.endswith('.nii'):
+                contents['members'].append( [m.name, None] )        # Image size depends on the converter
+                contents['nifti'][m.name] = NIfTI_header_read( tar.extractfile(m) )
+                continue
+            contents['members'].append( [m.name, m.size] )
+            data = tar.extractfile(m).read()
+            if m.name.endswith('.json'):
+                contents['json'][m.name] = json.loads( data.decode('utf8') )
+            else:
+                contents['sha256'][m.name] = hashlib.sha256( data ).hexdigest()
+    return contents
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Outputs_Collect( work ):
+    outputs = {'archives': {}, 'minda_packages': {}}
+
+    mproc = work + '/mproc'
+    for site in sorted( os.listdir(mproc) if os.path.isdir(mproc) else [] ):
+        for fname in sorted( os.listdir(mproc + '/' + site) ):
+            if fname.endswith('.tgz'):
+                outputs['archives'][site + '/' + fname] = Archive_Contents_get( mproc + '/' + site + '/' + fname )
+
+    packages_fname = work + '/standin/minda_packages.jsonl'
+    if os.path.isfile( packages_fname ):
+        with open(packages_fname, 'r') as f:
+            for line in f:
+                package = json.loads( line )
+                for row in package['dataStructureRows']:
+                    elements = { e['name']: e['value']  for e in row['dataElement'] }
+                    outputs['minda_packages'][ elements.get('derived_files', '') ] = {'schemaName': package.get('schemaName'),
+                                                                                     'shortName':  row.get('shortName'),
+                                                                                     'elements':   elements}
+    return outputs
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+#                                                           Comparisons
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Outputs_Compare( golden, current ):
+    diffs = []
+    for kind in ['archives', 'minda_packages']:
+        g = golden.get( kind, {} )
+        c = current.get( kind, {} )
+        for name in sorted( set(g) - set(c) ):
+            diffs.append( '%s: missing: %s' % (kind, name) )
+        for name in sorted( set(c) - set(g) ):
+            diffs.append( '%s: unexpected: %s' % (kind, name) )
+        for name in sorted( set(g) & set(c) ):
+            if kind == 'archives':
+                for part in ['members', 'json', 'sha256', 'nifti']:
+                    if g[name][part] != c[name][part]:
+                        diffs.append( '%s: %s: %s differ:\n      golden:  %s\n      current: %s' % (kind, name, part,
+                                      json.dumps(g[name][part], sort_keys=True), json.dumps(c[name][part], sort_keys=True)) )
+            else:
+                if g[name] != c[name]:
+                    keys = sorted( k for k in set(g[name]['elements']) | set(c[name]['elements'])
+                                   if g[name]['elements'].get(k) != c[name]['elements'].get(k) )
+                    diffs.append( '%s: %s: fields differ: %s' % (kind, name, ', '.join(keys) or 'schemaName/shortName') )
+    return diffs
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Timings_get( report ):
+    return {'runs_per_hour': report['runs_per_hour'],
+            'MB_per_s':      report['MB_per_s'],
+            'stage_mean_s':  { k: v['mean']  for k, v in report['stage_latency_s'].items() } }
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Timings_Compare( baseline, current, threshold ):
+    regressions = []
+    if current['runs_per_hour'] < baseline['runs_per_hour'] * (1 - threshold):
+        regressions.append( 'throughput: %.1f runs/hour, baseline %.1f' % (current['runs_per_hour'], baseline['runs_per_hour']) )
+
+    for stage, t_base in sorted( baseline['stage_mean_s'].items() ):
+        t = current['stage_mean_s'].get( stage )
+        if t is None or t_base < Stage_time_min_s:
+            continue
+        if t > t_base * (1 + threshold):
+            regressions.append( 'stage %s: %.3f s, baseline %.3f s (+%.0f%%)' % (stage, t, t_base, 100*(t/t_base - 1)) )
+    return regressions
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Regression_Campaign_Run( work, workers, mri_convert, aws ):
+    root = work + '/synthetic'
+    Synthetic_Dataset_Create( root, Campaign['subjects'] * len(Campaign['sites']), Campaign['sites'], Campaign['seed'],
+                              Campaign['image_bytes'], verbose=False )
+
+    report, results = Load_Test( {'root': root, 'work': work + '/campaign', 'sites': Campaign['sites'], 'modalities': Campaign['modalities'],
+                                  'workers': workers, 'subjects': 0, 'latency': 0.0, 'error_rate': 0.0, 's3_error_rate': 0.0,
+                                  'tls': False, 'mri_convert': mri_convert, 'aws': aws} )
+    return report, Outputs_Collect( work + '/campaign' )
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    o = command_line_get_variables()
+
+    if os.path.isdir(o['work']) and os.listdir(o['work']):
+        print('Error: working directory must be empty:', o['work'] )
+        sys.exit(1)
+
+    print('Running regression campaign:', json.dumps(Campaign) )
+    report, outputs = Regression_Campaign_Run( o['work'], o['workers'], o['mri_convert'], o['aws'] )
+    timings = Timings_get( report )
+
+    golden_outputs_fname  = o['golden'] + '/golden_outputs.json'
+    golden_timings_fname  = o['golden'] + '/baseline_timings.json'
+
+    if o['update']:
+        os.makedirs( o['golden'], exist_ok=True )
+        with open(golden_outputs_fname, 'w') as f:
+            json.dump( outputs, f, sort_keys=True, indent=1 )
+        with open(golden_timings_fname, 'w') as f:
+            json.dump( timings, f, sort_keys=True, indent=1 )
+        print('Recorded %d archives and %d miNDA packages as golden, and baseline timings (%.1f runs/hour), in %s'
+              % (len(outputs['archives']), len(outputs['minda_packages']), timings['runs_per_hour'], o['golden']) )
+        sys.exit(0)
+
+    with open(golden_outputs_fname, 'r') as f:
+        golden = json.load(f)
+    with open(golden_timings_fname, 'r') as f:
+        baseline = json.load(f)
+
+    diffs       = Outputs_Compare( golden, outputs )
+    regressions = Timings_Compare( baseline, timings, o['threshold'] )
+
+    print()
+    print('Archives: %d (golden %d);  miNDA packages: %d (golden %d)' % (len(outputs['archives']), len(golden['archives']),
+                                                                       len(outputs['minda_packages']), len(golden['minda_packages'])) )
+    print('Throughput: %.1f runs/hour (baseline %.1f)' % (timings['runs_per_hour'], baseline['runs_per_hour']) )
+    for d in diffs:
+        print('DIFFERENCE:', d )
+    for r in regressions:
+        print('REGRESSION:', r )
+
+    if diffs or regressions:
+        print('\nFAILED: %d output differences, %d timing regressions' % (len(diffs), len(regressions)) )
+        sys.exit(1)
+
+    print('\nPASSED')
+# ========================================================================================================================================================
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+import sys, os, time, socket
+import resource
+import sqlite3
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Per-stage resource accounting for the sharing pipeline.
+#
+# Each stage (subject info, discovery, NDA lookup, NIfTI conversion, BIDS archive, miNDA upload, AWS-s3 upload, local record)
+# is wrapped between Stage_Start() and Stage_End(), or used as   with Stage_Usage('stage', bids_run):   and the following is
+# recorded for it:
+#   wall_s                    Elapsed time
+#   user_s, sys_s             CPU time of this process
+#   maxrss_kb                 Peak resident set size during the stage (VmHWM, reset at stage start when the kernel allows it;
+#                             otherwise the process high-water mark up to the end of the stage)
+#   child_user_s, child_sys_s CPU time of child processes reaped during the stage (mri_convert, aws)
+#   child_maxrss_kb           Largest child resident set size seen so far (getrusage RUSAGE_CHILDREN)
+#   read_bytes, write_bytes   Storage I/O from /proc/self/io, which includes reaped children
+#   rchar, wchar              Bytes passed through read/write system calls (includes NFS and pipes)
+#
+# Records are stored in the table  stage_usage  of metadata.sqlite, next to fmriresults01, one row per stage and run.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Stage_table = 'stage_usage'
+
+Stage_columns = ['batch_id', 'host', 'pid', 'subject', 'modality', 'bids_run', 'stage', 'status', 'start_time',
+                 'wall_s', 'user_s', 'sys_s', 'maxrss_kb', 'child_user_s', 'child_sys_s', 'child_maxrss_kb',
+                 'read_bytes', 'write_bytes', 'rchar', 'wchar']
+
+Stage_labels  = {'batch_id': '', 'host': '', 'pid': 0, 'subject': '', 'modality': ''}
+Stage_records = []       # Finished stages not yet stored
+Stage_current = {'stage': '', 'bids_run': ''}   # Stage in progress, for the records of share_log.py
+Stage_dbdir   = ''       # Directory containing metadata.sqlite; set by Stage_Usage_Init
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Summarize per-stage resource usage recorded by share_min_proc_fMRI_dMRI_BOLD_T1T2.py in metadata.sqlite,')
+    print('per modality and stage: runs, wall time, CPU, peak RSS of this process and of its children, and I/O bytes.')
+    print('Use it to decide how many sharing workers fit on a host.')
+    print()
+    print('Usage:')
+    print('  ./resource_usage.py  metadata.sqlite')
+    print()
+    print('Example:')
+    print('  ./resource_usage.py  /mproc/chla/metadata.sqlite')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def proc_io_read():
+    # Read /proc/self/io; returns an empty dictionary where it is not available (non-Linux, restricted /proc)
+    io_counts = {}
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                name, value = line.split(':')
+                io_counts[name.strip()] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return io_counts
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def peak_rss_reset():
+    # Reset the kernel's peak-RSS mark (VmHWM) to the current RSS (Linux >= 4.0), so the next reading belongs to one stage
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def peak_rss_read():
+    # VmHWM in kB from /proc/self/status, or the lifetime maximum from getrusage
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def usage_snapshot():
+    s  = resource.getrusage(resource.RUSAGE_SELF)
+    c  = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_counts = proc_io_read()
+    return {'t':               time.time(),
+            'user_s':          s.ru_utime,
+            'sys_s':           s.ru_stime,
+            'child_user_s':    c.ru_utime,
+            'child_sys_s':     c.ru_stime,
+            'child_maxrss_kb': c.ru_maxrss,
+            'read_bytes':      io_counts.get('read_bytes', 0),
+            'write_bytes':     io_counts.get('write_bytes', 0),
+            'rchar':           io_counts.get('rchar', 0),
+            'wchar':           io_counts.get('wchar', 0) }
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Stage_Usage_Init( metadatadir, subject, modality, batch_id='' ):
+    # Set labels shared by all stages of this process, and the directory of the metadata.sqlite that will receive them.
+    # Records still pending when the process exits (for example after sys.exit on an error) are stored then.
+    global Stage_dbdir
+
+    Stage_dbdir = metadatadir
+    Stage_labels['host']     = socket.gethostname()
+    Stage_labels['pid']      = os.getpid()
+    Stage_labels['subject']  = subject
+    Stage_labels['modality'] = modality
+    if batch_id:
+        Stage_labels['batch_id'] = batch_id
+    else:
+        Stage_labels['batch_id'] = '%s-%d-%s' % (Stage_labels['host'], Stage_labels['pid'], time.strftime('%Y%m%d%H%M%S'))
+
+    if not Stage_Usage_Init.atexit_set:
+        import atexit
+        atexit.register( Stage_Usage_Store )
+        Stage_Usage_Init.atexit_set = True
+
+Stage_Usage_Init.atexit_set = False
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Stage_Start( stage, bids_run='' ):
+    # Returns a token to pass to Stage_End
+    peak_rss_reset()
+    Stage_current.update( {'stage': stage, 'bids_run': bids_run} )
+    return {'stage': stage, 'bids_run': bids_run, 'start': usage_snapshot()}
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Stage_End( token, status='ok' ):
+    t0 = token['start']
+    t1 = usage_snapshot()
+    Stage_current.update( {'stage': '', 'bids_run': token['bids_run']} )
+
+    rec = dict( Stage_labels )
+    rec.update( {'bids_run':   token['bids_run'],
+                 'stage':      token['stage'],
+                 'status':     status,
+                 'start_time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t0['t'])),
+                 'wall_s':     t1['t'] - t0['t'],
+                 'maxrss_kb':  peak_rss_read(),
+                 'child_maxrss_kb': t1['child_maxrss_kb'] } )
+    for var in ['user_s', 'sys_s', 'child_user_s', 'child_sys_s', 'read_bytes', 'write_bytes', 'rchar', 'wchar']:
+        rec[var] = t1[var] - t0[var]
+
+    Stage_records.append( rec )
+    return rec
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+class Stage_Usage:
+    # Context-manager form of Stage_Start/Stage_End; a stage left through an exception is recorded with status 'error'
+    def __init__( self, stage, bids_run='' ):
+        self.stage    = stage
+        self.bids_run = bids_run
+        self.record   = {}
+
+    def __enter__( self ):
+        self.token = Stage_Start( self.stage, self.bids_run )
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        if exc_type is None:
+            self.record = Stage_End( self.token )
+        else:
+            self.record = Stage_End( self.token, status='error' )
+        return False
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Stage_Usage_Store( metadatadir='' ):
+    # Append pending stage records to table stage_usage in metadata.sqlite
+    if not metadatadir:
+        metadatadir = Stage_dbdir
+    if not Stage_records or not metadatadir or not os.path.isdir(metadatadir):
+        return
+
+    sqlite_file = ''.join([metadatadir, '/', 'metadata.sqlite'])
+    try:
+        conn = sqlite3.connect( sqlite_file, timeout=30 )
+        c = conn.cursor()
+        c.execute( 'CREATE TABLE IF NOT EXISTS {tn} (id INTEGER PRIMARY KEY, {cols})'.format(
+                   tn=Stage_table, cols=', '.join(["'%s'" % s for s in Stage_columns]) ) )
+        c.executemany( 'INSERT INTO {tn} ({cn}) VALUES ({qm})'.format(
+                       tn=Stage_table, cn=','.join(Stage_columns), qm=','.join(['?']*len(Stage_columns)) ),
+                       [ [rec[s] for s in Stage_columns]  for rec in Stage_records ] )
+        conn.commit()
+        conn.close()
+    except sqlite3.Error as err:
+        print('Warning: unable to store stage resource usage in %s: %s' % (sqlite_file, err) )
+        return
+
+    del Stage_records[:]
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Stage_Usage_Summary( sqlite_file ):
+    # Per modality and stage: number of runs, mean and max wall time, mean CPU, peak RSS of this process and its children,
+    # and mean I/O bytes. Returns a list of dictionaries, one per (modality, stage)
+    conn = sqlite3.connect( sqlite_file )
+    conn.row_factory = sqlite3.Row
+    rows = conn.execute(
+        'SELECT modality, stage, COUNT(*) AS n, '
+        '       AVG(wall_s) AS wall_mean_s, MAX(wall_s) AS wall_max_s, '
+        '       AVG(user_s + sys_s) AS cpu_mean_s, AVG(child_user_s + child_sys_s) AS child_cpu_mean_s, '
+        '       MAX(maxrss_kb) AS maxrss_kb, MAX(child_maxrss_kb) AS child_maxrss_kb, '
+        '       AVG(read_bytes) AS read_mean_bytes, AVG(write_bytes) AS write_mean_bytes, AVG(rchar) AS rchar_mean '
+        '  FROM {tn} GROUP BY modality, stage ORDER BY modality, MIN(id)'.format(tn=Stage_table) ).fetchall()
+    conn.close()
+    return [ dict(r) for r in rows ]
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Stage_Usage_Summary_print( summary ):
+    hdr = '%-16s %-14s %6s %9s %9s %9s %9s %10s %10s %10s %10s' % ('modality', 'stage', 'n', 'wall_mean', 'wall_max',
+                                                                 'cpu_mean', 'chld_cpu', 'rss_MB', 'chld_rss_MB', 'read_MB', 'write_MB')
+    print( hdr )
+    print( '-' * len(hdr) )
+
+    modality = None
+    for r in summary:
+        if modality is not None and r['modality'] != modality:
+            print()
+        modality = r['modality']
+        print( '%-16s %-14s %6d %9.1f %9.1f %9.1f %9.1f %10.1f %10.1f %10.1f %10.1f' % (
+               r['modality'], r['stage'], r['n'], r['wall_mean_s'], r['wall_max_s'], r['cpu_mean_s'], r['child_cpu_mean_s'],
+               (r['maxrss_kb'] or 0)/1024, (r['child_maxrss_kb'] or 0)/1024,
+               (r['read_mean_bytes'] or 0)/2**20, (r['write_mean_bytes'] or 0)/2**20 ) )
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    if len(sys.argv) != 2:
+        program_description()
+        sys.exit()
+
+    sqlite_file = sys.argv[1]
+    if not os.path.isfile( sqlite_file ):
+        print('Error: unable to find', sqlite_file )
+        sys.exit()
+
+    Stage_Usage_Summary_print( Stage_Usage_Summary( sqlite_file ) )
+# ========================================================================================================================================================
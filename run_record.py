@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import sys, json
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Compact record of one run found by discovery (series_process_info_get.Get_File_Names_and_Process_Info(..., records=True)),
+# in place of its dictionary of files and series parameters:
+#
+#   key, bids_run                     'Run-01', 'run-01'
+#   MinProc_file, ...                 minimally-processed container and, depending on the modality, motion, registration and
+#                                     events files (BOLD), bvals, bvecs and registration matrix (DTI)
+#   FasTrk_file, ...                  fast-track linkage: resolved file, its name, the name it should have, series date and time
+#   TR, TE, TI, FlipAngle, nreps, ndiffdirs
+#
+# Fields are slots (no per-record __dict__), and numpy scalars from the series table are stored as Python numbers. A record
+# pickles as one flat tuple of its values, so lists of records travel cheaply through multiprocessing queues and pools.
+#
+# A record reads like the dictionary it replaces (rec['MinProc_file'], rec.get('Event_file', ''), 'TI' in rec, keys()); a
+# field that discovery did not set (None) is absent, as its key was from the dictionary.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Fields = ('key', 'bids_run',
+          'MinProc_file', 'Motion_file', 'Regis_file', 'Event_file', 'bval_file', 'bvec_file', 'RegMtx_file', 'RegistrationMatrix',
+          'FasTrk_file', 'FasTrk_file_nopath', 'FasTrk_file_Guessed_Name', 'series_date', 'series_time',
+          'TR', 'TE', 'TI', 'FlipAngle', 'nreps', 'ndiffdirs')
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+class Run_Record( object ):
+    __slots__ = Fields
+
+    def __init__( self, *values, **fields ):
+        for name, value in zip( Fields, values ):
+            setattr( self, name, value )
+        for name in Fields[len(values):]:
+            setattr( self, name, None )
+        for name, value in fields.items():
+            setattr( self, name, value )      # AttributeError for an unknown field
+
+    def __reduce__( self ):
+        return (Run_Record, self.to_tuple())
+
+    def to_tuple( self ):
+        return tuple( getattr(self, name)  for name in Fields )
+
+    def as_dict( self ):
+        return { name: getattr(self, name)  for name in Fields  if getattr(self, name) is not None }
+
+    def __getitem__( self, name ):
+        value = getattr( self, name, None )  if name in Fields  else None
+        if value is None:
+            raise KeyError( name )
+        return value
+
+    def get( self, name, default=None ):
+        value = getattr( self, name, None )  if name in Fields  else None
+        return default  if value is None  else value
+
+    def __contains__( self, name ):
+        return name in Fields  and getattr(self, name) is not None
+
+    def keys( self ):
+        return [ name  for name in Fields  if getattr(self, name) is not None ]
+
+    def __repr__( self ):
+        return 'Run_Record(%s)' % ', '.join( '%s=%r' % (name, getattr(self, name))  for name in Fields  if getattr(self, name) is not None )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def value_get( value ):
+    # numpy scalar (from the series table) as a Python number
+    return value.item()  if hasattr(value, 'item') and not hasattr(value, '__len__')  else value
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Run_Record_from_dict( key, run ):
+    # Record of a run's dictionary of files and parameters (an entry of Get_File_Names_and_Process_Info); other keys are dropped
+    rec = Run_Record( key, key.lower() )
+    for name in Fields[2:]:
+        if name in run:
+            setattr( rec, name, value_get( run[name] ) )
+    return rec
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Run_Records_from_Files( Files ):
+    # {'Run-01': Run_Record, ...} from Get_File_Names_and_Process_Info's {'Run-01': {...}, ...} (entries that are not runs'
+    # dictionaries are left out)
+    return { key: Run_Record_from_dict( key, run )  for key, run in Files.items()  if isinstance( run, dict ) }
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    # Records of the runs listed by series_process_info_get.py:
+    #   ./series_process_info_get.py --subject S --modality M > runs.json ;  ./run_record.py runs.json
+    if len(sys.argv) != 2:
+        print('Usage:  ./run_record.py  Runs.json   (output of series_process_info_get.py)')
+        sys.exit()
+
+    with open(sys.argv[1], 'r') as f:
+        Files = json.load( f )
+
+    for key, rec in sorted( Run_Records_from_Files( Files ).items() ):
+        print( rec )
+# ========================================================================================================================================================
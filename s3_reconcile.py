@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+import sys, os, getopt, json, csv, sqlite3, string, subprocess, time, datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from share_config import Share_Config_Get
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# What has really been shared: the target bucket, listed once, joined with the local records (metadata.sqlite of each output
+# directory: fmriresults01.derived_files, archive_digests) and with a freshly downloaded NDA fmriresults01 package.
+#
+# The bucket is listed in concurrent shards: the keys recorded locally share a stem (the bucket prefix and "NDARINV"), and
+# the keys under the stem are split into consecutive ranges at the stem followed by each letter or digit (Shard_characters).
+# A shard starts after its lower bound (list-objects-v2 --start-after) and reads pages until it passes its upper bound, so
+# the shards together cover every key under the stem, whatever character follows it. One more listing, with the stem as
+# delimiter, returns every key outside the stem (and a roll-up of any other key that contains it, which is then listed as
+# well). --workers 1 lists the bucket in a single pass.
+#
+# The listing is kept in table s3_listing of each metadata.sqlite; the share script (AWS_file_upload) skips uploading an
+# archive that the listing shows already in the bucket with the same size and MD5.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Listing_table = 's3_listing'
+
+Shard_characters = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
+Report_categories = ['missing_remote', 'orphaned', 'size_mismatch', 'checksum_mismatch', 'not_in_nda']
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Reconcile the data sets recorded locally (metadata.sqlite), the objects in the AWS-s3 bucket and the records in NDA')
+    print()
+    print('Usage:')
+    print('  ./s3_reconcile.py  --outdir OutDir1,OutDir2,...  [--NDApkg Package]  [--workers N]  [--json Report]')
+    print()
+    print('where:')
+    print('  OutDir     Output directories of the share script (each with its metadata.sqlite)')
+    print('  Package    Freshly downloaded NDA fmriresults01 package (fmriresults01.txt); without it, NDA is not checked')
+    print('  N          Concurrent bucket listings (default: 8)')
+    print('  Report     Write the full report to this .json file')
+    print()
+    print('Reported: archives recorded as uploaded but missing from the bucket, bucket objects not recorded locally (orphaned),')
+    print('size and MD5 mismatches, and records uploaded to miNDA but not yet in the NDA package.')
+    print('Bucket and AWS command are those of share_config.json.')
+    print()
+    print('Example:')
+    print('  ./s3_reconcile.py  --outdir /mproc/chla,/mproc/yale  --NDApkg /home/oruiz/ABCD_Inventory/NDA_downloaded_packages/fmriresults01.txt  --json reconcile.json')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def command_line_get_variables():
+    o = {'outdirs': [], 'nda_pkg': '', 'workers': 8, 'json': ''}
+
+    try:
+        opts,args = getopt.getopt(sys.argv[1:], "ho:n:p:j:", ["outdir=", "NDApkg=", "workers=", "json="])
+    except getopt.GetoptError as err:
+        print("Error parsing arguments: %s" % str(err))
+        program_description()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            program_description()
+            sys.exit()
+        elif opt in ("-o", "--outdir"):
+            o['outdirs'] = [ d  for d in arg.split(',')  if d ]
+        elif opt in ("-n", "--NDApkg"):
+            o['nda_pkg'] = arg
+        elif opt in ("-p", "--workers"):
+            o['workers'] = max( 1, int(arg) )
+        elif opt in ("-j", "--json"):
+            o['json'] = arg
+
+    if not o['outdirs']:
+        program_description()
+        sys.exit()
+
+    return o
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+#                                                       Bucket listing
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def bucket_and_prefix_get( bucket_url ):
+    # 's3://bucket/some/prefix/' -> ('bucket', 'some/prefix/')
+    bucket, _, prefix = bucket_url[len('s3://'):].partition('/')
+    return bucket, prefix
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def S3_List_run( bucket, prefix, args ):
+    # Output of  aws s3api list-objects-v2  for the objects under prefix, with further arguments
+    Config = Share_Config_Get()
+    cmnd_and_args = [Config['AWS_cmd'], 's3api', 'list-objects-v2', '--bucket', bucket, '--prefix', prefix, '--output', 'json'] + args
+    if Config['AWS_endpoint_url']:
+        cmnd_and_args += ['--endpoint-url', Config['AWS_endpoint_url']]
+
+    rs = subprocess.run( cmnd_and_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE )
+    if rs.returncode != 0:
+        raise IOError( 'unable to list s3://%s/%s: %s' % (bucket, prefix, rs.stderr.decode('utf-8').strip()) )
+    return json.loads( rs.stdout.decode('utf-8') or '{}' )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def S3_List( bucket, prefix, delimiter='' ):
+    # All objects under prefix (the AWS CLI follows the pages); returns (objects {key: {size, etag}}, common prefixes)
+    out = S3_List_run( bucket, prefix, ['--delimiter', delimiter]  if delimiter  else [] )
+    objects = { c['Key']: {'size': c['Size'], 'etag': c['ETag'].strip('"')}  for c in out.get('Contents') or [] }
+    common  = [ c['Prefix']  for c in out.get('CommonPrefixes') or [] ]
+    return objects, common
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def S3_List_Range( bucket, prefix, after='', upto=None ):
+    # Objects under prefix whose keys sort after `after` (from the first, if '') and up to `upto` (to the last, if None),
+    # read one page at a time so that the listing stops at upto; keys sort as S3 returns them (UTF-8 bytes, code points)
+    objects = {}
+    token = ''
+    while True:
+        args = ['--no-paginate']
+        if token:
+            args += ['--continuation-token', token]
+        elif after:
+            args += ['--start-after', after]
+        out = S3_List_run( bucket, prefix, args )
+
+        for c in out.get('Contents') or []:
+            if upto is not None and c['Key'] > upto:
+                return objects
+            objects[ c['Key'] ] = {'size': c['Size'], 'etag': c['ETag'].strip('"')}
+
+        token = out.get('NextContinuationToken', '')
+        if not out.get('IsTruncated') or not token:
+            return objects
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def stem_get( keys ):
+    # Longest common beginning of the keys, shorter than any of them, so each key continues it in some shard
+    if not keys:
+        return ''
+    return os.path.commonprefix( list(keys) )[ :min( len(k)  for k in keys ) - 1 ]
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Bucket_Listing_get( bucket_url, expected_keys=[], workers=8 ):
+    # Objects of the bucket under its prefix, listed in concurrent shards of the stem of expected_keys
+    bucket, prefix = bucket_and_prefix_get( bucket_url )
+    stem = prefix + stem_get( expected_keys )
+    if not expected_keys or workers <= 1 or stem == prefix:
+        return S3_List( bucket, prefix )[0]
+
+    with ThreadPoolExecutor( max_workers=workers ) as pool:
+        # Everything not under the stem, plus roll-ups of keys that contain it
+        outside = pool.submit( S3_List, bucket, prefix, stem[len(prefix):] )
+
+        # Everything under the stem, in ranges (after, upto]: from the stem itself to stem0, stem0 to stem1, ..., stemz to the end
+        bounds = [ stem + c  for c in Shard_characters ]
+        shards = [ pool.submit( S3_List_Range, bucket, stem, after, upto )  for after, upto in zip( [''] + bounds, bounds + [None] ) ]
+
+        objects, common = outside.result()
+        for shard in shards:
+            objects.update( shard.result() )
+
+        # Keys that contain the stem other than at their beginning
+        for p in common:
+            if p != stem:
+                objects.update( S3_List( bucket, p )[0] )
+
+    return objects
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Listing_Store( metadatadir, bucket_url, objects ):
+    # Listing in table s3_listing of metadatadir/metadata.sqlite (replaces the previous listing of the same bucket)
+    bucket, prefix = bucket_and_prefix_get( bucket_url )
+    listed = datetime.datetime.now().isoformat( timespec='seconds' )
+    conn = sqlite3.connect( ''.join([metadatadir, '/', 'metadata.sqlite']), timeout=30 )
+    with conn:
+        conn.execute( 'CREATE TABLE IF NOT EXISTS %s (bucket TEXT, key TEXT, size INTEGER, etag TEXT, listed TEXT, PRIMARY KEY (bucket, key))'
+                      % Listing_table )
+        conn.execute( 'DELETE FROM %s WHERE bucket = ?' % Listing_table, (bucket,) )
+        conn.executemany( 'INSERT INTO %s VALUES (?,?,?,?,?)' % Listing_table,
+                          [ (bucket, key, obj['size'], obj['etag'], listed)  for key, obj in objects.items() ] )
+    conn.close()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Listing_Match( outtarname, bucket_url, digests ):
+    # True if the last listing stored next to outtarname shows it in the bucket with the same size and MD5.
+    # Objects uploaded in parts have an ETag that is not an MD5 (it contains '-'), and never match.
+    if not digests:
+        return False
+    bucket, prefix = bucket_and_prefix_get( bucket_url )
+    sqlite_file = ''.join([os.path.dirname(os.path.abspath(outtarname)), '/', 'metadata.sqlite'])
+    if not os.path.isfile( sqlite_file ):
+        return False
+    try:
+        conn = sqlite3.connect( sqlite_file, timeout=30 )
+        row = conn.execute( 'SELECT size, etag FROM %s WHERE bucket = ? AND key = ?' % Listing_table,
+                            (bucket, prefix + os.path.basename(outtarname)) ).fetchone()
+        conn.close()
+    except sqlite3.Error:
+        return False
+    return bool(row) and row[0] == digests['size'] and row[1] == digests['md5']
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+#                                                    Local records and NDA
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Local_Records_get( metadatadir ):
+    # Last fmriresults01 record of each derived_files, with the digests of its archive: {derived_files: record}
+    records = {}
+    sqlite_file = ''.join([metadatadir, '/', 'metadata.sqlite'])
+    if not os.path.isfile( sqlite_file ):
+        print('Warning: no metadata.sqlite in', metadatadir )
+        return records
+
+    conn = sqlite3.connect( sqlite_file, timeout=30 )
+    tables = [ r[0]  for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'") ]
+    if 'fmriresults01' in tables:
+        for derived_files, miNDA_ok, s3_ok in conn.execute( 'SELECT derived_files, miNDA_ok, s3_ok FROM fmriresults01 ORDER BY id' ):
+            records[ derived_files ] = {'outdir': metadatadir, 'miNDA_ok': miNDA_ok == 'True', 's3_ok': s3_ok == 'True'}
+    digests = {}
+    if 'archive_digests' in tables:
+        for archive, size, md5 in conn.execute( 'SELECT archive, size, md5 FROM archive_digests ORDER BY rowid' ):
+            digests[ archive ] = {'size': size, 'md5': md5}
+    conn.close()
+
+    for derived_files, rec in records.items():
+        rec.update( digests.get( derived_files.split('/')[-1], {} ) )
+    return records
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def NDA_Derived_Files_get( nda_pkg ):
+    # derived_files of the records in an NDA fmriresults01 package (tab-separated; second line holds column descriptions)
+    derived = set()
+    with open(nda_pkg, 'r', newline='') as f:
+        reader = csv.reader( f, delimiter='\t' )
+        header = next( reader )
+        next( reader, None )
+        col = header.index( 'derived_files' )
+        for row in reader:
+            if len(row) > col:
+                derived.add( row[col].strip() )
+    return derived
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Reconcile( records, objects, bucket_url, nda_derived=None ):
+    # Join of local records, bucket objects and NDA records; returns {category: [entries]}
+    bucket, prefix = bucket_and_prefix_get( bucket_url )
+    report = dict( (c, [])  for c in Report_categories )
+
+    local_keys = set()
+    for derived_files, rec in sorted( records.items() ):
+        if not derived_files.startswith( bucket_url ):
+            continue
+        key = prefix + derived_files[len(bucket_url):]
+        local_keys.add( key )
+        obj = objects.get( key )
+
+        if obj is None:
+            if rec['s3_ok']:
+                report['missing_remote'].append( {'key': key, 'outdir': rec['outdir']} )
+        elif 'size' in rec and obj['size'] != rec['size']:
+            report['size_mismatch'].append( {'key': key, 'outdir': rec['outdir'], 'local': rec['size'], 'remote': obj['size']} )
+        elif 'md5' in rec and '-' not in obj['etag'] and obj['etag'] != rec['md5']:
+            report['checksum_mismatch'].append( {'key': key, 'outdir': rec['outdir'], 'local': rec['md5'], 'remote': obj['etag']} )
+
+        if nda_derived is not None and rec['miNDA_ok'] and derived_files not in nda_derived:
+            report['not_in_nda'].append( {'derived_files': derived_files, 'outdir': rec['outdir'], 'in_bucket': obj is not None} )
+
+    for key in sorted( set(objects) - local_keys ):
+        report['orphaned'].append( {'key': key, 'size': objects[key]['size']} )
+
+    return report
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    o = command_line_get_variables()
+    bucket_url = Share_Config_Get()['AWS_bucket']
+    t0 = time.time()
+
+    records = {}
+    for outdir in o['outdirs']:
+        records.update( Local_Records_get( outdir ) )
+    print('Local records:   %d   (%s)' % (len(records), ', '.join(o['outdirs'])) )
+
+    bucket, prefix = bucket_and_prefix_get( bucket_url )
+    expected = [ df[len(bucket_url):]  for df in records  if df.startswith(bucket_url) ]
+    try:
+        objects = Bucket_Listing_get( bucket_url, expected, o['workers'] )
+    except IOError as err:
+        print('Error:', err )
+        sys.exit(1)
+    print('Bucket objects:  %d   (%s, listed in %.1f s)' % (len(objects), bucket_url, time.time() - t0) )
+
+    for outdir in o['outdirs']:
+        Listing_Store( outdir, bucket_url, objects )
+
+    nda_derived = None
+    if o['nda_pkg']:
+        nda_derived = NDA_Derived_Files_get( o['nda_pkg'] )
+        print('NDA records:     %d   (%s)' % (len(nda_derived), o['nda_pkg']) )
+
+    report = Reconcile( records, objects, bucket_url, nda_derived )
+
+    print()
+    for c in Report_categories:
+        if c == 'not_in_nda' and nda_derived is None:
+            continue
+        print('%-18s %6d' % (c, len(report[c])) )
+        for entry in report[c][:10]:
+            print('      ', entry.get('key', entry.get('derived_files')) )
+        if len(report[c]) > 10:
+            print('       ...')
+
+    if o['json']:
+        with open(o['json'], 'w') as f:
+            json.dump( report, f, indent=2 )
+        print()
+        print('Report written to', o['json'] )
+# ========================================================================================================================================================
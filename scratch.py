@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import os, socket, shutil, tempfile, atexit
+
+from share_config import Share_Config_Get
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Scratch space of the share script: each process works in its own directory under "Scratch_root" (share_config.json; e.g. a
+# tmpfs or local NVMe mount), and each run in a fresh subdirectory of it, so concurrent workers and overlapping site batches
+# never write the same path:
+#
+#   <Scratch_root>/mproc_share.<host>.<pid>/<run label>.<random>/<image>.nii
+#
+# Run directories are removed when the run is done with them, and whatever a process still holds when its task ends
+# (share_pool.py) or when it exits; directories left by processes of this host that no longer exist (killed) are removed by
+# the next process that starts using scratch.
+#
+# Files written into an output directory (BIDS archives) are written to a temporary name next to their final name, tracked
+# here, and renamed into place when complete (see archive_digest.Archive_Open).
+# ---------------------------------------------------------------------------------------------------------------------------------
+Process_dir_prefix = 'mproc_share.%s.' % socket.gethostname()
+
+Process_dir = ''        # Created on first use
+Tracked = set()         # Run directories and partial files of this process, removed by Scratch_Cleanup
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Scratch_root_get():
+    return Share_Config_Get().get('Scratch_root', '/tmp') or '/tmp'
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Stale_Remove( root ):
+    # Process directories of this host whose process no longer exists
+    try:
+        names = os.listdir( root )
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith( Process_dir_prefix ):
+            continue
+        try:
+            pid = int( name[len(Process_dir_prefix):] )
+            os.kill( pid, 0 )
+        except ValueError:
+            continue
+        except ProcessLookupError:
+            print('Removing scratch directory of a process that has ended:', os.path.join(root, name) )
+            shutil.rmtree( os.path.join(root, name), ignore_errors=True )
+        except PermissionError:
+            pass
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Process_Dir_get():
+    # Scratch directory of this process (a forked worker gets its own, not its parent's)
+    global Process_dir
+    name = Process_dir_prefix + str( os.getpid() )
+    if not Process_dir or os.path.basename( Process_dir ) != name:
+        root = Scratch_root_get()
+        Stale_Remove( root )
+        Process_dir = os.path.join( root, name )
+        Tracked.clear()
+    os.makedirs( Process_dir, exist_ok=True )
+    return Process_dir
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Run_Dir_Create( label ):
+    # New, empty directory for one run
+    run_dir = tempfile.mkdtemp( prefix=label + '.', dir=Process_Dir_get() )
+    Tracked.add( run_dir )
+    return run_dir
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Remove( path ):
+    # Remove a run directory or a partial file, and stop tracking it
+    Tracked.discard( path )
+    try:
+        if os.path.isdir( path ):
+            shutil.rmtree( path )
+        elif os.path.exists( path ):
+            os.remove( path )
+    except OSError as err:
+        print('Error: unable to remove', path, err )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Partial_fname_get( fname ):
+    # Temporary name, in the same directory (same file system, so the final rename is atomic), for a file being written
+    partial = '%s.part-%d' % (fname, os.getpid())
+    Tracked.add( partial )
+    return partial
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Partial_Commit( partial, fname ):
+    # Atomic rename of a complete file into place
+    os.replace( partial, fname )
+    Tracked.discard( partial )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Scratch_Cleanup():
+    # Everything this process still holds: at the end of a task (share_pool.py) and at exit
+    for path in sorted( Tracked ):
+        Remove( path )
+    if Process_dir and os.path.basename( Process_dir ) == Process_dir_prefix + str( os.getpid() ):
+        shutil.rmtree( Process_dir, ignore_errors=True )
+
+atexit.register( Scratch_Cleanup )
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    # Show the scratch root and the process directories in it
+    root = Scratch_root_get()
+    print('Scratch root:', root )
+    Stale_Remove( root )
+    for name in sorted( os.listdir(root) ):
+        if name.startswith('mproc_share.'):
+            print('  ', name )
+# ========================================================================================================================================================
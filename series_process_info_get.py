@@ -2,19 +2,26 @@
 
 import sys, os
 
-from scipy.io import loadmat
-
 import warnings
 warnings.simplefilter(action='ignore', category=UserWarning)
-import pandas as pd
-pd.set_option('display.width', 512)
-pd.set_option('max_colwidth', 60)
 
-import glob, json, time
+import glob, json, time, csv, fnmatch
+
+from share_config import Share_Config_Get
+from lookup_index import Index_Open, PCInfo_Index_Lookup, PCInfo_index_columns
+from regmtx_cache import RegMtx_get
+from share_errors import Discovery_Error
+from run_record import Run_Records_from_Files
+
+# pandas and scipy.io are imported by the functions that use them (see pandas_get), so that
+# printing usage, or importing this module, does not pay for them
 
 #------------------------------------------------------------------------------------------------------------------------------------------
-Dirs_Loc_fname = '/home/abcdproc1/ProjInfo/MMIL_ProjInfo.csv'
-PCInfo_fname   = '/home/abcdproc1/MetaData/DAL_ABCD/DAL_ABCD_pcinfo.csv'
+Config = Share_Config_Get()
+
+Dirs_Loc_fname = Config['Dirs_Loc_fname']
+PCInfo_fname   = Config['PCInfo_fname']
+FasTrk_root    = Config['FasTrk_root']
 
 filt = {'DTI_ndiffdirs_min':  50,   # Don, 2018aug09,10.  Before it was thresh = 0
         'BOLD_nreps_min':    100    # Don, 2018jan__
@@ -31,10 +38,25 @@ fstktype_for_modality = dict( zip( modality_list, fstktype_list) )
 addit_var_list = ['ndiffdirs', 'nreps', 'TR', 'TE', 'FlipAngle']   # 'TI' exists only for T1 series; it is handled in the code, below
 
 Verbose = False    # Set through command line
+
+Catalog_depth = 3  # Levels of a container listed by Container_Catalog_get: down to exportDTIforFSL/DTI<n>/<file>
+Catalogs = {}      # Container directory -> its entries (tuples of path components); emptied at each discovery
 #------------------------------------------------------------------------------------------------------------------------------------------
 
 
 # ========================================================================================================================================================
+#----------------------------------------------------------------------------------------
+def pandas_get():
+    import pandas as pd
+    if not pandas_get.options_set:
+        pd.set_option('display.width', 512)
+        pd.set_option('max_colwidth', 60)
+        pandas_get.options_set = True
+    return pd
+
+pandas_get.options_set = False
+#----------------------------------------------------------------------------------------
+
 #----------------------------------------------------------------------------------------
 def program_description():
     print()
@@ -141,6 +163,7 @@ def PCInfo_get( subj, modality ):
     # get rows with SeriesType == modality,
     # and extract  SeriesInstanceUID.
 
+    pd = pandas_get()
     PCInfo = pd.DataFrame()
 
     # print('PCInfo.columns:', PCInfo.columns )
@@ -157,23 +180,35 @@ def PCInfo_get( subj, modality ):
     #  'fMRI_MID_task', 'fMRI_SST_task', 'fMRI_nBack_task', 'rsfMRI']
 
     start_time = time.time()
-    # # 2017:
-    # PCInfo  =  pd.read_csv( '/home/abcddaic/MetaData/DAL_ABCD_QC/DAL_ABCD_QC_combined_pcinfo.csv', low_memory=False )
-    # PCInfo = PCInfo[['pGUID', 'EventName', 'SiteName', 'SeriesType',
-    #                  'SeriesInstanceUID', 'StudyDate', 'SeriesTime']]
-    # 2017 patch:
-    PCInfo  =  pd.read_csv( PCInfo_fname, low_memory=False,
-                            usecols=['pGUID', 'EventName', 'SiteName', 'Manufacturer',
-                                      'SeriesType', 'SeriesInstanceUID', 'StudyDate', 'SeriesTime'] )
-    elapsed_time = time.time() - start_time
 
-    if Verbose:
-        print('PCInfo.shape:', PCInfo.shape )
-        print('Reading time: %.1f s' % elapsed_time )
-        print()
+    # Rows of this subject from the prebuilt index (lookup_index.py), if there is a current one
+    conn = Index_Open( PCInfo_fname )
+    if conn:
+        PCInfo = pd.DataFrame( PCInfo_Index_Lookup( conn, subj ), columns=PCInfo_index_columns )
+        conn.close()
+
+        if Verbose:
+            print('PCInfo rows from index: %.0f,  lookup time: %.3f s' % (len(PCInfo), time.time() - start_time) )
+            print()
+
+    else:
+        # # 2017:
+        # PCInfo  =  pd.read_csv( '/home/abcddaic/MetaData/DAL_ABCD_QC/DAL_ABCD_QC_combined_pcinfo.csv', low_memory=False )
+        # PCInfo = PCInfo[['pGUID', 'EventName', 'SiteName', 'SeriesType',
+        #                  'SeriesInstanceUID', 'StudyDate', 'SeriesTime']]
+        # 2017 patch:
+        PCInfo  =  pd.read_csv( PCInfo_fname, low_memory=False,
+                                usecols=['pGUID', 'EventName', 'SiteName', 'Manufacturer',
+                                          'SeriesType', 'SeriesInstanceUID', 'StudyDate', 'SeriesTime'] )
+        elapsed_time = time.time() - start_time
 
-    mask = [ subj in s  for s in PCInfo['pGUID'] ]
-    PCInfo = PCInfo.loc[mask]
+        if Verbose:
+            print('PCInfo.shape:', PCInfo.shape )
+            print('Reading time: %.1f s' % elapsed_time )
+            print()
+
+        mask = [ subj in s  for s in PCInfo['pGUID'] ]
+        PCInfo = PCInfo.loc[mask]
 
     if Verbose:
         print('PCInfo:')
@@ -230,9 +265,8 @@ def Sers_filter_by_UID( subj, SerInfo_this_process, modality ):
     else:
         acceptable = False
         if Verbose:
-            print("Error: SeriesTime in ContainerInfo and PCInfo differ")
             print( [float(s) for s in NewTable['SeriesTime_x']] == NewTable['SeriesTime_y']  )
-        sys.exit()
+        raise Discovery_Error("Error: SeriesTime in ContainerInfo and PCInfo differ")
 
 
     # Check if all identified series in pcinfo exist in ContainerInfo:
@@ -252,6 +286,8 @@ def Sers_filter_by_UID( subj, SerInfo_this_process, modality ):
 
 # ---------------------------------------------------------------------------------------------------------------
 def Sers_from_ContainerInfo_and_PCinfo( subj, modality, scantype, fpath ):
+    pd = pandas_get()
+    from scipy.io import loadmat
 
     path_to_search  =  fpath + 'PROC*_' + subj + '_*'
 
@@ -275,12 +311,10 @@ def Sers_from_ContainerInfo_and_PCinfo( subj, modality, scantype, fpath ):
         print( '\n'.join(f_list) )
 
     if len(f_list) == 0:
-        print("Error: unable to find minimally-processed directory for requested subject")
-        sys.exit()
+        raise Discovery_Error("Error: unable to find minimally-processed directory for requested subject")
 
     elif len(f_list) > 1:
-        print("Error: found too many min.processed-series directories; cannot continue")
-        sys.exit()
+        raise Discovery_Error("Error: found too many min.processed-series directories; cannot continue")
 
     fdir = f_list[0]
     #----------------------------------------------------------------------------------------
@@ -293,9 +327,8 @@ def Sers_from_ContainerInfo_and_PCinfo( subj, modality, scantype, fpath ):
     fname = fdir + '/' + fname
     try:
         data = loadmat(fname, squeeze_me=True, struct_as_record=True)
-    except:
-        print('Error: unable to read', fname )
-        sys.exit()
+    except Exception as err:
+        raise Discovery_Error('Error: unable to read %s: %s' % (fname, err))
 
     # Extract structure of interest
     CntrInfo = data['ContainerInfo']
@@ -422,10 +455,7 @@ def Sers_from_ContainerInfo_and_PCinfo( subj, modality, scantype, fpath ):
         print('There are %.0f acceptable MRI_types in ContainerInfo' % st_num, ':  inds =', inds )
 
     if st_num <= 0:
-        if Verbose:
-            print()
-            print('Error: ContainerInfo does not include any acceptable MRI_types')
-        sys.exit()
+        raise Discovery_Error('Error: ContainerInfo does not include any acceptable MRI_types')
 
     if Verbose:
         print()
@@ -458,8 +488,7 @@ def Sers_from_ContainerInfo_and_PCinfo( subj, modality, scantype, fpath ):
         Series = SerInfo_this_process[ SerInfo_this_process['nreps'] >= filt['BOLD_nreps_min'] ]
 
     else:
-        print('Error: unrecognized scantype:', scantype )
-        sys.exit()
+        raise Discovery_Error('Error: unrecognized scantype: %s' % scantype)
 
 
     if Verbose:
@@ -492,18 +521,16 @@ def T1T2_file_names_get( fdir, scantype, scan_number ):
         path_to_search  =  fdir + '/T2w_res.mgz*'
 
     for sn in scan_number:
-        res_f_list = glob.glob(path_to_search)
+        res_f_list = Container_glob( fdir, path_to_search )
         if Verbose:
             print( path_to_search )
             print( '\n'.join(res_f_list) )
 
     if len(res_f_list) == 0:
-        print("Error: unable to find minimally-processed data for requested subject")
-        sys.exit()
+        raise Discovery_Error("Error: unable to find minimally-processed data for requested subject")
 
     if len(res_f_list) > 1:
-        print("Error: found too many min.processed-series; I don't know what to do")
-        sys.exit()
+        raise Discovery_Error("Error: found too many min.processed-series; I don't know what to do")
 
     # Construct a dictionary with the resolved names of processed-data files to share
     Proc_files = {'Run-01': {'MinProc_file': res_f_list[0]} }
@@ -515,6 +542,44 @@ def T1T2_file_names_get( fdir, scantype, scan_number ):
 # ---------------------------------------------------------------------------------------------------------------
 
 
+# ---------------------------------------------------------------------------------------------------------------
+def Container_Catalog_get( fdir ):
+    # All entries of container fdir, down to Catalog_depth levels, from one recursive scandir (one directory pass on NFS)
+    if fdir in Catalogs:
+        return Catalogs[fdir]
+
+    entries = []
+    def scan( d, prefix ):
+        try:
+            with os.scandir( d ) as it:
+                for e in it:
+                    entries.append( prefix + (e.name,) )
+                    if len(prefix) + 1 < Catalog_depth and e.is_dir():
+                        scan( e.path, prefix + (e.name,) )
+        except OSError:
+            pass
+    scan( fdir, () )
+
+    Catalogs[fdir] = sorted( entries )
+    return Catalogs[fdir]
+# ---------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------
+def Container_glob( fdir, path_to_search ):
+    # glob.glob(path_to_search), for patterns inside container fdir, resolved against the container's catalog
+    parts = path_to_search[ len(fdir)+1: ].split('/')
+    matches = []
+    for e in Container_Catalog_get( fdir ):
+        if len(e) != len(parts):
+            continue
+        # As glob, wildcards do not match names starting with a dot
+        if all( fnmatch.fnmatchcase(name, pat) and (not name.startswith('.') or pat.startswith('.'))  for name, pat in zip(e, parts) ):
+            matches.append( fdir + '/' + '/'.join(e) )
+    return matches
+# ---------------------------------------------------------------------------------------------------------------
+
+
 # ---------------------------------------------------------------------------------------------------------------
 def File_names_filter( f_list, key, infix ):
     uFiles = {}
@@ -527,8 +592,7 @@ def File_names_filter( f_list, key, infix ):
         uFiles.update( dict( {key: sub_list[0]} ) )
     else:
         uFiles.update( dict( {key: ''} ) )
-        print("Error: found too many", infix, "files under subdir; I don't know what to do")
-        sys.exit()
+        raise Discovery_Error("Error: found too many %s files under subdir; I don't know what to do" % infix)
 
     return uFiles
 # ---------------------------------------------------------------------------------------------------------------
@@ -556,7 +620,7 @@ def BOLD_file_names_get( fdir, scan_number, task, t_ord ):
     key = 'Regis_file'
     
     path_to_search  =  fdir + '/BOLD' + '*' + '_for_corr_resBOLD_regT1.mat'
-    f_list = glob.glob(path_to_search)
+    f_list = Container_glob( fdir, path_to_search )
 
     if Verbose:
         print( path_to_search )
@@ -568,7 +632,7 @@ def BOLD_file_names_get( fdir, scan_number, task, t_ord ):
         
     else:
         path_to_search  =  fdir + '/BOLD' + '*' + '_for_f0_corr_resBOLD_regT1.mat'
-        f_list = glob.glob(path_to_search)
+        f_list = Container_glob( fdir, path_to_search )
 
         if Verbose:
             print( path_to_search )
@@ -587,7 +651,7 @@ def BOLD_file_names_get( fdir, scan_number, task, t_ord ):
         # path_to_search  =  fdir + '/BOLD' + sn + '*'
         path_to_search  =  fdir + '/BOLD%.0f*' % sn
 
-        f_list = glob.glob(path_to_search)
+        f_list = Container_glob( fdir, path_to_search )
 
         if Verbose:
             print( path_to_search )
@@ -609,7 +673,7 @@ def BOLD_file_names_get( fdir, scan_number, task, t_ord ):
 
             path_to_search  =  fdir + '/stim*%s/%s*%.0f_events.tsv' % (task, task, t_ord[j])
 
-            f_list = glob.glob(path_to_search)
+            f_list = Container_glob( fdir, path_to_search )
 
             if Verbose:
                 print( path_to_search )
@@ -652,7 +716,7 @@ def DTI_file_names_and_RegMtx_get( fdir, manuf, scan_number ):
         uFiles = {}
 
         path_to_search  =  fdir + '/exportDTIforFSL/DTI%.0f/*' % sn
-        f_list = glob.glob(path_to_search)
+        f_list = Container_glob( fdir, path_to_search )
 
         if Verbose:
             print( path_to_search )
@@ -664,8 +728,7 @@ def DTI_file_names_and_RegMtx_get( fdir, manuf, scan_number ):
 
         res_f_list = [s  for s in f_list  if '.nii.gz' in s]
         if len(res_f_list) > 1:
-            print("Error: found too many nIfTI DTI files under subdir; I don't know what to do")
-            sys.exit()
+            raise Discovery_Error("Error: found too many nIfTI DTI files under subdir; I don't know what to do")
 
         key = 'MinProc_file'
         uFiles.update( dict( {key: res_f_list[0]} ) )
@@ -676,13 +739,11 @@ def DTI_file_names_and_RegMtx_get( fdir, manuf, scan_number ):
 
         bval_f_list = [s  for s in f_list  if 'bvals' in s]
         if len(bval_f_list) > 1:
-            print("Error: found too many bval DTI files under subdir; I don't know what to do")
-            sys.exit()
+            raise Discovery_Error("Error: found too many bval DTI files under subdir; I don't know what to do")
 
         bvec_f_list = [s  for s in f_list  if 'bvecs' in s]
         if len(bvec_f_list) > 1:
-            print("Error: found too many bvec DTI files under subdir; I don't know what to do")
-            sys.exit()
+            raise Discovery_Error("Error: found too many bvec DTI files under subdir; I don't know what to do")
 
         key = 'bval_file'
         uFiles.update( dict( {key: bval_f_list[0]} ) )
@@ -698,7 +759,7 @@ def DTI_file_names_and_RegMtx_get( fdir, manuf, scan_number ):
         # extract  RegInfo.M_T1_to_T2 –> registration matrix for T1 to DTI
 
         path_to_search  =  fdir + '/*_corr_regT1_regT1.mat'
-        regmtx_f_list = glob.glob(path_to_search)
+        regmtx_f_list = Container_glob( fdir, path_to_search )
         regmtx_f_list = [s  for s in regmtx_f_list  if 'rev' not in s]
 
         if Verbose:
@@ -707,8 +768,7 @@ def DTI_file_names_and_RegMtx_get( fdir, manuf, scan_number ):
             print()
 
         if len(regmtx_f_list) <= 0:
-            print("Error: unable to find DTI registration-matrix file")
-            sys.exit()
+            raise Discovery_Error("Error: unable to find DTI registration-matrix file")
 
         if len(regmtx_f_list) > 1:
             print("Warning: found more than one DTI registration-matrix files under subdir; taking first one")
@@ -718,23 +778,15 @@ def DTI_file_names_and_RegMtx_get( fdir, manuf, scan_number ):
         key = 'RegMtx_file'
         uFiles.update( dict( {key: regmtx_f} ) )
 
-        # Read registration matrix from container and append it to output dictionary
-        RegMtx = {}
+        # Read registration matrix from container (once per file; see regmtx_cache.py) and append it to output dictionary
         key = 'RegistrationMatrix'
         uFiles.update( dict( {key: [] } ) )
 
-        try:
-            data = loadmat(regmtx_f, squeeze_me=True, struct_as_record=True)
-
-            Info = data['RegInfo']
-
-            # Read matrix as a Python ndarray
-            RegMtx = Info['M_T1_to_T2'].item()
-
-            uFiles.update( dict( {key: RegMtx.tolist() }))
-
-        except:
+        RegMtx = RegMtx_get( regmtx_f )
+        if RegMtx is None:
             print('Warning: unable to read registration matrix', regmtx_f )
+        else:
+            uFiles.update( dict( {key: RegMtx }))
 
         if Verbose:
             print('RegMtx:')
@@ -759,11 +811,9 @@ def DTI_file_names_and_RegMtx_get( fdir, manuf, scan_number ):
         f_n_max = 1
 
     if len(res_f_list) == 0:
-        print("Error: unable to find minimally-processed data for requested subject")
-        sys.exit()
+        raise Discovery_Error("Error: unable to find minimally-processed data for requested subject")
     if len(res_f_list) > f_n_max:
-        print("Error: found too many min.processed-series; I don't know what to do")
-        sys.exit()
+        raise Discovery_Error("Error: found too many min.processed-series; I don't know what to do")
     # -----------------------------------------------------------------------------------------------
 
     # # TEST
@@ -798,7 +848,7 @@ def FasTrk_files_names_get( Series, scan_number, subj, modality ):
         series_time = series_time.split('.')[0]
         event       = Series['EventName'][sn]
 
-        path_to_search  =  '/fast-track/*/NDAR' + subj + '_*' + series_time + '*'
+        path_to_search  =  FasTrk_root + '/*/NDAR' + subj + '_*' + series_time + '*'
         if Verbose:
             print( path_to_search )
 
@@ -858,29 +908,50 @@ def FasTrk_files_names_get( Series, scan_number, subj, modality ):
 
 # ========================================================================================================================================================
 # ---------------------------------------------------------------------------------------------------------------
-def Get_File_Names_and_Process_Info( subj, modality ):
-    Files = {}
+def Scantype_and_Path_get( modality ):
+    # Scan type, and prefix of the minimally-processed containers for this modality, from the global location of processed files.
+    # Returns empty strings for an unknown modality
+    scantype = ''
+    fpath    = ''
+
+    filoc = {}
+    with open(Dirs_Loc_fname, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            if row['ProjID'] == 'DAL_ABCD':
+                filoc = row
+                break
 
-    #-------------------------------------------------------------------------------------------
-    filoc = pd.read_csv( Dirs_Loc_fname, low_memory=False )
-    filoc = filoc[ filoc['ProjID'] == 'DAL_ABCD' ]
     if modality == 'T1':
         scantype = 'MPR'
-        fpath = filoc['proc'][0] + '/MRI'
+        fpath = filoc['proc'] + '/MRI'
 
     elif modality == 'T2':
         scantype = 'XetaT2'
-        fpath = filoc['proc'][0] + '/MRI'
+        fpath = filoc['proc'] + '/MRI'
 
     elif modality == 'dMRI':
         scantype = 'DTI'
-        fpath = filoc['proc_dti'][0] + '/DTI'
+        fpath = filoc['proc_dti'] + '/DTI'
 
     elif 'fMRI' in modality:
         scantype = 'BOLD'
-        fpath = filoc['proc_bold'][0] + '/BOLD'
+        fpath = filoc['proc_bold'] + '/BOLD'
 
-    else:
+    return scantype, fpath
+# ---------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------
+def Get_File_Names_and_Process_Info( subj, modality, records=False ):
+    # Runs of subj's series of modality: {'Run-01': {files and parameters}, ...}, or, with records, {'Run-01': Run_Record, ...}
+    # (run_record.py)
+    Files = {}
+    Catalogs.clear()    # Containers are listed again at each discovery
+
+    #-------------------------------------------------------------------------------------------
+    scantype, fpath  =  Scantype_and_Path_get( modality )
+
+    if not scantype:
         if Verbose:
             program_description()
             print('Error: Modality must be one of', modality_list )
@@ -992,6 +1063,8 @@ def Get_File_Names_and_Process_Info( subj, modality ):
         print('\n- - - - - - - - - Files: - - - - - - - - -')
         print( json.dumps( Files, sort_keys=True, indent=2 ) )
 
+    if records:
+        return Run_Records_from_Files( Files )
 
     return Files
 # ---------------------------------------------------------------------------------------------------------------
@@ -1004,7 +1077,11 @@ if __name__ == "__main__":
 
     subj, modality, Verbose  =  command_line_get_variables()
 
-    Files  =  Get_File_Names_and_Process_Info( subj, modality )
+    try:
+        Files  =  Get_File_Names_and_Process_Info( subj, modality )
+    except Discovery_Error as err:
+        print( err )
+        sys.exit()
 
     print( json.dumps( Files, sort_keys=True ) )
 # ========================================================================================================================================================
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import sys, os, json
+
+from share_errors import Input_Error
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Site configuration shared by series_process_info_get.py and share_min_proc_fMRI_dMRI_BOLD_T1T2.py.
+#
+# Defaults are the production locations. Any of them can be overridden by a .json file containing a dictionary with some
+# of the keys below; the file is taken from the environment variable MPROC_SHARE_CONFIG or, if that is not set,
+# from share_config.json in the current directory (where login_credentials.json and dataset_description.json also live).
+# A file with a syntax error, or a MPROC_SHARE_CONFIG file that does not exist, raises Input_Error (share_errors.py).
+# ---------------------------------------------------------------------------------------------------------------------------------
+Config_fname_default = 'share_config.json'
+
+Config_defaults = {
+    # Discovery
+    'Dirs_Loc_fname':   '/home/abcdproc1/ProjInfo/MMIL_ProjInfo.csv',
+    'PCInfo_fname':     '/home/abcdproc1/MetaData/DAL_ABCD/DAL_ABCD_pcinfo.csv',
+    'FasTrk_root':      '/fast-track',
+    'Index_dir':        '',              # Where lookup_index.py keeps <table>.index.sqlite; '' = next to each table
+
+    'RegMtx_cache_fname': 'regmtx_cache.sqlite',   # Registration matrices read so far (regmtx_cache.py); '' = in memory only
+
+    # Conversion
+    'mri_convert_cmd':  '/usr/pubsw/packages/freesurfer/RH4-x86_64-R600/bin/mri_convert',
+    'Scratch_root':     '/tmp',          # Per-process and per-run directories for uncompressed images (scratch.py)
+    'Conversion_cache_dir':   '',        # Converted images kept for reruns (conversion_cache.py); '' = no cache
+    'Conversion_cache_bytes': 200 * 2**30,   # Least recently used entries are removed beyond this size
+
+    # Disk budgets (disk_budget.py); 0 = no limit. With an output-directory budget, archives are removed once uploaded
+    'Scratch_budget_bytes': 0,
+    'Outdir_budget_bytes':  0,
+    'Budget_db_fname':      'disk_budget.sqlite',   # Reservations shared by all processes of the host; relative: under Scratch_root
+    'Budget_wait_s':        3600,                   # Give up on a run after waiting this long for space
+
+    # miNDA record upload
+    'miNDA_url':        'https://ndar.nih.gov/api/mindar/import',
+    'miNDA_verify':     True,            # True, False, or path to a CA bundle (e.g. the certificate of a stand-in server)
+
+    # AWS-s3 upload
+    'AWS_bucket':       's3://abcd-mproc-patch/',
+    'AWS_cmd':          '/home/oruiz/.local/bin/aws',
+    'AWS_endpoint_url': '',              # e.g. http://127.0.0.1:9000 for an S3-compatible stand-in
+
+    # Limits shared by all processes of the host (rate_limit.py); 0 = no limit. Adjustable while running: ./rate_limit.py --set
+    'S3_admit_bytes_per_s': 0,            # Average rate at which uploads are started, not the speed of one
+    'miNDA_requests_per_s': 0,
+    'miNDA_max_concurrent': 0,
+    'Limits_db_fname':      'rate_limits.sqlite',   # Relative: under Scratch_root
+
+    # Log (share_log.py): JSON lines, written by one listener per pool or process
+    'Log_fname':  '',                    # '' = share_min_proc_data.jsonl next to the scripts
+    'Log_quiet':  False,                 # Do not print the tables and records of each run (as --quiet)
+
+    # Batch progress (share_progress.py)
+    'Progress_interval_s':   60,             # Between reports of share_pool.py; 0 = no reports
+    'Progress_textfile_dir': '',             # node_exporter textfile collector directory for mproc_share_<site>.prom; '' = none
+
+    # Campaigns of many sites and modalities (campaign.py): most tasks at once reading or writing each file-system root
+    'Campaign_fs_tasks': {},                 # e.g. {"/space/md8/proc_bold": 6, "/fast-track": 16, "/mproc": 12}
+    'Campaign_fs_tasks_default': 0,          # Roots not listed; 0 = no cap
+}
+
+Configs = {}            # Configuration file name -> configuration read from it (Share_Config_Get)
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Share_Config_Get( fname='' ):
+    # Defaults updated with the contents of the configuration file, if one exists. The file is read once per process (and
+    # inherited by forked workers), so callers in per-run and polling loops cost no I/O and see the same values for a whole
+    # batch; each call returns its own copy.
+    if not fname:
+        fname = os.environ.get( 'MPROC_SHARE_CONFIG', Config_fname_default )
+
+    if fname not in Configs:
+        Configs[ fname ] = Share_Config_Read( fname )
+    return dict( Configs[ fname ] )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Share_Config_Read( fname ):
+    Config = dict( Config_defaults )
+
+    if os.path.isfile( fname ):
+        try:
+            with open(fname, 'r') as f:
+                Config.update( json.load(f) )
+        except ValueError as err:
+            raise Input_Error('Error: syntax error in configuration file %s: %s' % (fname, err)) from err
+
+    elif 'MPROC_SHARE_CONFIG' in os.environ:
+        raise Input_Error('Error: unable to find configuration file %s' % fname )
+
+    return Config
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Host_db_fname_get( key ):
+    # Database file shared by all processes of the host (configuration key): taken under Scratch_root when its name is relative,
+    # so that processes started from different directories (run_mproc_share.sh, cron, a campaign) find the same file
+    Config = Share_Config_Get()
+    return os.path.join( Config.get('Scratch_root', '/tmp') or '/tmp', Config[key] )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+    # Show the configuration in effect
+    try:
+        print( json.dumps( Share_Config_Get(), sort_keys=True, indent=2 ) )
+    except Input_Error as err:
+        print( err )
+        sys.exit(1)
+# ---------------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Errors of discovery and sharing, raised instead of ending the process, so that a batch or a long-lived process can share
+# many participants and record the failure of one run or participant without stopping:
+#
+#   Share_Error              Base of all of them; str(err) is the message the command line prints
+#     Discovery_Error        series_process_info_get.py: series, directories or files not found, ambiguous, or unreadable
+#     Input_Error            The participant's information, or a sidecar or events file of a run, is missing or invalid
+#     Conversion_Error       NIfTI conversion (mri_convert) or naming of the converted image failed
+#     Archive_Error          The BIDS data set cannot be built (e.g. it was already built and shared)
+#     Budget_Error           No disk space became available within the budget's wait (disk_budget.py)
+#     Upload_Error           miNDA or AWS-s3 cannot be used (e.g. no login credentials)
+#
+# The command-line scripts print the message and exit as before.
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+class Share_Error( Exception ):
+    pass
+
+class Discovery_Error( Share_Error ):
+    pass
+
+class Input_Error( Share_Error ):
+    pass
+
+class Conversion_Error( Share_Error ):
+    pass
+
+class Archive_Error( Share_Error ):
+    pass
+
+class Budget_Error( Share_Error ):
+    pass
+
+class Upload_Error( Share_Error ):
+    pass
+# ========================================================================================================================================================
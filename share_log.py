@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+import sys, os, json, time, socket, atexit, queue
+import logging, logging.handlers
+
+from share_config import Share_Config_Get
+import resource_usage
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Log of the share script: one JSON object per line ("Log_fname" in share_config.json; default share_min_proc_data.jsonl next to
+# the scripts), with the participant, modality, run and stage being processed (from resource_usage.py) in every record:
+#
+#   {"time": "2018-08-23T10:01:02.345", "level": "INFO", "host": "...", "pid": 1234, "subject": "INV028D3ELL", "modality": "dMRI",
+#    "run": "run-01", "stage": "bids_archive", "message": "..."}
+#
+# Processes never write the file from the code that logs: records go through a QueueHandler to a single writer. share_pool.py
+# starts a listener process before forking its workers (Log_Listener_Start), so the workers of a pool share it; a process
+# started on its own (run_mproc_share.sh) writes through a QueueListener thread of its own. Lines are appended, and the file
+# is reopened if it is moved away, so rotation is left to logrotate: size-based rotation by several writers is not safe.
+#
+# Quiet mode (--quiet, or "Log_quiet") skips printing, and so rendering, the tables and packages the share script shows for each
+# run (Show).
+# ---------------------------------------------------------------------------------------------------------------------------------
+Log_name = 'MyLogger'
+
+Host = socket.gethostname()
+
+Quiet = bool( Share_Config_Get().get('Log_quiet', False) )
+
+Listener = None        # QueueListener thread, or listener process, and the process that started it
+Listener_queue = None
+Listener_owner = 0
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Log_fname_get():
+    return Share_Config_Get().get('Log_fname', '') or os.path.join( os.path.dirname(os.path.abspath(__file__)), 'share_min_proc_data.jsonl' )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+class Context_Filter( logging.Filter ):
+    # Labels of what is being processed, added in the process that logs (the writer only sees the records)
+    def filter( self, record ):
+        record.host     = Host
+        record.subject  = resource_usage.Stage_labels.get('subject', '')
+        record.modality = resource_usage.Stage_labels.get('modality', '')
+        record.run      = resource_usage.Stage_current.get('bids_run', '')
+        record.stage    = resource_usage.Stage_current.get('stage', '')
+        return True
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+class JSON_Formatter( logging.Formatter ):
+    def format( self, record ):
+        rec = {'time':     time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + '.%03d' % record.msecs,
+               'level':    record.levelname,
+               'host':     getattr( record, 'host', '' ),
+               'pid':      record.process,
+               'subject':  getattr( record, 'subject', '' ),
+               'modality': getattr( record, 'modality', '' ),
+               'run':      getattr( record, 'run', '' ),
+               'stage':    getattr( record, 'stage', '' ),
+               'message':  record.getMessage()}
+        if record.exc_info:
+            rec['exception'] = self.formatException( record.exc_info )
+        return json.dumps( rec )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def file_handler_get( fname ):
+    handler = logging.handlers.WatchedFileHandler( fname )
+    handler.setFormatter( JSON_Formatter() )
+    return handler
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def queue_handler_set( q ):
+    log = logging.getLogger( Log_name )
+    log.setLevel( logging.DEBUG )
+    handler = logging.handlers.QueueHandler( q )
+    handler.addFilter( Context_Filter() )
+    log.addHandler( handler )
+    log.propagate = False
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def listener_main( q, fname ):
+    # Listener process: write the records of all processes of the pool, until None
+    handler = file_handler_get( fname )
+    while True:
+        try:
+            record = q.get()
+        except (EOFError, OSError, KeyboardInterrupt):
+            break
+        if record is None:
+            break
+        handler.handle( record )
+    handler.close()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Log_Listener_Start():
+    # In the parent of a worker pool, before forking the workers: a listener process that writes the log, and a queue to it
+    # that the workers inherit
+    global Listener, Listener_queue, Listener_owner
+    import multiprocessing
+    if Listener is not None:
+        return
+    ctx = multiprocessing.get_context( 'fork' )
+    Listener_queue = ctx.Queue()
+    Listener = ctx.Process( target=listener_main, args=(Listener_queue, Log_fname_get()), name='log listener', daemon=True )
+    Listener.start()
+    Listener_owner = os.getpid()
+    queue_handler_set( Listener_queue )
+    atexit.register( Log_Stop )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Log_Init():
+    # Log of a process started on its own; nothing to do in a pool worker, which inherits the queue to the pool's listener
+    global Listener, Listener_owner
+    log = logging.getLogger( Log_name )
+    if log.handlers:
+        return
+    q = queue.Queue()
+    Listener = logging.handlers.QueueListener( q, file_handler_get( Log_fname_get() ) )
+    Listener.start()
+    Listener_owner = os.getpid()
+    queue_handler_set( q )
+    atexit.register( Log_Stop )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Log_Stop():
+    # Write what is queued and stop the writer (only in the process that started it)
+    global Listener
+    if Listener is None or Listener_owner != os.getpid():
+        return
+    if isinstance( Listener, logging.handlers.QueueListener ):
+        Listener.stop()
+    else:
+        Listener_queue.put( None )
+        Listener.join( 10 )
+    Listener = None
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Quiet_Set( quiet ):
+    global Quiet
+    Quiet = quiet
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Quiet_get():
+    return Quiet
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Show( title, obj ):
+    # Print a table, record or package with its title, unless quiet (then obj is not even converted to text)
+    if Quiet:
+        return
+    print( title )
+    print( obj, '\n' )
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    # Show the last records of the log, optionally only those of one participant:  ./share_log.py  [Subject]  [N]
+    subject = sys.argv[1]  if len(sys.argv) > 1  else ''
+    nlast   = int( sys.argv[2] )  if len(sys.argv) > 2  else 50
+    fname = Log_fname_get()
+    if not os.path.isfile( fname ):
+        print('No log:', fname )
+        sys.exit()
+
+    records = []
+    with open(fname, 'r') as f:
+        for line in f:
+            try:
+                rec = json.loads( line )
+            except ValueError:
+                continue
+            if not subject or rec.get('subject') == subject.replace('NDAR_', ''):
+                records.append( rec )
+
+    for rec in records[-nlast:]:
+        print('%s %-7s %-12s %-16s %-8s %-14s %s' % (rec['time'], rec['level'], rec['subject'], rec['modality'], rec['run'], rec['stage'], rec['message']) )
+# ========================================================================================================================================================
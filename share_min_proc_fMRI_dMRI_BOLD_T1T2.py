@@ -1,27 +1,42 @@
 #!/usr/bin/env python3
 
-import sys, getopt, os, tarfile, datetime, io
-import logging, logging.handlers
+import sys, getopt, os, tarfile, datetime, io, time, traceback
+import logging
 import subprocess, json
 import sqlite3
 
 import warnings
 warnings.simplefilter(action='ignore', category=UserWarning)
 # warnings.simplefilter(action='ignore', category=FutureWarning)
-import pandas as pd
-pd.set_option('display.width', 1024)
-pd.set_option('max_colwidth', 200)
 
-import requests
 import ast
 import csv
-from scipy.io import loadmat
 import math
 
 from series_process_info_get import Get_File_Names_and_Process_Info
+from resource_usage import Stage_Usage_Init, Stage_Start, Stage_End, Stage_Usage_Store
+from share_config import Share_Config_Get
+from lookup_index import Index_Open, NDA_Index_Lookup, NDA_index_columns
+from sidecars import Sidecars_Build, Motion_parse, Motion_TSV
+from regmtx_cache import RegMtx_get
+from archive_digest import Archive_Open, Digests_Store, Digests_Remove, base64_get, Manifest_fname_get, Series_mtime_get
+from s3_reconcile import Listing_Match
+from disk_budget import Reserve, Resize, Release, Release_All, Converted_size_estimate, Evict_uploaded, Archive_overhead
+import scratch
+from conversion_cache import Conversion_Key_get, Conversion_Cache_get, Conversion_Cache_put
+from rate_limit import Acquire, Slot_Acquire, Slot_Release
+from share_log import Log_Init, Log_name, Quiet_Set, Quiet_get, Show
+from share_errors import Share_Error, Discovery_Error, Input_Error, Conversion_Error, Archive_Error, Budget_Error, Upload_Error
+
+# pandas, requests and scipy.io are imported by the functions that use them (see pandas_get), so that printing usage,
+# and the lookups served by csv or by a lookup index (lookup_index.py), do not pay for them
 
 # ---------------------------------------------------------------------------------------------------------------------------------
-AWS_bucket  = 's3://abcd-mproc-patch/'
+Config = Share_Config_Get()
+
+AWS_bucket  = Config['AWS_bucket']
+
+AWS_single_put_max = 5 * 2**30    # Larger archives are uploaded in parts (aws s3 cp), without whole-object checksums
 
 modality_list = ['T1',    'T2',   'dMRI', 'fMRI_MID_task', 'fMRI_SST_task', 'fMRI_nBack_task', 'rsfMRI']
 scantype_list = ['MPR', 'XetaT2',  'DTI',     'BOLD',           'BOLD',           'BOLD',       'BOLD' ]
@@ -33,10 +48,25 @@ bidsufix_for_modality  =  dict( zip( modality_list, BIDSsufx_list) )
 NDAexpid_for_modality  =  dict( zip( modality_list, NDAexpid_list) )
 
 TEST_MODE = False    # Can be changed through command line
+
+log = logging.getLogger( Log_name )    # JSON-lines log through a queue (share_log.py), set up by Log_Init
 # ---------------------------------------------------------------------------------------------------------------------------------
 
 
 # ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def pandas_get():
+    import pandas as pd
+    if not pandas_get.options_set:
+        pd.set_option('display.width', 1024)
+        pd.set_option('max_colwidth', 200)
+        pandas_get.options_set = True
+    return pd
+
+pandas_get.options_set = False
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
 # ---------------------------------------------------------------------------------------------------------------------------------
 def show_program_description():
     print()
@@ -54,6 +84,7 @@ def show_program_description():
     print('Usage:')
     print('  ./share_min_proc_fMRI_dMRI_BOLD_T1T2.py  --subject Subject  --demog SubjsFile  --modality Modality  --NDAdb DB  --outdir OutDir  ')
     print('  ./share_min_proc_fMRI_dMRI_BOLD_T1T2.py  --subject Subject  --demog SubjsFile  --modality Modality  --NDAdb DB  --outdir OutDir  --nowrite')
+    print('  ./share_min_proc_fMRI_dMRI_BOLD_T1T2.py  --subject Subject  --demog SubjsFile  --modality Modality  --NDAdb DB  --outdir OutDir  [--nowrite]  --quiet')
     print()
     print('where:')
     print('  Subject     Subject ID (without "NDAR" or "NDAR_" prefix)' )
@@ -62,6 +93,7 @@ def show_program_description():
     print('  DB          Path to a local, previously downloaded, NDA fast-track database package')
     print('  OutDir      Local directory to store assemblied BIDS data sets before sharing them')
     print('  --nowrite   Test mode: go through the process without uploading data to AWS-s3 or NDA')
+    print('  --quiet     Do not print the tables and records of each run (subject, NDA and series information, miNDA packages)')
     print()
     print('Examples:')
     print('  ./share_min_proc_fMRI_dMRI_BOLD_T1T2.py  --subject INV028D3ELL  --demog ./Subjs_Year1_patch_DTI.csv  --modality dMRI  --NDAdb /home/oruiz/ABCD_Inventory/NDA_downloaded_packages/image03.txt  --outdir test  --nowrite')
@@ -84,6 +116,8 @@ def show_program_description():
     print('  mri_info                                       Output NIfTI files')
     print('  ~/.local/bin/aws s3 ls s3://abcd-mproc-patch   Data sets received by AWS-s3, belonging to the Year-1 patch') 
     print()
+    print('Locations of input files, mri_convert, miNDA and AWS-s3 endpoints can be changed in share_config.json (see share_config.py)')
+    print()
 # ---------------------------------------------------------------------------------------------------------------------------------
 
 # ---------------------------------------------------------------------------------------------------------------------------------
@@ -96,12 +130,12 @@ def command_line_get_variables():
     test_mode  = False
 
     # print("number of arguments found: %d\n" % len(sys.argv))
-    if len(sys.argv) < 11  or len(sys.argv) > 12:
+    if len(sys.argv) < 11  or len(sys.argv) > 13:
         show_program_description()
         sys.exit()
 
     try:
-        opts,args = getopt.getopt(sys.argv[1:],"hs:d:m:n:o:w",["subject=", "demog=", "modality=", "NDAdb=", "outdir=", "nowrite"])
+        opts,args = getopt.getopt(sys.argv[1:],"hs:d:m:n:o:wq",["subject=", "demog=", "modality=", "NDAdb=", "outdir=", "nowrite", "quiet"])
     except getopt.GetoptError as err:
         print("Error parsing arguments: %s" % str(err))
         show_program_description()
@@ -123,6 +157,8 @@ def command_line_get_variables():
             outdir = arg
         elif opt in ("-w", "--nowrite"):
             test_mode = True
+        elif opt in ("-q", "--quiet"):
+            Quiet_Set( True )
 
     outdir = os.path.abspath(outdir)
 
@@ -140,25 +176,40 @@ def command_line_get_variables():
 # ========================================================================================================================================================
 #                                               Functions used with all modalities
 
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Subjects_File_Preload( subjs_fname ):
+    # Keep the subjects file in memory, by pGUID (for worker processes forked after this; see share_pool.py)
+    subjs = {}
+    with open(subjs_fname, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            subjs.setdefault( row['pGUID'], [] ).append( row )
+    Subjects_tables[ subjs_fname ] = subjs
+    return len(subjs)
+
+Subjects_tables = {}
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
 # ---------------------------------------------------------------------------------------------------------------------------------
 def Subjects_File_Get_Subject( subject_id, subjs_fname ):
-    
-    subjs = pd.read_csv( subjs_fname, low_memory=False )
+    # Rows (dictionaries) of subject_id in the subjects file
+    if subjs_fname in Subjects_tables:
+        return [ dict(row)  for row in Subjects_tables[subjs_fname].get( subject_id, [] ) ]
 
-    return subjs[ subjs['pGUID'] == subject_id ]
+    with open(subjs_fname, 'r', newline='') as f:
+        return [ row  for row in csv.DictReader(f)  if row['pGUID'] == subject_id ]
 # ---------------------------------------------------------------------------------------------------------------------------------
 
 
 # ---------------------------------------------------------------------------------------------------------------------------------
 def Demog_Subject_Info_Get( subject_id, demog_file ):
+    pd = pandas_get()
 
     if os.path.exists( demog_file ):
         try:
             subjs = pd.read_json( demog_file )
         except ValueError:
-            print("Error: could not read demographics data from file")
-            log.error("Error: could not read demographics data from file")
-            sys.exit(0)
+            raise Input_Error("Error: could not read demographics data from file")
 
     return subjs[ subjs['pGUID'] == subject_id ][['pGUID', 'dob', 'gender']]
 # ---------------------------------------------------------------------------------------------------------------------------------
@@ -166,20 +217,32 @@ def Demog_Subject_Info_Get( subject_id, demog_file ):
 
 # ---------------------------------------------------------------------------------------------------------------------------------
 def NDA_db_Metadata_Get( db_fname, subject_id, FsTk_fname ):
-    rec = pd.DataFrame()
+    # Returns the matching record as a dictionary ({} if none)
+    rec = {}
     ok = True
     msg = ''
 
-    # Read select columns from fast-track data package downloaded from NDA
-    Series = pd.read_csv( db_fname, header=0, sep='\t', skiprows=[1], low_memory=False,
-                          usecols=["image03_id", "dataset_id",
-                                   "subjectkey", "interview_date", "interview_age", "gender",
-                                   "image_file",
-                                   "image_description",   # modality
-                                   "experiment_id",
-                                   'visit'] )
+    # Run resolved beforehand for a whole list of participants (bulk_resolution.py, through share_pool.py --bulk)
+    if (subject_id, FsTk_fname) in NDA_resolved:
+        rec, n_matches = NDA_resolved[ (subject_id, FsTk_fname) ]
+        if n_matches > 1:
+            msg = 'More than one FsTk file name match found in NDA database package; taking last entry. '
+        return dict(rec), ok, msg
+
+    # Rows of this subject from the index of the package (lookup_index.py) if there is a current one,
+    # otherwise read select columns from fast-track data package downloaded from NDA
+    conn = Index_Open( db_fname )
+    if conn:
+        Series = NDA_Index_Lookup( conn, subject_id )
+        conn.close()
+    else:
+        pd = pandas_get()
+        Series = pd.read_csv( db_fname, header=0, sep='\t', skiprows=[1], low_memory=False,
+                              usecols=NDA_index_columns )    # image03_id, dataset_id, subjectkey, interview_date, ..., image_description (modality)
 
-    Series = Series[ Series['subjectkey'] == subject_id ]
+        Series = Series[ Series['subjectkey'] == subject_id ].to_dict('records')
+        # numpy scalars -> Python values, as in records read from the index
+        Series = [ { k: (v.item() if hasattr(v, 'item') else v)  for k, v in r.items() }  for r in Series ]
 
     if not len(Series):
         ok = False
@@ -187,27 +250,27 @@ def NDA_db_Metadata_Get( db_fname, subject_id, FsTk_fname ):
         return rec, ok, msg
 
 
-    rec = Series[ [ FsTk_fname == os.path.basename(s)  for s in Series['image_file'] ] ]
+    matches = [ r  for r in Series  if FsTk_fname == os.path.basename( r['image_file'] ) ]
 
-    if not len(rec):
+    if not len(matches):
         ok = False
         msg = 'FsTk file name not found in NDA database package. '
         return rec, ok, msg
 
-    if len(rec) > 1:
+    if len(matches) > 1:
         msg = 'More than one FsTk file name match found in NDA database package; taking last entry. '
-        rec = rec.iloc[-1:]
+    rec = dict( matches[-1] )
 
     #                 Convert study date to NDA format
     # Record to upload requires format "04/06/2017 00:00:00", so convert
-    datetime_orig = rec['interview_date'].iat[0]
+    datetime_orig = rec['interview_date']
     dt_obj = datetime.datetime.strptime( datetime_orig, '%m/%d/%Y' )
     datetime_reformated = dt_obj.strftime( '%m/%d/%Y %H:%M:%S' )
-    # rec['interview_date'] = datetime_reformated
-    # rec.loc[:,'interview_date'] = datetime_reformated
-    rec['interview_date'].iat[0] = datetime_reformated
+    rec['interview_date'] = datetime_reformated
 
     return rec, ok, msg
+
+NDA_resolved = {}    # (pGUID, fast-track basename) -> (record, matches); see bulk_resolution.NDA_Records_from_Run_Table
 # ---------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -222,8 +285,7 @@ def NIfTI_file_create( procfname, fstkfname, type0, type_new, TR, TE, TI, FlipAn
     # Set output file name
     ss = fstkfname.split( type0 )
     if len(ss) != 2:
-        print('Error (share_min_proc): unable to construct NIfTI file name')
-        sys.exit(0)
+        raise Conversion_Error('Error (share_min_proc): unable to construct NIfTI file name')
 
     fname_image = ss[0] + type_new + ss[1]
 
@@ -238,11 +300,11 @@ def NIfTI_file_create( procfname, fstkfname, type0, type_new, TR, TE, TI, FlipAn
         if fxpos < 0:
             fname_bas = fname_image
         else:
-            print('Error (share_min_proc): invalid NIfTI file name')
-            sys.exit(0)
+            raise Conversion_Error('Error (share_min_proc): invalid NIfTI file name')
 
     if len(fname_bas) > 0:
-        fname_image = '/tmp/' + fname_bas + '.nii'
+        # In a directory of its own under the scratch root (scratch.py), removed with the image
+        fname_image = os.path.join( scratch.Run_Dir_Create( fname_bas ), fname_bas + '.nii' )
 
     print('Generating NIfTI file:', fname_image, ',  with updated TR (and trying to update also TE, TI, and FlipAngle).')
 
@@ -260,7 +322,7 @@ def NIfTI_file_create( procfname, fstkfname, type0, type_new, TR, TE, TI, FlipAn
     # I write them anyway, because there may be an extension one day,
     # and I will include all the parameteres in the .json file inside the BIDS data set
 
-    cmnd = '/usr/pubsw/packages/freesurfer/RH4-x86_64-R600/bin/mri_convert'
+    cmnd = Config['mri_convert_cmd']
 
     TRstr        = '%f' % TR
     TEstr        = '%f' % TE
@@ -272,6 +334,14 @@ def NIfTI_file_create( procfname, fstkfname, type0, type_new, TR, TE, TI, FlipAn
     else:
         cmnd_and_args = [cmnd,  '-i', procfname,  '-o', fname_image, '-tr', TRstr,  '-te', TEstr,
                          '-flip_angle', FlipAnglestr ]
+
+    # Same source and parameters as an earlier run: take its output from the conversion cache (conversion_cache.py)
+    cache_key = Conversion_Key_get( procfname, [ a  for a in cmnd_and_args  if a != fname_image ] )
+    if Conversion_Cache_get( cache_key, fname_image ):
+        print('NIfTI file taken from conversion cache:', cache_key )
+        print()
+        return fname_bas, fname_image
+
     print('Executing:', ' '.join( cmnd_and_args) )
 
     rs = subprocess.run( cmnd_and_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE )
@@ -279,8 +349,9 @@ def NIfTI_file_create( procfname, fstkfname, type0, type_new, TR, TE, TI, FlipAn
     rs_ok  = (rs.returncode == 0)
     rs_msg = rs.stdout.decode("utf-8")
     if not rs_ok:
-        print('Error (share_min_proc): unable to convert NIfTI file', procfname, 'to .mgz', fname_image )
-        sys.exit(0)
+        raise Conversion_Error('Error (share_min_proc): unable to convert NIfTI file %s to .mgz %s' % (procfname, fname_image))
+
+    Conversion_Cache_put( cache_key, fname_image, procfname )
 
     print()
 
@@ -290,6 +361,7 @@ def NIfTI_file_create( procfname, fstkfname, type0, type_new, TR, TE, TI, FlipAn
 
 # ---------------------------------------------------------------------------------------------------------------------------------
 def miNDA_record_upload( metadata ):
+    import requests
     miNDA_ok = False
     miNDA_msg = ''
 
@@ -298,14 +370,10 @@ def miNDA_record_upload( metadata ):
             try:
                 login_credentials = json.load(f)
             except ValueError:
-                print("Error: could not read miNDA login_credentials.json in the current directory or syntax error")
-                log.error("Error: could not read miNDA login_credentials.json in the current directory or syntax error")
-                sys.exit(0)
+                raise Upload_Error("Error: could not read miNDA login_credentials.json in the current directory or syntax error")
 
     except IOError:
-        print("share_min_proc_data.py: Error: unable to read login_credentials.json file in the current directory")
-        log.error("share_min_proc_data.py: Error: could not read login_credentials.json in the current directory")
-        sys.exit(0)
+        raise Upload_Error("share_min_proc_data.py: Error: unable to read login_credentials.json file in the current directory")
 
     username = login_credentials['miNDAR']['username']
     password = login_credentials['miNDAR']['password']
@@ -326,18 +394,30 @@ def miNDA_record_upload( metadata ):
 
 
     if TEST_MODE:
-        print('\npackage to upload to miNDA:')
-        print( json.dumps( package, sort_keys=True, indent=2 ) )
+        if not Quiet_get():
+            print('\npackage to upload to miNDA:')
+            print( json.dumps( package, sort_keys=True, indent=2 ) )
         miNDA_ok  = True
         miNDA_msg = "Here I would upload record to miNDA"
     else:
-        # Upload metadata package
-        res = requests.post( "https://ndar.nih.gov/api/mindar/import",
-                            auth=requests.auth.HTTPBasicAuth(username, password),
-                            headers={'content-type':'application/json'},
-                            data = json.dumps(package) )
-        miNDA_ok  = res.ok
-        miNDA_msg = res.text
+        # Upload metadata package, within the request rate and concurrency shared by all workers (rate_limit.py)
+        slot, waited = Slot_Acquire('minda')
+        waited += Acquire('minda_requests')
+        if waited:
+            print('Waited %.1f s for the miNDA limiters' % waited )
+        try:
+            res = requests.post( Config['miNDA_url'],
+                                auth=requests.auth.HTTPBasicAuth(username, password),
+                                headers={'content-type':'application/json'},
+                                data = json.dumps(package),
+                                verify = Config['miNDA_verify'] )
+            miNDA_ok  = res.ok
+            miNDA_msg = res.text
+        except requests.exceptions.RequestException as err:
+            miNDA_ok  = False
+            miNDA_msg = 'Unable to reach miNDA: %s' % str(err)
+        finally:
+            Slot_Release( slot )
 
         if not miNDA_ok:
             print('\npackage to upload to miNDA:')
@@ -349,17 +429,38 @@ def miNDA_record_upload( metadata ):
 
 
 # ---------------------------------------------------------------------------------------------------------------------------------
-def AWS_file_upload( filename ):
-    # AWS must be configured, in the computer running this process, with the appropriate credentials
+def AWS_file_upload( filename, digests=None ):
+    # AWS must be configured, in the computer running this process, with the appropriate credentials.
+    # With the digests computed while writing the file (archive_digest.py), it is sent in one PUT carrying Content-MD5 and
+    # x-amz-checksum-sha256, which S3 checks against what it receives before storing the object.
+    # An archive that the last bucket listing (s3_reconcile.py) shows there already, same size and MD5, is not sent again.
     s3_ok  = False
     s3_msg = ''
 
+    if Listing_Match( filename, AWS_bucket, digests ):
+        return True, 'Already in AWS-s3 with the same size and MD5 (s3_reconcile.py listing); not uploaded again'
+
+    if digests and digests['size'] <= AWS_single_put_max:
+        bucket, _, prefix = AWS_bucket[len('s3://'):].partition('/')
+        cmnd_and_args = [Config['AWS_cmd'], 's3api', 'put-object', '--bucket', bucket, '--key', prefix + os.path.basename(filename),
+                         '--body', filename,
+                         '--content-md5',     base64_get( digests['md5'] ),
+                         '--checksum-sha256', base64_get( digests['sha256'] )]
+    else:
+        cmnd_and_args = [Config['AWS_cmd'], 's3', 'cp', filename, AWS_bucket]
+    if Config['AWS_endpoint_url']:
+        cmnd_and_args += ['--endpoint-url', Config['AWS_endpoint_url']]
+
     if TEST_MODE:
-        print('Would execute', ' '.join(['/home/oruiz/.local/bin/aws', 's3', 'cp', filename, AWS_bucket]) )
+        print('Would execute', ' '.join(cmnd_and_args) )
         s3_ok  = True
         s3_msg = "Here I would upload data set to AWS-s3"
     else:
-        rs  =  subprocess.run( ['/home/oruiz/.local/bin/aws', 's3', 'cp', filename, AWS_bucket], stderr=subprocess.PIPE )
+        # Average upload rate shared by all workers (rate_limit.py): admits the upload, which then runs at full speed
+        waited = Acquire( 's3_admit_bytes', digests['size']  if digests  else os.path.getsize(filename) )
+        if waited:
+            print('Waited %.1f s for the AWS-s3 upload admission limiter' % waited )
+        rs  =  subprocess.run( cmnd_and_args, stderr=subprocess.PIPE )
         s3_ok  = (rs.returncode == 0)
         s3_msg = rs.stderr.decode("utf-8")
 
@@ -373,13 +474,12 @@ def createMetaDataDB( metadatadir, table_name, metadata ):
     sqlite_file = ''.join([metadatadir, '/', 'metadata.sqlite'])    # name of the sqlite database file
 
     # Connecting to the database file
-    conn = sqlite3.connect(sqlite_file)
+    conn = sqlite3.connect(sqlite_file, timeout=60)
     c = conn.cursor()
 
-    # Creating a new SQLite table
-    c.execute('CREATE TABLE {tn} (id INTEGER PRIMARY KEY)'.format(tn=table_name))
-    for key in metadata:
-        c.execute("ALTER TABLE {tn} ADD COLUMN '{cn}' {ct}".format(tn=table_name,cn=key,ct="TEXT"))
+    # Creating the table, if the database does not have it yet (stage_usage may have created the file first)
+    c.execute("CREATE TABLE IF NOT EXISTS {tn} (id INTEGER PRIMARY KEY, {cols})".format(
+              tn=table_name, cols=', '.join( "'{cn}' TEXT".format(cn=key)  for key in metadata )))
 
     # Committing changes and closing the connection to the database file
     conn.commit()
@@ -393,22 +493,22 @@ def addMetaData( metadatadir, table_name, metadata ):
     """
     sqlite_file = ''.join([metadatadir, '/', 'metadata.sqlite'])    # name of the sqlite database file
 
-    # if db does not exist already, create it
-    if not os.path.isfile(sqlite_file):
-            createMetaDataDB(metadatadir, table_name, metadata)
-            if not os.path.isfile(sqlite_file):
-                    print("share_min_proc_data.py: Error: Could not create a database file at %s" % sqlite_file)
-                    return
+    # if db, or its table, does not exist already, create it
+    try:
+        createMetaDataDB(metadatadir, table_name, metadata)
+    except sqlite3.Error as err:
+        print("share_min_proc_data.py: Error: Could not create table %s in %s: %s" % (table_name, sqlite_file, err))
+        return
 
-    # Connecting to the database file
+    # Connecting to the database file (shared with the stage_usage records of all workers, so wait for their writes)
     conn = 0
     try:
-        conn = sqlite3.connect(sqlite_file)
+        conn = sqlite3.connect(sqlite_file, timeout=60)
     except sqlite3.Error:
         print("share_min_proc_data.py: Warning: Could not connect to database file %s... wait and try again." % sqlite_file)
         time.sleep(1)
         try:
-                conn = sqlite3.connect(sqlite_file)
+                conn = sqlite3.connect(sqlite_file, timeout=60)
         except sqlite3.Error:
                 print("share_min_proc_data.py: Error: Could not connect to database file %s" % sqlite_file)
                 return
@@ -446,29 +546,26 @@ def addMetaData( metadatadir, table_name, metadata ):
 
 # ---------------------------------------------------------------------------------------------------------------------------------
 def motion_file_read( fname ):
-    motion = pd.read_csv( fname,  delim_whitespace=True,  header=None,  index_col=0,
-                          names=['t_indx', 'rot_z', 'rot_x', 'rot_y', 'trans_z', 'trans_x', 'trans_y', 'nothing1', 'nothing2'] )
-    motion = motion.drop( ['nothing1', 'nothing2'], axis='columns' )
-    return motion.to_csv( sep='\t' )
+    # Motion table as BIDS .tsv text (see sidecars.py)
+    motion, index_is_int, ok, msg = Motion_parse( fname )
+    if not ok:
+        raise ValueError( msg )
+    return Motion_TSV( motion, index_is_int ).decode('utf8')
 # ---------------------------------------------------------------------------------------------------------------------------------
 
 # ---------------------------------------------------------------------------------------------------------------------------------
 def registration_matrix_read( regmtx_f ):
-    RegMtx = []
-    try:
-        data = loadmat( regmtx_f, squeeze_me=True, struct_as_record=True )
-        Info = data['RegInfo']
-        # Read matrix as a Python ndarray
-        RegMtx = Info['M_T1_to_T2'].item()
-        RegMtx = RegMtx.tolist()
-    except:
+    # Read once per file for all runs and invocations (regmtx_cache.py)
+    RegMtx = RegMtx_get( regmtx_f )
+    if RegMtx is None:
         print('Warning: unable to read registration matrix', regmtx_f )
+        RegMtx = []
     return RegMtx
 # ---------------------------------------------------------------------------------------------------------------------------------
 
 
 # ---------------------------------------------------------------------------------------------------------------------------------
-def BIDS_file_check_and_name_parts( outdir, fname_bas, pGUID, visit, scantype ):
+def BIDS_file_check_and_name_parts( outdir, fname_bas, pGUID, visit, scantype, modality='' ):
     # Construct file name elements according to BIDS format standard
     outtarname  = ''
     subj        = ''
@@ -481,7 +578,8 @@ def BIDS_file_check_and_name_parts( outdir, fname_bas, pGUID, visit, scantype ):
 
     outtarname = ''.join([ outdir, os.path.sep, fname_bas, '.tgz' ])
 
-    if os.path.exists(outtarname):
+    if os.path.exists(outtarname) or os.path.exists( Manifest_fname_get(outtarname) ):
+        # An archive evicted after upload (disk_budget.py) leaves its manifest
         msg = "Error: BIDS file already exists: %s" % outtarname
         print( msg )
         log.error( msg )
@@ -532,7 +630,7 @@ def BIDS_file_check_and_name_parts( outdir, fname_bas, pGUID, visit, scantype ):
 # def BIDS_file_create_T1T2( outdir, fname_bas, fname_image, nda, scantype, registration_matrix, bvals, bvecs, duplicate ):
 
 def BIDS_file_create_T1T2( outdir, fname_bas, fname_image, pGUID, visit, scantype,
-                           run, TR, TE, TI, FlipAngle ):
+                           run, TR, TE, TI, FlipAngle, mtime=0 ):
 
     # Assembly and write tar file containing a structural(T1-or-T2)-MRI BIDS-complying data set
 
@@ -554,7 +652,7 @@ def BIDS_file_create_T1T2( outdir, fname_bas, fname_image, pGUID, visit, scantyp
     print( msg )
     log.info( msg )
 
-    tarout = tarfile.open( outtarname, 'w:gz' )
+    tarout = Archive_Open( outtarname, mtime )
     tarout.add( fname_image, arcname=imageName )
 
 
@@ -581,6 +679,7 @@ def BIDS_file_create_T1T2( outdir, fname_bas, fname_image, pGUID, visit, scantyp
 
     # Close data set package and return
     tarout.close()
+    Archive_digests[ outtarname ] = tarout.digests
 
     return True, outtarname
 # ---------------------------------------------------------------------------------------------------------------------------------
@@ -589,7 +688,7 @@ def BIDS_file_create_T1T2( outdir, fname_bas, fname_image, pGUID, visit, scantyp
 
 # ---------------------------------------------------------------------------------------------------------------------------------
 def BIDS_file_create_BOLD( outdir, fname_bas, fname_image, pGUID, visit, scantype, modality,
-                           motion_file, regis_file, event_file, run, TR, TE, FlipAngle ):
+                           motion_file, regis_file, event_file, run, TR, TE, FlipAngle, motion_tsv=None, mtime=0 ):
 
     # Assembly and write tar file containing a functional-MRI BIDS-complying data set
 
@@ -597,7 +696,7 @@ def BIDS_file_create_BOLD( outdir, fname_bas, fname_image, pGUID, visit, scantyp
     msg = ''
     res_ok = False
 
-    outtarname, subj, bids_visit, bids_type, bids_sufix, bids_sufix2, ok, msg  =  BIDS_file_check_and_name_parts( outdir, fname_bas, pGUID, visit, scantype )
+    outtarname, subj, bids_visit, bids_type, bids_sufix, bids_sufix2, ok, msg  =  BIDS_file_check_and_name_parts( outdir, fname_bas, pGUID, visit, scantype, modality )
     
     if not ok:
         outtarname = ''
@@ -611,7 +710,7 @@ def BIDS_file_create_BOLD( outdir, fname_bas, fname_image, pGUID, visit, scantyp
     print( msg )
     log.info( msg )
 
-    tarout = tarfile.open( outtarname, 'w:gz' )
+    tarout = Archive_Open( outtarname, mtime )
     tarout.add( fname_image, arcname=imageName )
 
 
@@ -629,13 +728,14 @@ def BIDS_file_create_BOLD( outdir, fname_bas, fname_image, pGUID, visit, scantyp
     # Add motion-correction table
     tsvfName  = "sub-%s/ses-%s/%s/sub-%s_ses-%s_task-%s_%s%s.tsv" % ( subj, bids_visit, bids_type,
                                                                       subj, bids_visit, bids_sufix2, run, '_motion' )
-    tsv_str = motion_file_read( motion_file )
+    if motion_tsv is None:
+        motion_tsv = motion_file_read( motion_file ).encode('utf8')
 
     print("Adding  %s  to  %s" % (tsvfName, outtarname) )
 
     tinfo = tarfile.TarInfo( name=tsvfName )
-    tinfo.size = len( tsv_str )
-    tarout.addfile( tinfo, io.BytesIO(tsv_str.encode('utf8')) )
+    tinfo.size = len( motion_tsv )
+    tarout.addfile( tinfo, io.BytesIO(motion_tsv) )
 
 
     # Add "meta information about the acquisition" as a json file containing:
@@ -665,6 +765,7 @@ def BIDS_file_create_BOLD( outdir, fname_bas, fname_image, pGUID, visit, scantyp
 
     # Close data set package and return
     tarout.close()
+    Archive_digests[ outtarname ] = tarout.digests
 
     return True, outtarname
 # ---------------------------------------------------------------------------------------------------------------------------------
@@ -673,7 +774,7 @@ def BIDS_file_create_BOLD( outdir, fname_bas, fname_image, pGUID, visit, scantyp
 
 # ---------------------------------------------------------------------------------------------------------------------------------
 def BIDS_file_create_DTI( outdir, fname_bas, fname_image, pGUID, visit, scantype, registration_matrix, bvals, bvecs, run,
-                          TR, TE, FlipAngle ):
+                          TR, TE, FlipAngle, bvals_bytes=None, bvecs_bytes=None, mtime=0 ):
     # Assembly and write a tar file containing a BIDS-complying directory structure
     # BIDS format specification is described in: http://bids.neuroimaging.io/bids_spec.pdf
 
@@ -695,7 +796,7 @@ def BIDS_file_create_DTI( outdir, fname_bas, fname_image, pGUID, visit, scantype
     print( msg )
     log.info( msg )
 
-    tarout = tarfile.open( outtarname, 'w:gz' )
+    tarout = Archive_Open( outtarname, mtime )
     tarout.add( fname_image, arcname=imageName )
 
 
@@ -706,21 +807,23 @@ def BIDS_file_create_DTI( outdir, fname_bas, fname_image, pGUID, visit, scantype
     # Add bvals file (2018jul30: do not transpose)
     bvalName = "sub-%s/ses-%s/%s/sub-%s_ses-%s_%s%s.bval" % ( subj, bids_visit, bids_type,
                                                               subj, bids_visit, run, bids_sufix )
-    with open(bvals, 'r') as f:
-        bvals_str = f.read()
+    if bvals_bytes is None:
+        with open(bvals, 'r') as f:
+            bvals_bytes = f.read().encode('utf8')
     tinfo = tarfile.TarInfo(name=bvalName)
-    tinfo.size = len(bvals_str)
-    tarout.addfile(tinfo, io.BytesIO(bvals_str.encode('utf8')))
+    tinfo.size = len(bvals_bytes)
+    tarout.addfile(tinfo, io.BytesIO(bvals_bytes))
 
 
     # Add bvecs file (2018jul30: do not transpose)
     bvecName = "sub-%s/ses-%s/%s/sub-%s_ses-%s_%s%s.bvec" % ( subj, bids_visit, bids_type,
                                                               subj, bids_visit, run, bids_sufix )
-    with open(bvecs, 'r') as f:
-        bvecs_str = f.read()
+    if bvecs_bytes is None:
+        with open(bvecs, 'r') as f:
+            bvecs_bytes = f.read().encode('utf8')
     tinfo = tarfile.TarInfo(name=bvecName)
-    tinfo.size = len(bvecs_str)
-    tarout.addfile(tinfo, io.BytesIO(bvecs_str.encode('utf8')))
+    tinfo.size = len(bvecs_bytes)
+    tarout.addfile(tinfo, io.BytesIO(bvecs_bytes))
 
 
     # Add "meta information about the acquisition" and registration matrix to accompanying .json file
@@ -741,422 +844,542 @@ def BIDS_file_create_DTI( outdir, fname_bas, fname_image, pGUID, visit, scantype
 
     # Close data set package and return
     tarout.close()
+    Archive_digests[ outtarname ] = tarout.digests
     return True, outtarname
+
+Archive_digests = {}    # outtarname -> digests computed while writing it (see archive_digest.py)
 # ---------------------------------------------------------------------------------------------------------------------------------
 # ========================================================================================================================================================
 
 
 
 # ========================================================================================================================================================
-if __name__ == "__main__":
+#                                         Share one participant and modality
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Run_Share( run_files, sidecar, bids_run, subject_id, subj_info, modality, db_fname, outdir ):
+    # Share one run of a participant (run_files: its Run_Record from Get_File_Names_and_Process_Info; sidecar: its entry of
+    # Sidecars_Build): convert, assemble the BIDS data set, upload it, and record it in metadata.sqlite.
+    # Returns {'run', 'status' ('ok' or 'failed': miNDA or AWS-s3 refused it), 'archive', 'miNDA_ok', 's3_ok', 'error', 'msg'};
+    # a run that cannot be shared raises a Share_Error (an upload that raises: Upload_Error, once its archive is removed).
+    pGUID       = 'NDAR_'+subject_id
+    scantype    = scantype_for_modality[modality]
+    metadatadir = outdir
+    print('bids_run =  ', bids_run)
 
-    # ---------------------------------------------- Initialize log -------------------------------------------------
-    lfn = ''.join([ os.path.dirname(os.path.abspath(__file__)), os.path.sep, '/share_min_proc_data.log' ])
-    log = logging.getLogger('MyLogger')
-    log.setLevel(logging.DEBUG)
-    handler = logging.handlers.RotatingFileHandler( lfn, maxBytes=1e+7, backupCount=5 )
-    handler.setFormatter(logging.Formatter('%(levelname)s:%(asctime)s: %(message)s'))
-    log.addHandler(handler)
     # ---------------------------------------------------------------------------------------------------------------
+    Proc_fname = run_files['MinProc_file']
+    print('Proc_fname: ', Proc_fname)
 
+    FsTk_fname = run_files['FasTrk_file_nopath']
+    if FsTk_fname:
+        if FsTk_fname == run_files['FasTrk_file_Guessed_Name']:
+            comment = '  (same as guessed file name)'
+        else:
+            comment = '  ( Different from guessed file name; using guessed )'
+            print('FsTk_fname: ', FsTk_fname, comment )
+            FsTk_fname = run_files['FasTrk_file_Guessed_Name']
+            comment = '  (guessed)'
+    else:
+        FsTk_fname = run_files['FasTrk_file_Guessed_Name']
+        comment = '  (guessed)'
+    print('FsTk_fname: ', FsTk_fname, comment )
+
+    motion_file         = ''
+    regis_file          = ''
+    event_file          = ''
+    registration_matrix = ''
+    bvals               = ''
+    bvecs               = ''
+
+    if scantype in ['MPR', 'XetaT2']:
+        pass
 
-    # -------------------------------------- Interpret command-line variables ---------------------------------------
+    elif scantype == 'BOLD':
+        motion_file    = run_files['Motion_file']
+        regis_file     = run_files['Regis_file']
+        if 'Event_file' in run_files.keys():
+            event_file = run_files['Event_file']
+        else:
+            event_file = ''
+        print('motion_file:', motion_file)
+        print('regis_file: ', regis_file)
+        print('event_file: ', event_file)
 
-    subject_id, subjs_file, modality, db_fname, outdir, test_mode  =  command_line_get_variables()
+        if modality != 'rsfMRI' and not event_file:
+            raise Input_Error("Error: task series require an events file, and we were unable to find it. ")
 
-    TEST_MODE = test_mode
-    pGUID     = 'NDAR_'+subject_id
-    scantype  = scantype_for_modality[modality]
-    metadatadir = outdir
-    # ---------------------------------------------------------------------------------------------------------------
+    elif scantype == 'DTI':
+        registration_matrix = run_files['RegistrationMatrix']
+        bvals               = run_files['bval_file']
+        bvecs               = run_files['bvec_file']
+        print('Reg.Matrix =', registration_matrix)
+        print('bvals:      ', bvals)
+        print('bvecs:      ', bvecs)
 
+    else:
+        raise Input_Error("Error: invalid scantype: %s. " % scantype)
 
-    # ------------------------------- Get demographics information for this subject ---------------------------------
 
-    try:
-        subj_info = Subjects_File_Get_Subject( pGUID, subjs_file )
-        print('subj_info:')
-        print( subj_info, '\n' )
-    except Exception as err:
-        msg = "Error: unable to find subject's information: %s. " % str(err)
-        print( msg, '\n')
-        sys.exit(0)
+    series_date = run_files['series_date']    # Used if we need to calculate interview date and age
+    # series_time = run_files['series_time']    # Used if we need to calculate interview date and age
+
+    TR = run_files['TR']
+    TE = run_files['TE']
+    if 'TI' in run_files.keys():
+        TI = run_files['TI']
+    else:
+        TI = None
+    FlipAngle = run_files['FlipAngle']
+    print('TR, TE, FlipAngle: ', TR, TE, FlipAngle )
+
+    if len(Proc_fname) <= 0:
+        raise Discovery_Error('Error: no image series to process')
     # ---------------------------------------------------------------------------------------------------------------
 
 
-    # ------------------------------------ Check existence of output directory --------------------------------------
-    if not os.path.exists(outdir):
-        print("Warning: output directory %s does not exist, try to create..." % outdir)
-        os.mkdir(outdir)
-        if not os.path.exists(outdir):
-            print("share_min_proc_data.py: Error: could not create output directory %s" % outdir)
-            log.error("share_min_proc_data.py: Error: could not create output directory %s" % outdir)
-            print()
-            sys.exit(0)
+    # --------------------- Link this mproc series with previously fast-track uploaded data, ------------------------
+    #                       through NDA key: image03_id
+
+    ser_info = dict( subj_info[0] )
+
+    stage = Stage_Start('nda_lookup', bids_run)
+    nda_fstk_record, nda_ok, msg  =  NDA_db_Metadata_Get( db_fname, pGUID, FsTk_fname )
+    Stage_End( stage )
+
+    if nda_ok:
+        print( msg )
+        Show('nda_fstk_record:', nda_fstk_record )
+        nda_id = nda_fstk_record.get('image03_id', '')
+
+    else:
+        nda_fstk_record = {}
+        nda_id = ''
+        # print('Error:', msg )
+        # print('  So we skip this series without creating any BIDS dataset nor uploading anything to NDA or AWS-s3')
         print()
-    # ---------------------------------------------------------------------------------------------------------------
+        msg = 'Warning: ' + msg + 'Using metadata from local sources: REDCap, Incoming.csv, and fixes. '
+        print( msg, '\n' )
 
+    ser_info['nda_id'] = nda_id
 
+    Show('ser_info:', ser_info )
     # ---------------------------------------------------------------------------------------------------------------
-    #             Get file names and additional information corresponding to this subject and modality:
-    #             minimally-processed series, fast-track file names, and parameters like
-    #             TR, TE, TI, FlipAngle, event_file, or registration matrix, depending on modality.
-    #             Assembly BIDS data sets, and upload records to miNDA and data sets to AWS-s3.
 
+
+    # ---------------------------------- Create temporary NIfTI image file ------------------------------------------
+    type0 = 'ABCD-'
+    minprc_type = 'ABCD-MPROC-'
+
+    # Space for the uncompressed image (disk_budget.py; waits while other runs hold the scratch budget)
+    label = '%s %s %s' % (subject_id, modality, bids_run)
+    stage = Stage_Start('scratch_reserve', bids_run)
+    scratch_rid = Reserve( 'scratch', Converted_size_estimate( Proc_fname ), label )
+    Stage_End( stage, status='ok' if scratch_rid is not None else 'error' )
+    if scratch_rid is None:
+        raise Budget_Error('Error: no scratch space for %s' % label)
+
+    stage = Stage_Start('nifti_convert', bids_run)
     try:
-        Proc_files = Get_File_Names_and_Process_Info( subject_id, modality )
-    except:
-        print('Error: unable to get series information\n')
-        sys.exit(0)
+        fname_bas, fname_image  =  NIfTI_file_create( Proc_fname, FsTk_fname, type0, minprc_type, TR, TE, TI, FlipAngle )
+    except Conversion_Error:
+        Stage_End( stage, status='error' )
+        raise
+    Stage_End( stage )
+
+    # 2018jul30: mri_convert can set TR in the NIfTI file, but not TE, TI, or FlipAngle.
+    # So I am including these variables in the .json file, below
+    # ---------------------------------------------------------------------------------------------------------------
 
 
-    print('db_fname:   ', db_fname)
-    print('outdir :    ', outdir)
-    print('metadatadir:', metadatadir,   ',   scantype:', scantype,  ',   Processing:', Proc_files.keys() )
+    # ---------------------------------------- Assembly BIDS object -------------------------------------------------
+    visit = ser_info['event_rc']
+    # visit = nda_fstk_record['visit']
 
-    if TEST_MODE:
-        print('TEST_MODE = ', TEST_MODE )
-        # print( json.dumps( Proc_files, sort_keys=True, indent=2 ) )
+    # Space for the archive in the output directory, until its upload is confirmed; at most the size of the image
+    stage = Stage_Start('outdir_reserve', bids_run)
+    outdir_rid = Reserve( 'outdir', os.path.getsize( fname_image ) + Archive_overhead, label )
+    Stage_End( stage, status='ok' if outdir_rid is not None else 'error' )
+    if outdir_rid is None:
+        scratch.Remove( os.path.dirname(fname_image) )
+        raise Budget_Error('Error: no output-directory space for %s' % label)
 
-    if len(Proc_files.keys()) <= 0:
-        print('No series to process from this subject')
-        sys.exit(0)
+    # Create a BIDS data set and incorporate the NIfTI file; its members are dated at the series' acquisition, so that
+    # building it again gives the same archive
+    archive_mtime = Series_mtime_get( series_date, run_files.get('series_time', ''), Proc_fname )
+    stage = Stage_Start('bids_archive', bids_run)
+    if scantype in ['MPR', 'XetaT2']:
 
+        res_ok, outtarname  =  BIDS_file_create_T1T2( outdir, fname_bas, fname_image, pGUID, visit, scantype,
+                                                      bids_run, TR, TE, TI, FlipAngle, mtime=archive_mtime )
+    elif scantype == 'BOLD':
 
-    for j in range(1, len(Proc_files.keys())+1 ):
-        print()
+        res_ok, outtarname  =  BIDS_file_create_BOLD( outdir, fname_bas, fname_image, pGUID, visit, scantype, modality,
+                                                      motion_file, regis_file, event_file, bids_run, TR, TE, FlipAngle,
+                                                      motion_tsv=sidecar['motion_tsv'], mtime=archive_mtime )
+    elif scantype == 'DTI':
+
+        res_ok, outtarname  =  BIDS_file_create_DTI( outdir, fname_bas, fname_image, pGUID, visit, scantype,
+                                                     registration_matrix, bvals, bvecs, bids_run,
+                                                     TR, TE, FlipAngle,
+                                                     bvals_bytes=sidecar['bvals'], bvecs_bytes=sidecar['bvecs'], mtime=archive_mtime )
+    else:
+        Stage_End( stage, status='error' )
+        raise Input_Error('Error: scantype %s not implemented here' % scantype)
+    Stage_End( stage, status='ok' if res_ok else 'error' )
+
+
+    # Remove temporary NIfTI file
+    print('Removing NIfTI file:', fname_image)
+    scratch.Remove( os.path.dirname(fname_image) )
+    Release( scratch_rid )
+
+    if not res_ok:
+        raise Archive_Error('Error: unable to assemble the BIDS data set of %s' % label)
+    Resize( outdir_rid, Archive_digests[outtarname]['size'] )
+
+    # Checksums of the archive and its members, computed while writing it: manifest and table archive_digests
+    Digests_Store( metadatadir, outtarname, Archive_digests[outtarname], TEST_MODE )
+    # ---------------------------------------------------------------------------------------------------------------
+
+
+    # ----------------------------- Record file upload metadata in local and NDA databases --------------------------
 
-        key = 'Run-%02.0f'%j
+    #      Assembly meta-data record to be saved to NDA and our local database
+    #      Use information from our local spreadsheets, file system, and image files' metadata;
+    #      additional info from fast-track NDA database, and NDA data dictionary
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Calculate or set metadata for current image series, scanning scantype, and processing stage
+
+    # NDA: Data Dictionary: Title:      Processed MRI Data
+    # NDA: Data Dictionary: Short Name: fmriresults01
+
+    # NDA requires date format "04/06/2017 00:00:00". This format is set in NDA_db_Metadata_Get()
+
+    # Experiment ID is empty for structural imaging. For fMRI, a number will be provided by the NDA dictionary after we create new experiment types.
+    # After all, we decided not to create new experiment types, but to use the existent ids. To see them:
+    #   https://ndar.nih.gov/user/dashboard/collections.html
+    #   username > Collections > Title = Adolesc... > Experiments
+
+    # Type of scan value must be one of these:
+    #   MR diffusion; fMRI; MR structural (MPRAGE); MR structural (T1); MR structural (PD); MR structural (FSPGR); MR structural (FISP); MR structural (T2);
+    #   PET; ASL; microscopy; MR structural (PD, T2); MR structural (B0 map); MR structural (B1 map); single-shell DTI; multi-shell DTI; Field Map;
+    #   X-Ray; static magnetic field B0
+    # There are not values for minimally-processed data, we will use the closest "normal" types. For example, for min-proc T1, exp_scan = 'MR structural (T1)'
+
+    # We are using  session_det  to describe the data processing stage (none = fast-track,  minimally-processed,  processed, ...)
+    # and  image_history  to summarize the process
+
+    if scantype == 'MPR':
+        exp_id = ''
+        exp_scan      = 'MR structural (T1)'
+        session_det   = 'ABCD-MPROC-T1'
+        image_history = 'gradient unwarp, B1 inhomogeneity correction, resampled to 1mm^3 isotropic in LIA rigid body registration to non-MNI atlas'
+
+    elif scantype == 'XetaT2':
+        exp_id = ''
+        exp_scan      = 'MR structural (T2)'
+        session_det   = 'ABCD-MPROC-T2'
+        image_history = 'gradient unwarp, B1 inhomogeneity correction, resampled to 1mm^3 isotropic in LIA rigid body registration to non-MNI atlas'
+
+    elif scantype == 'BOLD':
+        exp_id      = NDAexpid_for_modality[modality]
+        exp_scan    = 'fMRI'
+        session_det = 'ABCD-MPROC-' + bidsufix_for_modality[modality].upper()
+        image_history = 'motion correction, B0 inhomogeneity correction, gradient unwarp, between scan motion correction, and resampling to 2.4mm^3 (requires rigid registration to T1 - see included json for matrix values)'
+
+    elif scantype == 'DTI':
+        exp_id = ''
+        exp_scan      = 'multishell DTI'
+        session_det   = 'ABCD-MPROC-DTI'
+        image_history = 'eddy-current correction, motion correction, B0 inhomogeneity correction, gradient unwarp, replacement of bad slice-frames, between scan motion correction, rigid body registration to atlas and resampling to 1.7mm^3 LPI (requires rigid registration to T1 - see included json for matrix values)'
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    if nda_fstk_record:
+        dataset_id     = '0' if nda_fstk_record['dataset_id'] == ''  else  nda_fstk_record['dataset_id']
+        interview_date = nda_fstk_record['interview_date']
+        interview_age  = nda_fstk_record['interview_age']
+        if 'image_file' in nda_fstk_record:
+            image_file = nda_fstk_record['image_file']
+        else:
+            image_file = 's3://nda-abcd/' + FsTk_fname
+
+    else:
+        # The associated fast-track data record was not found in NDA.
+        # We use then metadata from our local sources: REDCap, Incoming.csv, and fixes.'
+        dataset_id = '0'
+
+        # Construct interview date like in anonymizer.sh
+        interview_date = '%s/%s/%s' % (series_date[4:6], series_date[6:8], series_date[0:4]) + ' 00:00:00'
+        bday = datetime.datetime.strptime( ser_info['dob'], '%Y-%m-%d')
+        sday = datetime.datetime.strptime( series_date,  '%Y%m%d')
+        interview_age = ("%.1f" % ((sday-bday).days/365.25))
+        interview_age = '%.0f' % round( float(interview_age)*12 )
 
         if TEST_MODE:
-            print('key =', key )
-            # print( Proc_files[key] )
+            print('series_date:', series_date )
+            print('bday:', bday )
+            print('sday:', sday )
+
+        image_file = 's3://nda-abcd/' + FsTk_fname
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    # Assembly NDA-complying meta-data record (according to specifications in fmriresults01_definitions-2.csv)
+    record = {"subjectkey":      pGUID,
+            "src_subject_id":    pGUID,
+            "origin_dataset_id": dataset_id,
+            "interview_date":    interview_date,
+            "interview_age":     interview_age,
+            "gender":            ser_info['gender'],
+            "experiment_id":     exp_id,
+            "inputs":            'ABCD Fast-Track image data release for baseline assessments',
+            "img03_id":          ser_info['nda_id'],   # row_id in image03 data structure, mapping derivative to source record in image03. Recommended
+            "file_source":       image_file,           # Required
+            "job_name":          '',
+            "proc_types":        '',
+            "metric_files":      '',
+            "pipeline":          'MMPS version 248',
+            "pipeline_script":   'MMIL_Preproc',
+            "pipeline_tools":    'MMPS',
+            "pipeline_type":     'MMPS',
+            "pipeline_version":  '248',
+            "qc_fail_quest_reason": '',
+            "qc_outcome":        'pass',
+            "derived_files": AWS_bucket + fname_bas + '.tgz',   # Archive of the files produced by the pipeline. Required
+            "scan_type":     exp_scan,                          # Required
+            "img03_id2":     '',
+            "file_source2":  '',
+            "session_det":   session_det,              # Session details. Recommended
+            "image_history": image_history }
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # ---------------------------------------------------------------------------------------------------------------
 
-        if key in Proc_files.keys():
-            bids_run = key.lower()
-            print('bids_run =  ', bids_run)
 
-            # ---------------------------------------------------------------------------------------------------------------
-            Proc_fname = Proc_files[key]['MinProc_file']
-            print('Proc_fname: ', Proc_fname)
-
-            FsTk_fname = Proc_files[key]['FasTrk_file_nopath']
-            if FsTk_fname:
-                if FsTk_fname == Proc_files[key]['FasTrk_file_Guessed_Name']:
-                    comment = '  (same as guessed file name)'
-                else:
-                    comment = '  ( Different from guessed file name; using guessed )'
-                    print('FsTk_fname: ', FsTk_fname, comment )
-                    FsTk_fname = Proc_files[key]['FasTrk_file_Guessed_Name']
-                    comment = '  (guessed)'
-            else:
-                FsTk_fname = Proc_files[key]['FasTrk_file_Guessed_Name']
-                comment = '  (guessed)'
-            print('FsTk_fname: ', FsTk_fname, comment )
+    # ------------------------------ Upload record to miNDA and BIDS strucutre to AWS -------------------------------
 
-            motion_file         = ''
-            regis_file          = ''
-            event_file          = ''
-            registration_matrix = ''
-            bvals               = ''
-            bvecs               = ''
-
-            if scantype in ['MPR', 'XetaT2']:
-                pass
-
-            elif scantype == 'BOLD':
-                motion_file    = Proc_files[key]['Motion_file']
-                regis_file     = Proc_files[key]['Regis_file']
-                if 'Event_file' in Proc_files[key].keys():
-                    event_file = Proc_files[key]['Event_file']
-                else:
-                    event_file = ''
-                print('motion_file:', motion_file)
-                print('regis_file: ', regis_file)
-                print('event_file: ', event_file)
-
-                if modality != 'rsfMRI' and not event_file:
-                    print()
-                    msg = "Error: task series require an events file, and we were unable to find it. "
-                    print( msg, '\n')
-                    sys.exit(0)
-
-            elif scantype == 'DTI':
-                registration_matrix = Proc_files[key]['RegistrationMatrix']
-                bvals               = Proc_files[key]['bval_file']
-                bvecs               = Proc_files[key]['bvec_file']
-                print('Reg.Matrix =', registration_matrix)
-                print('bvals:      ', bvals)
-                print('bvecs:      ', bvecs)
+    # An upload that raises (no aws command, no credentials, a network exception) fails the run like a refused one, so its
+    # archive is removed below and a rerun can build it again; the error is raised as an Upload_Error once the run is recorded
+    upload_error = None
 
-            else:
-                msg = "Error: invalid scantype: %s. " % scantype
-                print( msg, '\n')
-                sys.exit(0)
+    stage = Stage_Start('minda_upload', bids_run)
+    try:
+        miNDA_ok, miNDA_msg  =  miNDA_record_upload( record )
+    except Exception as err:
+        miNDA_ok, miNDA_msg, upload_error  =  False, 'miNDA upload failed: %s: %s' % (type(err).__name__, err), err
+    Stage_End( stage, status='ok' if miNDA_ok else 'error' )
 
+    print('\nmiNDA_ok =', miNDA_ok)
+    print(  'miNDA_msg:', miNDA_msg, '\n')
 
-            series_date = Proc_files[key]['series_date']    # Used if we need to calculate interview date and age
-            # series_time = Proc_files[key]['series_time']    # Used if we need to calculate interview date and age
+    if miNDA_ok:
+        stage = Stage_Start('s3_upload', bids_run)
+        try:
+            s3_ok, s3_msg  =  AWS_file_upload( outtarname, Archive_digests.get(outtarname) )
+        except Exception as err:
+            s3_ok, s3_msg, upload_error  =  False, 'AWS-s3 upload failed: %s: %s' % (type(err).__name__, err), err
+        Stage_End( stage, status='ok' if s3_ok else 'error' )
+    else:
+        # Unable to upload record to miNDA
+        s3_ok  = ''
+        s3_msg = 'AWS-s3 not attempted because miNDA upload failed'
 
-            TR = Proc_files[key]['TR']
-            TE = Proc_files[key]['TE']
-            if 'TI' in Proc_files[key].keys():
-                TI = Proc_files[key]['TI']
-            else:
-                TI = None
-            FlipAngle = Proc_files[key]['FlipAngle']
-            print('TR, TE, FlipAngle: ', TR, TE, FlipAngle )
+    print('s3_ok =', s3_ok)
+    print('s3_msg:', s3_msg)
 
-            if len(Proc_fname) <= 0:
-                print('Error: no image series to process')
-                sys.exit(0)
-            # ---------------------------------------------------------------------------------------------------------------
+    if not miNDA_ok or not s3_ok:
+        print('Removing BIDS container:', outtarname )  # So we don't have to remove it manually when re-running the process
+        try:
+            os.remove( outtarname )
+        except Exception as e:
+            print('Error: unable to remove file', outtarname, e)
+        Digests_Remove( outtarname )
 
+    elif Evict_uploaded() and not TEST_MODE:
+        print('Removing uploaded BIDS container:', outtarname )  # Keeps the output directory within its disk budget
+        try:
+            os.remove( outtarname )
+        except Exception as e:
+            print('Error: unable to remove file', outtarname, e)
+    Release( outdir_rid )
+    # ---------------------------------------------------------------------------------------------------------------
 
-            # --------------------- Link this mproc series with previously fast-track uploaded data, ------------------------
-            #                       through NDA key: image03_id
 
-            ser_info = subj_info.copy()
+    # ----------------------------------- Upload record to local SQLite database ------------------------------------
+    local_db_table = 'fmriresults01'
 
-            nda_fstk_record, nda_ok, msg  =  NDA_db_Metadata_Get( db_fname, pGUID, FsTk_fname )
+    local_record = record
 
-            if nda_ok:
-                print( msg )
-                print('nda_fstk_record:')
-                print( nda_fstk_record )
-                if len( nda_fstk_record ):
-                    nda_id = nda_fstk_record['image03_id'].item()
-                else:
-                    nda_id = ''
-                # Convert record (one-row Pandas DataFrame) to a dictionary, to simplify variable extraction below
-                nda_fstk_record = nda_fstk_record.to_dict( 'records')[0]
-                print()
+    local_record['miNDA_ok']  = miNDA_ok
+    local_record['miNDA_msg'] = miNDA_msg
+    local_record['miNDA_msg'] = local_record['miNDA_msg'].replace('\"','')
+    local_record['miNDA_msg'] = local_record['miNDA_msg'].replace('\'','')
 
-            else:
-                nda_fstk_record = {}
-                nda_id = ''
-                # print('Error:', msg )
-                # print('  So we skip this series without creating any BIDS dataset nor uploading anything to NDA or AWS-s3')
-                print()
-                msg = 'Warning: ' + msg + 'Using metadata from local sources: REDCap, Incoming.csv, and fixes. '
-                print( msg, '\n' )
+    local_record['s3_ok']  = s3_ok
+    local_record['s3_msg'] = s3_msg
+    local_record['s3_msg'] = local_record['s3_msg'].replace('\"','')
+    local_record['s3_msg'] = local_record['s3_msg'].replace('\'','')
 
-            ser_info['nda_id'] = nda_id
+    addMetaData( metadatadir, local_db_table, local_record )
 
-            print('ser_info:')
-            print( ser_info, '\n' )
+    # Per-stage resource usage of this run, to table stage_usage of the same database
+    Stage_Usage_Store( metadatadir )
+    # ---------------------------------------------------------------------------------------------------------------
 
-            # Convert ser_info (one-row Pandas DataFrame) to a dictionary, to simplify variable extraction below
-            ser_info = ser_info.to_dict('records')[0]
-            # ---------------------------------------------------------------------------------------------------------------
+    if isinstance( upload_error, Upload_Error ):
+        raise upload_error
+    if upload_error is not None:
+        raise Upload_Error( 'Error: upload of %s failed: %s: %s' % (outtarname, type(upload_error).__name__, upload_error) ) from upload_error
 
+    return {'run': bids_run, 'status': 'ok'  if miNDA_ok and s3_ok  else 'failed', 'archive': outtarname,
+            'miNDA_ok': bool(miNDA_ok), 's3_ok': bool(s3_ok), 'error': '', 'msg': ''  if miNDA_ok and s3_ok  else (s3_msg or miNDA_msg)}
+# ---------------------------------------------------------------------------------------------------------------------------------
 
-            # ---------------------------------- Create temporary NIfTI image file ------------------------------------------
-            type0 = 'ABCD-'
-            minprc_type = 'ABCD-MPROC-'
 
-            fname_bas, fname_image  =  NIfTI_file_create( Proc_fname, FsTk_fname, type0, minprc_type, TR, TE, TI, FlipAngle )
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Subject_Share( subject_id, subjs_file, modality, db_fname, outdir, test_mode=False, plan_runs=None ):
+    # Find the series of one participant and modality, assemble their BIDS data sets, upload records to miNDA and data sets
+    # to AWS-s3, and record the results in metadata.sqlite. Returns {'subject', 'modality', 'runs': [result of Run_Share, ...]}.
+    # plan_runs, {'Run-01': Run_Record, ...} from a share plan (share_plan.py), are shared instead of the runs of discovery.
+    # Errors of the participant (information, discovery) raise a Share_Error (share_errors.py); the error of one run, including
+    # its invalid sidecar inputs, is recorded in its result ('status': 'error', 'error': exception type, 'msg') and the other
+    # runs go on.
+    global TEST_MODE
+
+    # ------------------------------------------------ Set variables ------------------------------------------------
+    TEST_MODE = test_mode
+    pGUID     = 'NDAR_'+subject_id
+    scantype  = scantype_for_modality[modality]
+    metadatadir = outdir
 
-            # 2018jul30: mri_convert can set TR in the NIfTI file, but not TE, TI, or FlipAngle.
-            # So I am including these variables in the .json file, below
-            # ---------------------------------------------------------------------------------------------------------------
+    Stage_Usage_Init( metadatadir, subject_id, modality )
+    # ---------------------------------------------------------------------------------------------------------------
 
 
-            # ---------------------------------------- Assembly BIDS object -------------------------------------------------
-            visit = ser_info['event_rc']
-            # visit = nda_fstk_record['visit']
+    # ------------------------------- Get demographics information for this subject ---------------------------------
 
-            # Create a BIDS data set and incorporate the NIfTI file
-            if scantype in ['MPR', 'XetaT2']:
+    stage = Stage_Start('subject_info')
+    try:
+        subj_info = Subjects_File_Get_Subject( pGUID, subjs_file )
+        if not subj_info:
+            raise ValueError('%s not in %s' % (pGUID, subjs_file))
+        Show('subj_info:', subj_info )
+    except Exception as err:
+        Stage_End( stage, status='error' )
+        raise Input_Error("Error: unable to find subject's information: %s. " % str(err)) from err
+    Stage_End( stage )
+    # ---------------------------------------------------------------------------------------------------------------
 
-                res_ok, outtarname  =  BIDS_file_create_T1T2( outdir, fname_bas, fname_image, pGUID, visit, scantype,
-                                                              bids_run, TR, TE, TI, FlipAngle )
-            elif scantype == 'BOLD':
 
-                res_ok, outtarname  =  BIDS_file_create_BOLD( outdir, fname_bas, fname_image, pGUID, visit, scantype, modality,
-                                                              motion_file, regis_file, event_file, bids_run, TR, TE, FlipAngle )
-            elif scantype == 'DTI':
+    # ------------------------------------ Check existence of output directory --------------------------------------
+    if not os.path.exists(outdir):
+        print("Warning: output directory %s does not exist, try to create..." % outdir)
+        try:
+            os.mkdir(outdir)
+        except OSError as err:
+            raise Archive_Error("share_min_proc_data.py: Error: could not create output directory %s: %s" % (outdir, err)) from err
+        print()
+    # ---------------------------------------------------------------------------------------------------------------
 
-                res_ok, outtarname  =  BIDS_file_create_DTI( outdir, fname_bas, fname_image, pGUID, visit, scantype,
-                                                             registration_matrix, bvals, bvecs, bids_run,
-                                                             TR, TE, FlipAngle )
-            else:
-                print('Error: scantype', scantype, 'not implemented here')
-                print()
-                sys.exit(0)
 
+    # ---------------------------------------------------------------------------------------------------------------
+    #             Get file names and additional information corresponding to this subject and modality:
+    #             minimally-processed series, fast-track file names, and parameters like
+    #             TR, TE, TI, FlipAngle, event_file, or registration matrix, depending on modality.
+    #             Assembly BIDS data sets, and upload records to miNDA and data sets to AWS-s3.
 
-            # Remove temporary NIfTI file
-            print('Removing NIfTI file:', fname_image)
-            try:
-                os.remove( fname_image )
-            except Exception as e:
-                print('Error: unable to remove temporary file', fname_image, e)
-
-            if not res_ok:
-                print()
-                sys.exit(0)
-            # ---------------------------------------------------------------------------------------------------------------
-
-
-            # ----------------------------- Record file upload metadata in local and NDA databases --------------------------
-
-            #      Assembly meta-data record to be saved to NDA and our local database
-            #      Use information from our local spreadsheets, file system, and image files' metadata;
-            #      additional info from fast-track NDA database, and NDA data dictionary
-
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            # Calculate or set metadata for current image series, scanning scantype, and processing stage
-
-            # NDA: Data Dictionary: Title:      Processed MRI Data
-            # NDA: Data Dictionary: Short Name: fmriresults01
-
-            # NDA requires date format "04/06/2017 00:00:00". This format is set in NDA_db_Metadata_Get()
-
-            # Experiment ID is empty for structural imaging. For fMRI, a number will be provided by the NDA dictionary after we create new experiment types.
-            # After all, we decided not to create new experiment types, but to use the existent ids. To see them:
-            #   https://ndar.nih.gov/user/dashboard/collections.html
-            #   username > Collections > Title = Adolesc... > Experiments
-
-            # Type of scan value must be one of these:
-            #   MR diffusion; fMRI; MR structural (MPRAGE); MR structural (T1); MR structural (PD); MR structural (FSPGR); MR structural (FISP); MR structural (T2);
-            #   PET; ASL; microscopy; MR structural (PD, T2); MR structural (B0 map); MR structural (B1 map); single-shell DTI; multi-shell DTI; Field Map;
-            #   X-Ray; static magnetic field B0
-            # There are not values for minimally-processed data, we will use the closest "normal" types. For example, for min-proc T1, exp_scan = 'MR structural (T1)'
-
-            # We are using  session_det  to describe the data processing stage (none = fast-track,  minimally-processed,  processed, ...)
-            # and  image_history  to summarize the process
-
-            if scantype == 'MPR':
-                exp_id = ''
-                exp_scan      = 'MR structural (T1)'
-                session_det   = 'ABCD-MPROC-T1'
-                image_history = 'gradient unwarp, B1 inhomogeneity correction, resampled to 1mm^3 isotropic in LIA rigid body registration to non-MNI atlas'
-
-            elif scantype == 'XetaT2':
-                exp_id = ''
-                exp_scan      = 'MR structural (T2)'
-                session_det   = 'ABCD-MPROC-T2'
-                image_history = 'gradient unwarp, B1 inhomogeneity correction, resampled to 1mm^3 isotropic in LIA rigid body registration to non-MNI atlas'
-
-            elif scantype == 'BOLD':
-                exp_id      = NDAexpid_for_modality[modality]
-                exp_scan    = 'fMRI'
-                session_det = 'ABCD-MPROC-' + bidsufix_for_modality[modality].upper()
-                image_history = 'motion correction, B0 inhomogeneity correction, gradient unwarp, between scan motion correction, and resampling to 2.4mm^3 (requires rigid registration to T1 - see included json for matrix values)'
-
-            elif scantype == 'DTI':
-                exp_id = ''
-                exp_scan      = 'multishell DTI'
-                session_det   = 'ABCD-MPROC-DTI'
-                image_history = 'eddy-current correction, motion correction, B0 inhomogeneity correction, gradient unwarp, replacement of bad slice-frames, between scan motion correction, rigid body registration to atlas and resampling to 1.7mm^3 LPI (requires rigid registration to T1 - see included json for matrix values)'
-
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-
-            if nda_fstk_record:
-                dataset_id     = '0' if nda_fstk_record['dataset_id'] == ''  else  nda_fstk_record['dataset_id']
-                interview_date = nda_fstk_record['interview_date']
-                interview_age  = nda_fstk_record['interview_age']
-                if 'image_file' in nda_fstk_record:
-                    image_file = nda_fstk_record['image_file']
-                else:
-                    image_file = 's3://nda-abcd/' + FsTk_fname
+    if plan_runs is not None:
+        Proc_files = plan_runs
+    else:
+        stage = Stage_Start('discovery')
+        try:
+            Proc_files = Get_File_Names_and_Process_Info( subject_id, modality, records=True )
+        except Discovery_Error:
+            Stage_End( stage, status='error' )
+            raise
+        except Exception as err:
+            Stage_End( stage, status='error' )
+            raise Discovery_Error('Error: unable to get series information: %s' % err) from err
+        Stage_End( stage )
 
-            else:
-                # The associated fast-track data record was not found in NDA.
-                # We use then metadata from our local sources: REDCap, Incoming.csv, and fixes.'
-                dataset_id = '0'
-
-                # Construct interview date like in anonymizer.sh
-                interview_date = '%s/%s/%s' % (series_date[4:6], series_date[6:8], series_date[0:4]) + ' 00:00:00'
-                bday = datetime.datetime.strptime( ser_info['dob'], '%Y-%m-%d')
-                sday = datetime.datetime.strptime( series_date,  '%Y%m%d')
-                interview_age = ("%.1f" % ((sday-bday).days/365.25))
-                interview_age = '%.0f' % round( float(interview_age)*12 )
-
-                if TEST_MODE:
-                    print('series_date:', series_date )
-                    print('bday:', bday )
-                    print('sday:', sday )
-
-                image_file = 's3://nda-abcd/' + FsTk_fname
-
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-
-            # Assembly NDA-complying meta-data record (according to specifications in fmriresults01_definitions-2.csv)
-            record = {"subjectkey":      pGUID,
-                    "src_subject_id":    pGUID,
-                    "origin_dataset_id": dataset_id,
-                    "interview_date":    interview_date,
-                    "interview_age":     interview_age,
-                    "gender":            ser_info['gender'],
-                    "experiment_id":     exp_id,
-                    "inputs":            'ABCD Fast-Track image data release for baseline assessments',
-                    "img03_id":          ser_info['nda_id'],   # row_id in image03 data structure, mapping derivative to source record in image03. Recommended
-                    "file_source":       image_file,           # Required
-                    "job_name":          '',
-                    "proc_types":        '',
-                    "metric_files":      '',
-                    "pipeline":          'MMPS version 248',
-                    "pipeline_script":   'MMIL_Preproc',
-                    "pipeline_tools":    'MMPS',
-                    "pipeline_type":     'MMPS',
-                    "pipeline_version":  '248',
-                    "qc_fail_quest_reason": '',
-                    "qc_outcome":        'pass',
-                    "derived_files": AWS_bucket + fname_bas + '.tgz',   # Archive of the files produced by the pipeline. Required
-                    "scan_type":     exp_scan,                          # Required
-                    "img03_id2":     '',
-                    "file_source2":  '',
-                    "session_det":   session_det,              # Session details. Recommended
-                    "image_history": image_history }
-            # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-            # ---------------------------------------------------------------------------------------------------------------
-
-
-            # ------------------------------ Upload record to miNDA and BIDS strucutre to AWS -------------------------------
-
-            miNDA_ok, miNDA_msg  =  miNDA_record_upload( record )
-
-            print('\nmiNDA_ok =', miNDA_ok)
-            print(  'miNDA_msg:', miNDA_msg, '\n')
-
-            if miNDA_ok:
-                s3_ok, s3_msg  =  AWS_file_upload( outtarname )
-            else:
-                # Unable to upload record to miNDA
-                s3_ok  = ''
-                s3_msg = 'AWS-s3 not attempted because miNDA upload failed'
 
-            print('s3_ok =', s3_ok)
-            print('s3_msg:', s3_msg)
+    print('db_fname:   ', db_fname)
+    print('outdir :    ', outdir)
+    print('metadatadir:', metadatadir,   ',   scantype:', scantype,  ',   Processing:', Proc_files.keys() )
 
-            if not miNDA_ok or not s3_ok:
-                print('Removing BIDS container:', outtarname )  # So we don't have to remove it manually when re-running the process
-                try:
-                    os.remove( outtarname )
-                except Exception as e:
-                    print('Error: unable to remove file', outtarname, e)
-            # ---------------------------------------------------------------------------------------------------------------
+    if TEST_MODE:
+        print('TEST_MODE = ', TEST_MODE )
+        # print( json.dumps( Proc_files, sort_keys=True, indent=2 ) )
 
+    result = {'subject': subject_id, 'modality': modality, 'runs': []}
 
-            # ----------------------------------- Upload record to local SQLite database ------------------------------------
-            local_db_table = 'fmriresults01'
+    if len(Proc_files.keys()) <= 0:
+        print('No series to process from this subject')
+        return result
 
-            local_record = record
 
-            local_record['miNDA_ok']  = miNDA_ok
-            local_record['miNDA_msg'] = miNDA_msg
-            local_record['miNDA_msg'] = local_record['miNDA_msg'].replace('\"','')
-            local_record['miNDA_msg'] = local_record['miNDA_msg'].replace('\'','')
+    # Sidecars of all runs (motion tables, events, bvals, bvecs), built and checked before converting any image; a run with
+    # invalid inputs is recorded as an Input_Error and the others are shared
+    stage = Stage_Start('sidecars')
+    sidecars, sidecar_errors  =  Sidecars_Build( Proc_files, scantype )
+    Stage_End( stage, status='error' if sidecar_errors else 'ok' )
 
-            local_record['s3_ok']  = s3_ok
-            local_record['s3_msg'] = s3_msg
-            local_record['s3_msg'] = local_record['s3_msg'].replace('\"','')
-            local_record['s3_msg'] = local_record['s3_msg'].replace('\'','')
 
-            addMetaData( metadatadir, local_db_table, local_record )
-            # ---------------------------------------------------------------------------------------------------------------
+    for key in sorted( Proc_files.keys() ):
+        print()
+
+        if TEST_MODE:
+            print('key =', key )
+            # print( Proc_files[key] )
+
+        bids_run = Proc_files[key].bids_run
+
+        if key in sidecar_errors:
+            msg = sidecar_errors[key]
+            print('bids_run =  ', bids_run)
+            print( msg, '\n')
+            log.error( msg )
+            result['runs'].append( {'run': bids_run, 'status': 'error', 'archive': '', 'miNDA_ok': False, 's3_ok': False,
+                                    'error': 'Input_Error', 'msg': msg} )
+            continue
+
+        try:
+            res = Run_Share( Proc_files[key], sidecars[key], bids_run, subject_id, subj_info, modality, db_fname, outdir )
+        except Exception as err:
+            if isinstance( err, Share_Error ):
+                print( err, '\n')
+                log.error( str(err) )
+            else:
+                traceback.print_exc( file=sys.stdout )
+                log.exception( 'Unexpected error in %s' % bids_run )
+            res = {'run': bids_run, 'status': 'error', 'archive': '', 'miNDA_ok': False, 's3_ok': False,
+                   'error': type(err).__name__, 'msg': str(err)}
+            # What the run still holds: its disk reservations and scratch files; its stage records, for progress reports
+            Release_All()
+            scratch.Scratch_Cleanup()
+            Stage_Usage_Store( metadatadir )
+        result['runs'].append( res )
+
+    return result
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    Log_Init()
+
+    subject_id, subjs_file, modality, db_fname, outdir, test_mode  =  command_line_get_variables()
+
+    try:
+        Subject_Share( subject_id, subjs_file, modality, db_fname, outdir, test_mode )
+    except Share_Error as err:
+        print( err, '\n')
+        log.error( str(err) )
 
     print()
 # ========================================================================================================================================================
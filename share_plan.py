@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import sys, os, getopt, time, json, socket, sqlite3
+import multiprocessing
+
+import series_process_info_get as spi
+from run_record import Fields, Run_Record
+from task_schedule import Tasks_get, Runs_Sizes_get, count_get
+from share_errors import Share_Error
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Share plan: the runs that discovery resolved (series_process_info_get.py: pcinfo, ContainerInfo, processed files, fast-track
+# linkage, series parameters), written once to an sqlite file, so that publishing (conversion, BIDS archive, miNDA and AWS-s3
+# uploads) can run from the plan, on any host that sees the processed files, without reading pcinfo or ContainerInfo again;
+# and so that a publish failure, or a subset of the plan, can be replayed without repeating discovery:
+#
+#   ./share_plan.py  --create chla.plan  --demog Subjs_Year1_patch.csv  --site chla  --modality fMRI_SST_task,dMRI
+#   ./share_pool.py  --plan chla.plan  --demog Subjs_Year1_patch.csv  --NDAdb image03.txt  --outdir /mproc/chla  --modality fMRI_SST_task
+#
+# Tables:
+#   plan_info   name, value: version (Plan_version), created, host, demog
+#   tasks       site, subject, modality, status ('ok', 'no runs', or the type of the error of discovery), msg, runs
+#   runs        site, subject, modality, the fields of run_record.Run_Record, and MinProc_bytes (input size, for the schedule)
+#
+# The file is written next to its final name and renamed into place, so a plan is either complete or absent. A plan of another
+# version is refused.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Plan_version = 1
+
+Run_columns = ['site', 'subject', 'modality'] + list( Fields ) + ['MinProc_bytes']
+
+Json_fields = ['RegistrationMatrix']     # Lists, stored as JSON text
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Write the share plan of one or more sites (the runs resolved by discovery) to an sqlite file, or list a plan')
+    print()
+    print('Usage:')
+    print('  ./share_plan.py  --create PlanFile  --demog SubjsFile  --site S1,S2,...  --modality M1,M2,...  [--workers N]')
+    print('  ./share_plan.py  --list PlanFile  [--site S1,S2,...]  [--modality M1,M2,...]  [--subjects P1,P2,...]  [--runs R1,R2,...]')
+    print()
+    print('where:')
+    print('  SubjsFile   Table (.csv) listing pGUIDs; participants of a site are the lines containing it')
+    print('  M1,M2,...   Modalities, from:', spi.modality_list )
+    print('  N           Discovery processes (default: number of CPUs)')
+    print('  P1,P2,...   Participants;  R1,R2,...  BIDS runs (run-01, ...)')
+    print()
+    print('Publish a plan, or part of it, with:  ./share_pool.py --plan PlanFile ...  (same filters)')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def command_line_get_variables():
+    o = {'create': '', 'list': '', 'demog': '', 'sites': [], 'modalities': [], 'subjects': [], 'runs': [],
+         'workers': os.cpu_count() or 1}
+
+    try:
+        opts,args = getopt.getopt(sys.argv[1:], "hc:l:d:s:m:u:r:p:", ["create=", "list=", "demog=", "site=", "modality=",
+                                                                    "subjects=", "runs=", "workers="])
+    except getopt.GetoptError as err:
+        print("Error parsing arguments: %s" % str(err))
+        program_description()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            program_description()
+            sys.exit()
+        elif opt in ("-c", "--create"):
+            o['create'] = arg
+        elif opt in ("-l", "--list"):
+            o['list'] = arg
+        elif opt in ("-d", "--demog"):
+            o['demog'] = arg
+        elif opt in ("-s", "--site"):
+            o['sites'] = arg.split(',')
+        elif opt in ("-m", "--modality"):
+            o['modalities'] = arg.split(',')
+        elif opt in ("-u", "--subjects"):
+            o['subjects'] = arg.split(',')
+        elif opt in ("-r", "--runs"):
+            o['runs'] = arg.split(',')
+        elif opt in ("-p", "--workers"):
+            o['workers'] = max( 1, int(arg) )
+
+    if not (o['list'] or (o['create'] and o['demog'] and o['sites'] and o['modalities'])):
+        program_description()
+        sys.exit()
+
+    for m in o['modalities']:
+        if m not in spi.modality_list:
+            print('Error: Modality must be one of', spi.modality_list )
+            sys.exit()
+
+    return o
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Task_Plan_get( task ):
+    # Discovery of one (subject, modality, site), in a pool worker: (status, msg, [run values, in the order of Run_columns])
+    subj, modality, site = task
+    try:
+        Proc_files = spi.Get_File_Names_and_Process_Info( subj, modality, records=True )
+    except Share_Error as err:
+        return type(err).__name__, str(err), []
+    except Exception as err:
+        return 'error', '%s: %s' % (type(err).__name__, err), []
+
+    rows = []
+    for key, (size, nreps, ndiffdirs) in zip( sorted( Proc_files ), Runs_Sizes_get( Proc_files ) ):
+        rows.append( (site, subj, modality) + Proc_files[key].to_tuple() + (size,) )
+    return ('ok'  if rows  else 'no runs'), '', rows
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def value_put( name, value ):
+    if value is None:
+        return None
+    if name in Json_fields:
+        return json.dumps( value )
+    if isinstance( value, (int, float, str, bytes) ):
+        return value
+    return str( value )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Plan_Create( plan_fname, demog, tasks, workers ):
+    # Discover the runs of tasks [(subject, modality, site), ...] in forked processes and write the plan. Returns the number
+    # of tasks of each status.
+    ctx = multiprocessing.get_context( 'fork' )
+    with ctx.Pool( processes=workers ) as pool:
+        plans = pool.map( Task_Plan_get, tasks, chunksize=4 )
+
+    part_fname = '%s.part-%d' % (plan_fname, os.getpid())
+    if os.path.exists( part_fname ):
+        os.remove( part_fname )
+    conn = sqlite3.connect( part_fname )
+    conn.execute( 'CREATE TABLE plan_info (name TEXT PRIMARY KEY, value TEXT)' )
+    conn.execute( 'CREATE TABLE tasks (site TEXT, subject TEXT, modality TEXT, status TEXT, msg TEXT, runs INTEGER)' )
+    conn.execute( 'CREATE TABLE runs (%s)' % ', '.join( '"%s"' % c  for c in Run_columns ) )
+    conn.execute( 'CREATE INDEX runs_task ON runs (site, modality, subject)' )
+
+    conn.executemany( 'INSERT INTO plan_info VALUES (?, ?)',
+                      [('version', str(Plan_version)), ('created', time.strftime('%Y-%m-%d %H:%M:%S')),
+                       ('host', socket.gethostname()), ('demog', os.path.abspath(demog))] )
+    counts = {}
+    for (subj, modality, site), (status, msg, rows) in zip( tasks, plans ):
+        conn.execute( 'INSERT INTO tasks VALUES (?, ?, ?, ?, ?, ?)', (site, subj, modality, status, msg, len(rows)) )
+        conn.executemany( 'INSERT INTO runs VALUES (%s)' % ', '.join( '?' * len(Run_columns) ),
+                          [ tuple( value_put( c, v )  for c, v in zip( Run_columns, row ) )  for row in rows ] )
+        counts[ status ] = counts.get( status, 0 ) + 1
+    conn.commit()
+    conn.close()
+    os.replace( part_fname, plan_fname )
+    return counts
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Plan_Open( plan_fname ):
+    # Connection to a plan (read only), after checking its version
+    if not os.path.isfile( plan_fname ):
+        raise Share_Error('Error: no share plan %s' % plan_fname)
+    conn = sqlite3.connect( 'file:%s?mode=ro' % os.path.abspath(plan_fname), uri=True )
+    try:
+        info = dict( conn.execute( 'SELECT name, value FROM plan_info' ).fetchall() )
+    except sqlite3.Error as err:
+        conn.close()
+        raise Share_Error('Error: %s is not a share plan: %s' % (plan_fname, err)) from err
+    if info.get('version') != str(Plan_version):
+        conn.close()
+        raise Share_Error('Error: share plan %s has version %s; this version reads %d' % (plan_fname, info.get('version'), Plan_version))
+    return conn
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Plan_Tasks_get( plan_fname, sites=[], modalities=[], subjects=[], runs=[] ):
+    # Tasks of the plan with runs selected by the filters (empty: all), in plan order:
+    #   [(subject, modality, site, {'Run-01': Run_Record, ...}, [(input bytes, nreps, ndiffdirs), ...]), ...]
+    # with the sizes of the runs in the order of their keys, as task_schedule.Runs_Sizes_get lists them
+    where = []
+    args  = []
+    for column, values in [('site', sites), ('modality', modalities), ('subject', [ s.replace('NDAR_', '')  for s in subjects ]),
+                           ('bids_run', [ r.lower()  for r in runs ])]:
+        if values:
+            where.append( '"%s" IN (%s)' % (column, ', '.join( '?' * len(values) )) )
+            args.extend( values )
+
+    conn = Plan_Open( plan_fname )
+    rows = conn.execute( 'SELECT %s FROM runs %s ORDER BY rowid' % (', '.join( '"%s"' % c  for c in Run_columns ),
+                                                                    ('WHERE ' + ' AND '.join( where ))  if where  else ''), args ).fetchall()
+    conn.close()
+
+    tasks = {}
+    for row in rows:
+        site, subj, modality = row[:3]
+        values = [ json.loads( v )  if c in Json_fields and v is not None  else v  for c, v in zip( Fields, row[3:3+len(Fields)] ) ]
+        rec = Run_Record( *values )
+        t = tasks.setdefault( (subj, modality, site), ({}, {}) )
+        t[0][ rec.key ] = rec
+        t[1][ rec.key ] = (row[-1] or 0, count_get( rec.nreps ), count_get( rec.ndiffdirs ))
+    return [ (subj, modality, site, recs, [ sizes[key]  for key in sorted(sizes) ])  for (subj, modality, site), (recs, sizes) in tasks.items() ]
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    o = command_line_get_variables()
+
+    if o['create']:
+        tasks = [ (subj, modality, site)  for site in o['sites']  for subj, modality in Tasks_get( o['demog'], site, o['modalities'] ) ]
+        print('Tasks (participant, modality): %d,  workers: %d' % (len(tasks), o['workers']) )
+        t0 = time.time()
+        counts = Plan_Create( o['create'], o['demog'], tasks, o['workers'] )
+        print('Plan %s written in %.1f s;  tasks: %s' % (o['create'], time.time() - t0,
+                                                         ',  '.join( '%s %d' % (s, n)  for s, n in sorted(counts.items()) )) )
+        sys.exit()
+
+    try:
+        conn = Plan_Open( o['list'] )
+        info = dict( conn.execute( 'SELECT name, value FROM plan_info' ).fetchall() )
+        failed = conn.execute( "SELECT site, subject, modality, status, msg FROM tasks WHERE status NOT IN ('ok', 'no runs')" ).fetchall()
+        conn.close()
+        tasks = Plan_Tasks_get( o['list'], o['sites'], o['modalities'], o['subjects'], o['runs'] )
+    except Share_Error as err:
+        print( err )
+        sys.exit()
+
+    print('Plan %s:  version %s,  created %s on %s from %s' % (o['list'], info['version'], info['created'], info['host'], info['demog']) )
+    for subj, modality, site, recs, sizes in tasks:
+        for key, size in zip( sorted( recs ), sizes ):
+            rec = recs[key]
+            print('%-10s %-14s %-16s %-8s %12d  %s' % (site, subj, modality, rec.bids_run, size[0], rec.get('FasTrk_file_Guessed_Name', '')) )
+    print('Tasks: %d,  runs: %d' % (len(tasks), sum( len(t[3])  for t in tasks )) )
+    for row in failed:
+        print('Discovery failed:', *row )
+# ========================================================================================================================================================
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+import sys, os, getopt, time, gc, traceback
+import multiprocessing
+
+import series_process_info_get as spi
+import share_min_proc_fMRI_dMRI_BOLD_T1T2 as share
+from lookup_index import Index_Preload
+from bulk_resolution import Bulk_Resolve, NDA_Records_from_Run_Table
+from resource_usage import Stage_Usage_Store
+from disk_budget import Release_All
+from scratch import Scratch_Cleanup
+from task_schedule import Tasks_get, Tasks_Discover, Run_Tasks_get, History_get, Task_Costs_get, LPT_Order, Makespan_estimate
+from share_progress import Runs_Expected_get, Progress_Report
+from share_config import Share_Config_Get
+from share_log import Log_Listener_Start, Quiet_Set
+from share_plan import Plan_Tasks_get
+from share_errors import Share_Error
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Worker pool for sharing many participants: the parent process imports pandas, scipy.io and requests, and loads the subjects
+# file and the pcinfo and NDA lookup indexes (lookup_index.py) in memory; workers are then forked from it, so they start
+# without paying for those imports and loads again, and share the loaded pages copy-on-write.
+# Each task is one (participant, modality, site), run by share_min_proc_fMRI_dMRI_BOLD_T1T2.Subject_Share, as one call of
+# share_min_proc_fMRI_dMRI_BOLD_T1T2.py from run_mproc_share.sh would do; runs found by discovery or read from a plan are
+# kept by the whole task, so the same participant listed under two sites keeps the runs of each.
+# Longest-first ordering discovers every task to estimate its cost; the runs it finds are passed to Subject_Share, so the
+# tasks are not discovered twice. A task whose runs are known (discovered, or from a plan) is then dispatched as one task per
+# run, (participant, modality, site, run key), which Subject_Share shares alone: the longest runs start first, and the runs
+# of one participant are shared in parallel instead of one after another (task_schedule.Run_Tasks_get).
+# With --plan, the tasks and their runs are read from a share plan (share_plan.py) instead of being discovered, and the site,
+# modality, participant and run options select the part of the plan to publish.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Pool_options = {}    # Set by the parent before forking; read by the workers
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Share minimally-processed data of the participants of one site, with a pool of worker processes forked')
+    print('from a parent that has preloaded modules and lookup tables (see share_min_proc_fMRI_dMRI_BOLD_T1T2.py)')
+    print()
+    print('Usage:')
+    print('  ./share_pool.py  --demog SubjsFile  --site Site  --modality M1,M2,...  --NDAdb DB  --outdir OutDir  [--workers N]')
+    print('                   [--logdir LogDir]  [--tasks-per-worker T]  [--bulk]  [--order lpt|listed]  [--priority S1,S2,...]  [--nowrite]  [--quiet]')
+    print('  ./share_pool.py  --plan PlanFile  --demog SubjsFile  --NDAdb DB  --outdir OutDir  [--site S1,S2,...]  [--modality M1,M2,...]')
+    print('                   [--subjects P1,P2,...]  [--runs R1,R2,...]  [other options as above]')
+    print()
+    print('where:')
+    print('  SubjsFile   Table (.csv) listing pGUIDs, anonymized dob, gender; participants are the lines containing Site,')
+    print('              as in run_mproc_share.sh')
+    print('  M1,M2,...   Modalities, from:', share.modality_list )
+    print('  DB          NDA-downloaded database package (image03.txt)')
+    print('  OutDir      Directory for BIDS data sets and metadata.sqlite')
+    print('  N           Worker processes (default: number of CPUs)')
+    print('  LogDir      Write the output of each task to LogDir/Subject_Modality.log (campaign.py: Site_Subject_Modality.log),')
+    print('              or of each run to LogDir/Subject_Modality_Run.log, instead of the standard output')
+    print('  T           Replace each worker after T tasks (default: never)')
+    print('  --bulk      Resolve the NDA records of all runs at once before starting (bulk_resolution.py)')
+    print('  --order     lpt: longest runs first, estimated from input sizes and past timings (task_schedule.py; default);')
+    print('              listed: in the order of SubjsFile (or of PlanFile, one task per run)')
+    print('  S1,S2,...   Participants dispatched before all others')
+    print('  --quiet     Do not print the tables and records of each run')
+    print('  PlanFile    Share plan (share_plan.py): publish its runs, of the given sites, modalities, participants and runs')
+    print('              (run-01, ...), without discovery')
+    print()
+    print('Example:')
+    print('  ./share_pool.py  --demog Subjs_Year1_patch_DTI.csv  --site chla  --modality dMRI  --NDAdb /home/oruiz/ABCD_Inventory/NDA_downloaded_packages/image03.txt  --outdir /mproc/chla  --workers 8  --logdir logs_chla')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def command_line_get_variables():
+    o = {'demog': '', 'site': '', 'modalities': [], 'db_fname': '', 'outdir': '', 'workers': os.cpu_count() or 1,
+         'logdir': '', 'tasks_per_worker': 0, 'bulk': False, 'order': 'lpt', 'priority': [], 'test_mode': False, 'quiet': False,
+         'plan': '', 'subjects': [], 'runs': []}
+
+    try:
+        opts,args = getopt.getopt(sys.argv[1:], "hd:s:m:n:o:p:l:t:br:y:wqP:u:R:",
+                                  ["demog=", "site=", "modality=", "NDAdb=", "outdir=", "workers=", "logdir=",
+                                   "tasks-per-worker=", "bulk", "order=", "priority=", "nowrite", "quiet",
+                                   "plan=", "subjects=", "runs="])
+    except getopt.GetoptError as err:
+        print("Error parsing arguments: %s" % str(err))
+        program_description()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            program_description()
+            sys.exit()
+        elif opt in ("-d", "--demog"):
+            o['demog'] = arg
+        elif opt in ("-s", "--site"):
+            o['site'] = arg
+        elif opt in ("-m", "--modality"):
+            o['modalities'] = arg.split(',')
+        elif opt in ("-n", "--NDAdb"):
+            o['db_fname'] = arg
+        elif opt in ("-o", "--outdir"):
+            o['outdir'] = arg
+        elif opt in ("-p", "--workers"):
+            o['workers'] = max( 1, int(arg) )
+        elif opt in ("-l", "--logdir"):
+            o['logdir'] = arg
+        elif opt in ("-t", "--tasks-per-worker"):
+            o['tasks_per_worker'] = int(arg)
+        elif opt in ("-b", "--bulk"):
+            o['bulk'] = True
+        elif opt in ("-r", "--order"):
+            o['order'] = arg
+        elif opt in ("-y", "--priority"):
+            o['priority'] = arg.split(',')
+        elif opt in ("-w", "--nowrite"):
+            o['test_mode'] = True
+        elif opt in ("-q", "--quiet"):
+            o['quiet'] = True
+        elif opt in ("-P", "--plan"):
+            o['plan'] = arg
+        elif opt in ("-u", "--subjects"):
+            o['subjects'] = arg.split(',')
+        elif opt in ("-R", "--runs"):
+            o['runs'] = arg.split(',')
+
+    if not (o['demog'] and o['db_fname'] and o['outdir'] and (o['plan'] or (o['site'] and o['modalities']))):
+        program_description()
+        sys.exit()
+
+    if o['order'] not in ['lpt', 'listed']:
+        print('Error: order must be lpt or listed')
+        sys.exit()
+
+    for m in o['modalities']:
+        if m not in share.modality_list:
+            print('Error: Modality must be one of', share.modality_list )
+            sys.exit()
+
+    return o
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Bulk_NDA_Preload( tasks, db_fname ):
+    # Resolve the NDA records of all runs of the tasks at once (bulk_resolution.py); returns the number of runs with a record
+    pGUIDs     = sorted( set( 'NDAR_' + task[0]  for task in tasks ) )
+    modalities = sorted( set( task[1]  for task in tasks ) )
+    runs = Bulk_Resolve( pGUIDs, modalities, spi.PCInfo_fname, db_fname )
+    share.NDA_resolved.update( NDA_Records_from_Run_Table( runs ) )
+    return len( share.NDA_resolved )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Worker_Pool_Preload( subjs_fname, db_fname, tasks=[], bulk=False ):
+    # Import and load, in this (parent) process, what every task would otherwise import and load again
+    loaded = {}
+    preloads = [('pandas',        lambda: (share.pandas_get(), spi.pandas_get())),
+                ('scipy.io',      lambda: __import__('scipy.io')),
+                ('requests',      lambda: __import__('requests')),
+                ('subjects',      lambda: share.Subjects_File_Preload( subjs_fname )),
+                ('pcinfo index',  lambda: Index_Preload( spi.PCInfo_fname )),
+                ('NDA index',     lambda: Index_Preload( db_fname ))]
+    if bulk:
+        preloads.append( ('bulk NDA runs', lambda: Bulk_NDA_Preload( tasks, db_fname )) )
+
+    for name, load in preloads:
+        t0 = time.time()
+        try:
+            res = load()
+        except (ImportError, IOError, OSError, KeyError, ValueError) as err:
+            print('Warning: unable to preload %s: %s' % (name, err) )
+            continue
+        loaded[ name ] = time.time() - t0
+        if isinstance( res, int ):
+            if not res:
+                print('Warning: no current %s; workers will read the table per task' % name )
+                del loaded[ name ]
+                continue
+            print('Preloaded %-14s %8d keys   %.2f s' % (name, res, loaded[name]) )
+        else:
+            print('Preloaded %-14s %8s        %.2f s' % (name, '', loaded[name]) )
+
+    Log_Listener_Start()    # One writer of the log for all workers (share_log.py)
+
+    # Keep the preloaded objects out of the garbage collector's reach, so that its passes do not write to (and copy)
+    # the pages shared with the workers
+    if hasattr( gc, 'freeze' ):
+        gc.collect()
+        gc.freeze()
+    return loaded
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Task_run( task ):
+    # Runs in a worker: share one (subject, modality, site), or only its run task[3] when given, into the site's output
+    # directory (Pool_options['outdirs'], campaign.py) or the output directory of the pool. Status: 'ok', 'runs failed' (some
+    # runs were not shared), the type of the Share_Error that stopped the participant, 'exit' (sys.exit), or 'error'
+    # (unexpected exception)
+    subj, modality, site = task[:3]
+    run = task[3]  if len(task) > 3  else ''
+    o = Pool_options
+    outdir = o['outdirs'][ site ]  if o.get('outdirs')  else o['outdir']
+    plan_runs = o['plan_runs'].get( task[:3] )  if o.get('plan_runs')  else None
+    if run:
+        plan_runs = { run: plan_runs[run] }
+    status = 'ok'
+    runs = []
+    t0 = time.time()
+
+    if o['logdir']:
+        sys.stdout.flush()
+        saved_fd = os.dup(1)
+        name = '%s_%s' % (subj, modality)  if not o.get('outdirs')  else  '%s_%s_%s' % (site, subj, modality)
+        flog = open('%s/%s%s.log' % (o['logdir'], name, '_' + run  if run  else ''), 'w')
+        os.dup2( flog.fileno(), 1 )    # Also receives the output of mri_convert and aws
+
+    try:
+        runs = share.Subject_Share( subj, o['demog'], modality, o['db_fname'], outdir, o['test_mode'], plan_runs )['runs']
+        if any( r['status'] != 'ok'  for r in runs ):
+            status = 'runs failed'
+    except Share_Error as err:
+        print( err, '\n')
+        share.log.error( str(err) )
+        status = type(err).__name__
+    except SystemExit as err:
+        status = 'exit' if err.code in (None, 0) else 'exit %s' % err.code
+    except Exception:
+        traceback.print_exc( file=sys.stdout )
+        status = 'error'
+
+    Stage_Usage_Store()
+    Release_All()       # Reservations of a task that ended early
+    Scratch_Cleanup()   # and its scratch files
+
+    if o['logdir']:
+        sys.stdout.flush()
+        os.dup2( saved_fd, 1 )
+        os.close( saved_fd )
+        flog.close()
+
+    return {'subject': subj, 'modality': modality, 'site': site, 'run': run, 'status': status, 'runs': len(runs), 'runs_ok': sum( 1  for r in runs  if r['status'] == 'ok' ),
+            'pid': os.getpid(), 'elapsed_s': time.time() - t0}
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Tasks_Order( tasks, workers, outdir, order='lpt', priority=[], task_runs=None, task_records=None ):
+    # Dispatch order: longest processing time first (the discovery each estimate needs runs in forked workers, unless the
+    # runs of the tasks and their Run_Records, task_records, are given), or as listed; tasks of priority participants first in
+    # both cases. Tasks whose records are known are split into one task per run (Run_Tasks_get). Returns the ordered tasks,
+    # their runs (None when the listed order was kept without discovery), and the Run_Records of the tasks ({task: records},
+    # for Subject_Share's plan_runs; tasks whose discovery failed are left out and discovered again).
+    task_records = task_records  or  {}
+    if order == 'listed' and not priority and task_runs is None:
+        return tasks, task_runs, task_records
+
+    t0 = time.time()
+    if task_runs is None:
+        task_runs, records = Tasks_Discover( tasks, workers, records=True )
+        task_records = { t: r  for t, r in zip( tasks, records )  if r is not None }
+    tasks, task_runs = Run_Tasks_get( tasks, task_runs, task_records )
+    costs = Task_Costs_get( tasks, task_runs, History_get( outdir ) )
+    cost_of = dict( zip( tasks, costs ) )
+    runs_of = dict( zip( tasks, task_runs ) )
+
+    ordered, _ = LPT_Order( tasks, costs  if order == 'lpt'  else [0.0] * len(tasks), priority )
+
+    print('Task costs estimated in %.1f s;  estimated makespan: listed order %.0f,  dispatch order %.0f'
+          % (time.time() - t0, Makespan_estimate( costs, workers ), Makespan_estimate( [ cost_of[t]  for t in ordered ], workers )) )
+    return ordered, [ runs_of[t]  for t in ordered ], task_records
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Share_Pool_Run( tasks, workers, tasks_per_worker=0, report=None, interval=0 ):
+    # Workers are forked from this process, after Worker_Pool_Preload. report(), if given, is called every interval seconds
+    # while waiting for results, and once at the end.
+    ctx = multiprocessing.get_context( 'fork' )
+    results = []
+    with ctx.Pool( processes=workers, maxtasksperchild=(tasks_per_worker or None) ) as pool:
+        it = pool.imap_unordered( Task_run, tasks )
+        last_report = time.time()
+        while True:
+            try:
+                r = it.next( timeout=(max( 0.1, last_report + interval - time.time() )  if report  else None) )
+            except StopIteration:
+                break
+            except multiprocessing.TimeoutError:
+                r = None
+            if r:
+                print('%-14s %-16s %-7s %-16s %3d/%-3d runs %7.1f s   (worker %d)' % (r['subject'], r['modality'], r.get('run', ''), r['status'],
+                                                                                 r['runs_ok'], r['runs'], r['elapsed_s'], r['pid']) )
+                results.append( r )
+            if report and time.time() - last_report >= interval:
+                report()
+                last_report = time.time()
+    if report:
+        report()
+    return results
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    Pool_options.update( command_line_get_variables() )
+    o = Pool_options
+    if o['quiet']:
+        Quiet_Set( True )    # Inherited by the workers
+
+    if not os.path.isdir( o['outdir'] ):
+        os.makedirs( o['outdir'] )
+    if o['logdir'] and not os.path.isdir( o['logdir'] ):
+        os.makedirs( o['logdir'] )
+
+    task_runs = None
+    if o['plan']:
+        try:
+            plan = Plan_Tasks_get( o['plan'], o['site'].split(',')  if o['site']  else [], o['modalities'], o['subjects'], o['runs'] )
+        except Share_Error as err:
+            print( err )
+            sys.exit()
+        tasks     = [ (subj, modality, site)  for subj, modality, site, recs, sizes in plan ]
+        task_runs = [ sizes  for subj, modality, site, recs, sizes in plan ]
+        o['plan_runs'] = { (subj, modality, site): recs  for subj, modality, site, recs, sizes in plan }    # Inherited by the workers
+        o['site'] = o['site']  or  ','.join( sorted( set( site  for subj, modality, site, recs, sizes in plan ) ) )
+    else:
+        tasks = [ (subj, modality, o['site'])  for subj, modality in Tasks_get( o['demog'], o['site'], o['modalities'] ) ]
+    print('Tasks (participant, modality): %d,  workers: %d' % (len(tasks), o['workers']) )
+    print()
+
+    t0 = time.time()
+    Worker_Pool_Preload( o['demog'], o['db_fname'], tasks, o['bulk'] )
+    print('Preload time: %.2f s' % (time.time() - t0) )
+
+    tasks, task_runs, task_records = Tasks_Order( tasks, o['workers'], o['outdir'], o['order'], o['priority'], task_runs,
+                                                  o.get('plan_runs') )
+    if task_records:
+        o['plan_runs'] = task_records    # Runs already discovered, shared by the workers without discovering them again
+    print('Tasks dispatched (one per run where the runs are known): %d' % len(tasks) )
+
+    # Progress reports (share_progress.py), against the runs discovery found when it ran for the order or the plan; without
+    # them, runs done and throughput only (no remaining runs, no ETA)
+    Config = Share_Config_Get()
+    interval = float( Config.get('Progress_interval_s', 60) or 0 )
+    report = None
+    if interval:
+        expected = None
+        if task_runs is not None:
+            expected = Runs_Expected_get( tasks, task_runs )
+            print('Runs expected: %d' % sum( expected.values() ) )
+        report = lambda: Progress_Report( o['site'], o['outdir'], expected, t0, Config.get('Progress_textfile_dir', '') )
+    print()
+
+    results = Share_Pool_Run( tasks, o['workers'], o['tasks_per_worker'], report, interval )
+
+    print()
+    print('Tasks: %d,  ok: %d,  with failed runs: %d,  stopped by an error: %d,  crashed: %d;  runs shared: %d of %d;  elapsed: %.1f s'
+          % (len(results), sum(1 for r in results if r['status'] == 'ok'), sum(1 for r in results if r['status'] == 'runs failed'),
+             sum(1 for r in results if r['status'].endswith('_Error') or r['status'].startswith('exit')),
+             sum(1 for r in results if r['status'] == 'error'),
+             sum(r['runs_ok'] for r in results), sum(r['runs'] for r in results), time.time() - t0) )
+# ========================================================================================================================================================
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+import sys, os, getopt, time, sqlite3
+
+from share_config import Share_Config_Get
+from task_schedule import Tasks_get, Tasks_Discover
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Progress of a batch: completed, failed and remaining runs per site and modality, current compression and upload throughput,
+# runs per minute, and estimated time to completion.
+#
+# Runs expected are those discovery finds for the tasks of the batch (task_schedule.Tasks_Discover). Runs done are read from
+# table stage_usage of the site's metadata.sqlite, where the share script stores the stages of each run as it ends (runs of
+# a process stopped by an error, when its task ends): a run is completed when its s3_upload stage succeeded, and failed
+# when any of its stages did not. Only stages started since the beginning of the batch count.
+#
+#   compression MB/s   Bytes read by the bids_archive stages that ended in the last Window_s, over Window_s
+#   upload MB/s        Bytes read by the s3_upload stages (aws) that ended in the last Window_s, over Window_s
+#   runs/min           Runs done (completed or failed) since the beginning of the batch, per minute
+#   ETA                Remaining runs at that rate
+#
+# share_pool.py reports every "Progress_interval_s" (share_config.json); run next to run_mproc_share.sh, this script does.
+# share_pool.py does not discover the tasks only to count their runs: if it did not discover them to order them (--order
+# listed), runs expected are unknown, and reports show runs done and throughput without remaining runs or ETA.
+# With "Progress_textfile_dir" set (the directory of node_exporter's textfile collector), each report is also written as
+# <dir>/mproc_share_<site>.prom, replaced atomically, for Prometheus.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Window_s = 300
+
+Metric_prefix = 'mproc_share'
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Report the progress of a sharing batch of one site (share_pool.py, or run_mproc_share.sh started at the same time):')
+    print('completed, failed and remaining runs per modality, compression and upload MB/s, runs per minute and ETA')
+    print()
+    print('Usage:')
+    print('  ./share_progress.py  --demog SubjsFile  --site Site  --modality M1,M2,...  --outdir OutDir  [--since Time]')
+    print('                       [--interval S]  [--textfile-dir Dir]  [--workers N]')
+    print()
+    print('where:')
+    print('  SubjsFile   Table (.csv) listing pGUIDs; participants are the lines containing Site')
+    print('  OutDir      Output directory of the site, whose metadata.sqlite receives the runs of the batch')
+    print('  Time        Beginning of the batch, as "YYYY-mm-dd HH:MM:SS" (default: now)')
+    print('  S           Seconds between reports (default: Progress_interval_s of share_config.json); 0: report once')
+    print('  Dir         Write Dir/mproc_share_Site.prom for the node_exporter textfile collector (default: Progress_textfile_dir)')
+    print('  N           Processes for discovery of the expected runs (default: number of CPUs)')
+    print()
+    print('Example:')
+    print('  ./run_mproc_share.sh  Subjs_Year1_patch_DTI.csv  chla  dMRI  &')
+    print('  ./share_progress.py  --demog Subjs_Year1_patch_DTI.csv  --site chla  --modality dMRI  --outdir /mproc/chla')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def command_line_get_variables():
+    Config = Share_Config_Get()
+    o = {'demog': '', 'site': '', 'modalities': [], 'outdir': '', 'since': time.time(),
+         'interval': float( Config.get('Progress_interval_s', 60) or 0 ), 'textfile_dir': Config.get('Progress_textfile_dir', ''),
+         'workers': os.cpu_count() or 1}
+
+    try:
+        opts,args = getopt.getopt(sys.argv[1:], "hd:s:m:o:t:i:x:p:",
+                                  ["demog=", "site=", "modality=", "outdir=", "since=", "interval=", "textfile-dir=", "workers="])
+    except getopt.GetoptError as err:
+        print("Error parsing arguments: %s" % str(err))
+        program_description()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            program_description()
+            sys.exit()
+        elif opt in ("-d", "--demog"):
+            o['demog'] = arg
+        elif opt in ("-s", "--site"):
+            o['site'] = arg
+        elif opt in ("-m", "--modality"):
+            o['modalities'] = arg.split(',')
+        elif opt in ("-o", "--outdir"):
+            o['outdir'] = arg
+        elif opt in ("-t", "--since"):
+            try:
+                o['since'] = time.mktime( time.strptime( arg, '%Y-%m-%d %H:%M:%S' ) )
+            except ValueError:
+                print('Error: time must be given as "YYYY-mm-dd HH:MM:SS"')
+                sys.exit()
+        elif opt in ("-i", "--interval"):
+            o['interval'] = float(arg)
+        elif opt in ("-x", "--textfile-dir"):
+            o['textfile_dir'] = arg
+        elif opt in ("-p", "--workers"):
+            o['workers'] = max( 1, int(arg) )
+
+    if not (o['demog'] and o['site'] and o['modalities'] and o['outdir']):
+        program_description()
+        sys.exit()
+
+    return o
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Runs_Expected_get( tasks, task_runs ):
+    # Runs per modality, from the discovery of each task (task_runs in the order of tasks)
+    expected = {}
+    for task, runs in zip( tasks, task_runs ):
+        expected[ task[1] ] = expected.get( task[1], 0 ) + len( runs )
+    return expected
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Stages_get( metadatadir, since ):
+    # Run stages started at or after since (epoch s): [(subject, modality, bids_run, stage, status, end time, bytes read)]
+    sqlite_file = ''.join([metadatadir, '/', 'metadata.sqlite'])
+    if not os.path.isfile( sqlite_file ):
+        return []
+    try:
+        conn = sqlite3.connect( sqlite_file, timeout=30 )
+        rows = conn.execute( "SELECT subject, modality, bids_run, stage, status, start_time, wall_s, rchar FROM stage_usage "
+                             "WHERE bids_run != '' AND start_time >= ?",
+                             (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(since)),) ).fetchall()
+        conn.close()
+    except sqlite3.Error:
+        return []
+
+    stages = []
+    for subject, modality, bids_run, stage, status, start_time, wall_s, rchar in rows:
+        end = time.mktime( time.strptime( start_time, '%Y-%m-%d %H:%M:%S' ) ) + float( wall_s or 0 )
+        stages.append( (subject, modality, bids_run, stage, status, end, int( rchar or 0 )) )
+    return stages
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Progress_get( site, metadatadir, expected, since, now=None ):
+    # Progress of the batch of site that began at since; expected: runs per modality, or None if unknown
+    if now is None:
+        now = time.time()
+    stages = Stages_get( metadatadir, since )
+
+    runs = {}    # (subject, modality, bids_run) -> 'completed' | 'failed' | ''
+    nbytes = {'bids_archive': 0, 's3_upload': 0}
+    for subject, modality, bids_run, stage, status, end, rchar in stages:
+        key = (subject, modality, bids_run)
+        if status != 'ok':
+            runs[ key ] = 'failed'  if runs.get( key ) != 'completed'  else 'completed'
+        elif stage == 's3_upload':
+            runs[ key ] = 'completed'
+        else:
+            runs.setdefault( key, '' )
+        if stage in nbytes and end >= now - Window_s:
+            nbytes[ stage ] += rchar
+
+    modalities = {}
+    for modality in sorted( set( expected or {} ) | set( k[1]  for k in runs ) ):
+        m = {'expected':  expected.get( modality, 0 )  if expected is not None  else None,
+             'completed': sum( 1  for k, state in runs.items()  if k[1] == modality and state == 'completed' ),
+             'failed':    sum( 1  for k, state in runs.items()  if k[1] == modality and state == 'failed' )}
+        m['remaining'] = max( 0, m['expected'] - m['completed'] - m['failed'] )  if expected is not None  else None
+        modalities[ modality ] = m
+
+    elapsed = max( 1.0, now - since )
+    done      = sum( m['completed'] + m['failed']  for m in modalities.values() )
+    remaining = sum( m['remaining']  for m in modalities.values() )  if expected is not None  else None
+    runs_per_min = 60.0 * done / elapsed
+    return {'site':         site,
+            'modalities':   modalities,
+            'elapsed_s':    now - since,
+            'compress_Bps': nbytes['bids_archive'] / min( Window_s, elapsed ),
+            'upload_Bps':   nbytes['s3_upload'] / min( Window_s, elapsed ),
+            'runs_per_min': runs_per_min,
+            'remaining':    remaining,
+            'eta_s':        (None  if remaining is None  else
+                             60.0 * remaining / runs_per_min  if runs_per_min  else (0.0  if not remaining  else None))}
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def duration_str( s ):
+    if s is None:
+        return 'unknown'
+    return '%dh%02dm' % (s // 3600, (s % 3600) // 60)
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Progress_print( p ):
+    print('Progress %s  %s elapsed:  %.1f runs/min,  compression %.1f MB/s,  upload %.1f MB/s,  ETA %s'
+          % (p['site'], duration_str( p['elapsed_s'] ), p['runs_per_min'], p['compress_Bps'] / 1e6, p['upload_Bps'] / 1e6,
+             duration_str( p['eta_s'] )) )
+    for modality, m in p['modalities'].items():
+        print('  %-16s completed %6d   failed %6d   remaining %6s   of %6s' % (modality, m['completed'], m['failed'],
+                                                                           '-'  if m['remaining'] is None  else m['remaining'],
+                                                                           '-'  if m['expected'] is None  else m['expected']) )
+    sys.stdout.flush()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Textfile_Write( p, textfile_dir ):
+    # Prometheus text exposition format, for node_exporter's textfile collector; renamed into place so it is never read half-written
+    site = p['site'].replace('"', '')
+    lines = ['# HELP %s_runs Runs of the current batch, by state' % Metric_prefix,
+             '# TYPE %s_runs gauge' % Metric_prefix]
+    for modality, m in p['modalities'].items():
+        for state in ['completed', 'failed', 'remaining']:
+            if m[state] is None:
+                continue
+            lines.append( '%s_runs{site="%s",modality="%s",state="%s"} %d' % (Metric_prefix, site, modality, state, m[state]) )
+
+    gauges = [('compress_bytes_per_second', 'Bytes read by BIDS archiving over the last %d s' % Window_s, p['compress_Bps']),
+              ('upload_bytes_per_second',   'Bytes uploaded to AWS-s3 over the last %d s' % Window_s,    p['upload_Bps']),
+              ('runs_per_minute',           'Runs done per minute since the batch began',                 p['runs_per_min']),
+              ('eta_seconds',               'Estimated time to complete the remaining runs',              p['eta_s']),
+              ('last_update_timestamp_seconds', 'Time of this report',                                    time.time())]
+    for name, doc, value in gauges:
+        if value is None:
+            continue
+        lines += ['# HELP %s_%s %s' % (Metric_prefix, name, doc),
+                  '# TYPE %s_%s gauge' % (Metric_prefix, name),
+                  '%s_%s{site="%s"} %r' % (Metric_prefix, name, site, float(value))]
+
+    fname = os.path.join( textfile_dir, '%s_%s.prom' % (Metric_prefix, site) )
+    partial = '%s.part-%d' % (fname, os.getpid())
+    try:
+        with open(partial, 'w') as f:
+            f.write( '\n'.join(lines) + '\n' )
+        os.replace( partial, fname )
+    except OSError as err:
+        print('Warning: unable to write progress metrics to %s: %s' % (fname, err) )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Progress_Report( site, metadatadir, expected, since, textfile_dir='' ):
+    p = Progress_get( site, metadatadir, expected, since )
+    Progress_print( p )
+    if textfile_dir:
+        Textfile_Write( p, textfile_dir )
+    return p
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    o = command_line_get_variables()
+
+    tasks = Tasks_get( o['demog'], o['site'], o['modalities'] )
+    expected = Runs_Expected_get( tasks, Tasks_Discover( tasks, o['workers'] ) )
+    print('Tasks (participant, modality): %d,  runs: %d' % (len(tasks), sum(expected.values())) )
+
+    try:
+        while True:
+            p = Progress_Report( o['site'], o['outdir'], expected, o['since'], o['textfile_dir'] )
+            if not o['interval'] or not p['remaining']:
+                break
+            time.sleep( o['interval'] )
+    except KeyboardInterrupt:
+        print()
+# ========================================================================================================================================================
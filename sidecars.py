@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import sys, json
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# BIDS sidecars of a participant's runs, built and checked in one call before any image is converted (a run whose inputs are
+# invalid is reported on its own; the other runs are shared):
+#
+#   BOLD   *_motion.1D  ->  _motion.tsv  (parsed with NumPy; rows must equal nreps; written as pandas' to_csv wrote it)
+#          events .tsv  ->  checked for the onset and duration columns required by BIDS
+#   DTI    bvals.txt, bvecs.txt  ->  .bval, .bvec  (content unchanged; one b-value and one 3-vector per volume, as many as nreps,
+#          and at least ndiffdirs diffusion-weighted volumes)
+#
+# numpy is imported by the functions that use it, so that importing this module does not.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Motion_columns = ['t_indx', 'rot_z', 'rot_x', 'rot_y', 'trans_z', 'trans_x', 'trans_y']
+Motion_file_columns = len(Motion_columns) + 2         # Two trailing columns are dropped
+
+Events_required_columns = ['onset', 'duration']
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def count_get( value ):
+    # nreps / ndiffdirs from ContainerInfo as an int; 0 when unknown (missing or NaN)
+    try:
+        value = float( value )
+    except (TypeError, ValueError):
+        return 0
+    return int( value )  if value == value and value > 0  else 0
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Motion_parse( fname, nreps=0 ):
+    # Returns (array rows x 7, index_is_int, ok, msg); rows hold t_indx and the six motion parameters
+    import numpy as np
+
+    try:
+        with open(fname, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError) as err:
+        return None, False, False, 'Error: unable to read motion file %s: %s. ' % (fname, err)
+
+    n_rows = sum( 1  for line in data.splitlines()  if line.strip() )
+    tokens = data.split()
+
+    if n_rows == 0 or len(tokens) != n_rows * Motion_file_columns:
+        return None, False, False, 'Error: motion file %s does not have %d columns in every row. ' % (fname, Motion_file_columns)
+
+    if nreps and n_rows != nreps:
+        return None, False, False, 'Error: motion file %s has %d rows; the series has %d repetitions. ' % (fname, n_rows, nreps)
+
+    motion = np.empty( (n_rows, Motion_file_columns), dtype=np.float64 )
+    try:
+        motion.ravel()[:] = np.array( tokens, dtype=np.float64 )
+    except ValueError:
+        return None, False, False, 'Error: non-numeric value in motion file %s. ' % fname
+
+    # pandas read the index column as integers when every value was written as one
+    index_is_int = all( t.lstrip(b'+-').isdigit()  for t in tokens[0::Motion_file_columns] )
+
+    return motion[:, :len(Motion_columns)], index_is_int, True, ''
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Motion_TSV( motion, index_is_int ):
+    # Tab-separated table with header, as  pandas.DataFrame.to_csv(sep='\t')  wrote it (shortest float representation)
+    if index_is_int:
+        index = motion[:, 0].astype('int64').astype(str)
+    else:
+        index = motion[:, 0].astype(str)
+    values = motion[:, 1:].astype(str)
+
+    lines = [ '\t'.join(Motion_columns) ]
+    lines += [ i + '\t' + '\t'.join(row)  for i, row in zip(index.tolist(), values.tolist()) ]
+    return ( '\n'.join(lines) + '\n' ).encode('utf8')
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Events_check( fname ):
+    try:
+        with open(fname, 'r') as f:
+            header = f.readline().rstrip('\r\n').split('\t')
+    except (IOError, OSError) as err:
+        return False, 'Error: unable to read events file %s: %s. ' % (fname, err)
+
+    missing = [ c  for c in Events_required_columns  if c not in header ]
+    if missing:
+        return False, 'Error: events file %s lacks column(s): %s. ' % (fname, ', '.join(missing))
+    return True, ''
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Diffusion_Tables_get( bvals_fname, bvecs_fname, nreps=0, ndiffdirs=0 ):
+    # Returns (bvals bytes, bvecs bytes, ok, msg); the bytes are the files' text, unchanged
+    import numpy as np
+
+    try:
+        # Text mode (universal newlines), as the files were always read for the archive
+        with open(bvals_fname, 'r') as f:
+            bvals_bytes = f.read().encode('utf8')
+        with open(bvecs_fname, 'r') as f:
+            bvecs_bytes = f.read().encode('utf8')
+    except (IOError, OSError, UnicodeDecodeError) as err:
+        return b'', b'', False, 'Error: unable to read diffusion tables: %s. ' % err
+
+    try:
+        bvals = np.array( bvals_bytes.split(), dtype=np.float64 )
+        bvecs = [ np.array( line.split(), dtype=np.float64 )  for line in bvecs_bytes.splitlines()  if line.strip() ]
+    except ValueError:
+        return b'', b'', False, 'Error: non-numeric value in %s or %s. ' % (bvals_fname, bvecs_fname)
+
+    n = len(bvals)
+    if len(bvecs) != 3 or any( len(row) != n  for row in bvecs ):
+        return b'', b'', False, 'Error: %s must have 3 rows of %d values, one per b-value. ' % (bvecs_fname, n)
+
+    if nreps and n != nreps:
+        return b'', b'', False, 'Error: %s has %d b-values; the series has %d volumes. ' % (bvals_fname, n, nreps)
+
+    if ndiffdirs and np.count_nonzero( bvals > 0 ) < ndiffdirs:
+        return b'', b'', False, ('Error: %s has %d diffusion-weighted volumes; the series has %d directions. '
+                                 % (bvals_fname, np.count_nonzero( bvals > 0 ), ndiffdirs))
+
+    return bvals_bytes, bvecs_bytes, True, ''
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Sidecars_Build( Proc_files, scantype ):
+    # Sidecars of all runs in Proc_files (from Get_File_Names_and_Process_Info), by run key:
+    #   BOLD: {'motion_tsv': bytes},  DTI: {'bvals': bytes, 'bvecs': bytes};  structural runs have none.
+    # Returns (sidecars, errors): sidecars of the runs whose inputs are valid, and {key: msg} of the runs whose are not, so
+    # that one invalid run does not stop the others.
+    sidecars = {}
+    errors   = {}
+    for key in sorted( Proc_files.keys() ):
+        run = Proc_files[key]
+        sidecar = {}
+
+        if scantype == 'BOLD':
+            motion, index_is_int, ok, msg = Motion_parse( run.get('Motion_file', ''), count_get( run.get('nreps') ) )
+            if not ok:
+                errors[key] = msg
+                continue
+            sidecar['motion_tsv'] = Motion_TSV( motion, index_is_int )
+
+            if run.get('Event_file', ''):
+                ok, msg = Events_check( run['Event_file'] )
+                if not ok:
+                    errors[key] = msg
+                    continue
+
+        elif scantype == 'DTI':
+            bvals, bvecs, ok, msg = Diffusion_Tables_get( run.get('bval_file', ''), run.get('bvec_file', ''),
+                                                          count_get( run.get('nreps') ), count_get( run.get('ndiffdirs') ) )
+            if not ok:
+                errors[key] = msg
+                continue
+            sidecar['bvals'] = bvals
+            sidecar['bvecs'] = bvecs
+
+        sidecars[key] = sidecar
+
+    return sidecars, errors
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    # Check the sidecar inputs of the runs listed by series_process_info_get.py:
+    #   ./series_process_info_get.py --subject S --modality M > runs.json ;  ./sidecars.py runs.json
+    if len(sys.argv) != 2:
+        print('Usage:  ./sidecars.py  Runs.json   (output of series_process_info_get.py)')
+        sys.exit()
+
+    with open(sys.argv[1], 'r') as f:
+        Proc_files = json.load( f )
+
+    scantype = ''
+    for run in Proc_files.values():
+        scantype = 'BOLD'  if 'Motion_file' in run  else  'DTI'  if 'bval_file' in run  else  scantype
+
+    sidecars, errors = Sidecars_Build( Proc_files, scantype )
+    for key, files in sorted( sidecars.items() ):
+        print( key, ',  '.join( '%s: %d bytes' % (name, len(data))  for name, data in sorted(files.items()) ) )
+    for key, msg in sorted( errors.items() ):
+        print( key, msg )
+    if errors:
+        sys.exit(1)
+# ========================================================================================================================================================
@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+
+import sys, os, getopt, json, time, random, threading, subprocess
+import hashlib, base64, urllib.parse, ssl
+import http.server
+from xml.sax.saxutils import escape
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Local stand-ins for the two remote services used when sharing, to measure throughput without touching NDA or AWS:
+#
+#   miNDA   POST /api/mindar/import     Accepts fmriresults01 packages (HTTP basic auth required, not checked),
+#                                       after a configurable latency; fails with HTTP 503 at a configurable rate.
+#                                       Received packages are appended to <StateDir>/minda_packages.jsonl
+#   S3      Path-style S3 API           PutObject (Content-MD5 and x-amz-checksum-sha256 are verified), multipart uploads,
+#                                       HeadObject, GetObject, DeleteObject, ListObjects(V2); objects are kept under <StateDir>/s3
+#
+# Point the share script to them through share_config.json:
+#   {"miNDA_url": "https://127.0.0.1:8443/api/mindar/import", "miNDA_verify": "<StateDir>/standin_cert.pem",
+#    "AWS_endpoint_url": "http://127.0.0.1:9000"}
+# and set AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY to any value; signatures are not checked.
+# ---------------------------------------------------------------------------------------------------------------------------------
+S3_ns = 'http://s3.amazonaws.com/doc/2006-03-01/'
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Run local stand-ins for miNDA (/api/mindar/import) and an S3-compatible object store')
+    print()
+    print('Usage:')
+    print('  ./standin_services.py  --state-dir Dir  [--minda-port P]  [--s3-port Q]  [--latency L]  [--jitter J]  [--error-rate E]')
+    print('                         [--s3-error-rate F]  [--tls]')
+    print()
+    print('where:')
+    print('  Dir      Directory keeping stored objects, received miNDA packages, and the self-signed certificate')
+    print('  P, Q     Ports for miNDA and S3 (default 8443 and 9000)')
+    print('  L, J     miNDA response latency and uniform jitter, in seconds (default 0.2 and 0.1)')
+    print('  E        Fraction of miNDA requests answered with HTTP 503 (default 0)')
+    print('  F        Fraction of S3 requests answered with HTTP 503 SlowDown (default 0)')
+    print('  --tls    Serve miNDA over https, with a self-signed certificate created with openssl in Dir')
+    print()
+    print('Example:')
+    print('  ./standin_services.py  --state-dir /scratch/standin  --tls  --latency 0.5  --error-rate 0.02')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def command_line_get_variables():
+    opts_out = {'state_dir': '', 'minda_port': 8443, 's3_port': 9000, 'latency': 0.2, 'jitter': 0.1,
+                'error_rate': 0.0, 's3_error_rate': 0.0, 'tls': False}
+    try:
+        opts,args = getopt.getopt(sys.argv[1:], "hd:p:q:l:j:e:f:t",
+                                  ["state-dir=", "minda-port=", "s3-port=", "latency=", "jitter=", "error-rate=", "s3-error-rate=", "tls"])
+    except getopt.GetoptError as err:
+        print("Error parsing arguments: %s" % str(err))
+        program_description()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            program_description()
+            sys.exit()
+        elif opt in ("-d", "--state-dir"):
+            opts_out['state_dir'] = os.path.abspath(arg)
+        elif opt in ("-p", "--minda-port"):
+            opts_out['minda_port'] = int(arg)
+        elif opt in ("-q", "--s3-port"):
+            opts_out['s3_port'] = int(arg)
+        elif opt in ("-l", "--latency"):
+            opts_out['latency'] = float(arg)
+        elif opt in ("-j", "--jitter"):
+            opts_out['jitter'] = float(arg)
+        elif opt in ("-e", "--error-rate"):
+            opts_out['error_rate'] = float(arg)
+        elif opt in ("-f", "--s3-error-rate"):
+            opts_out['s3_error_rate'] = float(arg)
+        elif opt in ("-t", "--tls"):
+            opts_out['tls'] = True
+
+    if not opts_out['state_dir']:
+        program_description()
+        sys.exit()
+
+    return opts_out
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+#                                                               miNDA
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+class miNDA_Handler( http.server.BaseHTTPRequestHandler ):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message( self, format, *args ):
+        pass
+
+    def reply( self, code, body ):
+        body = body.encode('utf8')
+        self.send_response( code )
+        self.send_header( 'Content-Type', 'application/json' )
+        self.send_header( 'Content-Length', str(len(body)) )
+        self.end_headers()
+        self.wfile.write( body )
+
+    def do_POST( self ):
+        srv  = self.server
+        body = self.rfile.read( int(self.headers.get('Content-Length', 0)) )
+
+        time.sleep( max(0.0, srv.latency + random.uniform(-srv.jitter, srv.jitter)) )
+
+        with srv.lock:
+            srv.counts['requests'] += 1
+
+        if self.path.split('?')[0] != '/api/mindar/import':
+            return self.reply( 404, '{"error": "not found"}' )
+
+        if not self.headers.get('Authorization', '').startswith('Basic '):
+            return self.reply( 401, '{"error": "authentication required"}' )
+
+        if random.random() < srv.error_rate:
+            with srv.lock:
+                srv.counts['errors'] += 1
+            return self.reply( 503, '{"error": "service temporarily unavailable (stand-in)"}' )
+
+        try:
+            package = json.loads( body.decode('utf8') )
+            rows = package['dataStructureRows']
+        except (ValueError, KeyError, TypeError):
+            with srv.lock:
+                srv.counts['errors'] += 1
+            return self.reply( 400, '{"error": "malformed package"}' )
+
+        with srv.lock:
+            srv.counts['accepted'] += 1
+            record_id = srv.counts['accepted']
+            with open(srv.packages_fname, 'a') as f:
+                f.write( json.dumps(package, sort_keys=True) + '\n' )
+
+        self.reply( 200, json.dumps( {'status': 'Success', 'rowsImported': len(rows), 'id': record_id} ) )
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+#                                                                S3
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def S3_body_read( handler ):
+    # Request body, undoing HTTP chunked transfer and aws-chunked content encodings used by the AWS CLI
+    h = handler.headers
+    if 'chunked' in h.get('Transfer-Encoding', ''):
+        raw = b''
+        while True:
+            size = int( handler.rfile.readline().split(b';')[0].strip(), 16 )
+            if size == 0:
+                while handler.rfile.readline().strip():
+                    pass
+                break
+            raw += handler.rfile.read( size )
+            handler.rfile.readline()
+    else:
+        raw = handler.rfile.read( int(h.get('Content-Length', 0)) )
+
+    if 'aws-chunked' in h.get('Content-Encoding', '') or 'x-amz-decoded-content-length' in h:
+        data = b''
+        pos  = 0
+        while pos < len(raw):
+            eol  = raw.index( b'\r\n', pos )
+            size = int( raw[pos:eol].split(b';')[0], 16 )
+            if size == 0:
+                break
+            data += raw[eol+2 : eol+2+size]
+            pos = eol + 2 + size + 2
+        raw = data
+
+    return raw
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+class S3_Handler( http.server.BaseHTTPRequestHandler ):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message( self, format, *args ):
+        pass
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def reply( self, code, body=b'', headers={}, content_type='application/xml', head_only=False, length=None ):
+        if isinstance(body, str):
+            body = body.encode('utf8')
+        self.send_response( code )
+        self.send_header( 'Content-Type', content_type )
+        self.send_header( 'Content-Length', str(len(body) if length is None else length) )
+        for k, v in headers.items():
+            self.send_header( k, v )
+        self.end_headers()
+        if not head_only:
+            self.wfile.write( body )
+
+    def error( self, code, s3_code, msg ):
+        self.reply( code, '<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>%s</Code><Message>%s</Message></Error>' % (s3_code, escape(msg)) )
+
+    def parse( self ):
+        u = urllib.parse.urlsplit( self.path )
+        parts = urllib.parse.unquote( u.path ).lstrip('/').split('/', 1)
+        bucket = parts[0]
+        key    = parts[1] if len(parts) > 1 else ''
+        query  = dict( urllib.parse.parse_qsl(u.query, keep_blank_values=True) )
+        return bucket, key, query
+
+    def throttled( self ):
+        srv = self.server
+        with srv.lock:
+            srv.counts['requests'] += 1
+        if random.random() < srv.error_rate:
+            with srv.lock:
+                srv.counts['errors'] += 1
+            if self.command in ['PUT', 'POST']:
+                S3_body_read( self )
+            self.error( 503, 'SlowDown', 'Please reduce your request rate (stand-in)' )
+            return True
+        return False
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def do_PUT( self ):
+        if self.throttled():
+            return
+        srv = self.server
+        bucket, key, query = self.parse()
+        data = S3_body_read( self )
+
+        if not key:
+            os.makedirs( srv.object_path(bucket, ''), exist_ok=True )
+            return self.reply( 200 )
+
+        md5 = hashlib.md5( data )
+        if 'Content-MD5' in self.headers and base64.b64decode(self.headers['Content-MD5']) != md5.digest():
+            return self.error( 400, 'BadDigest', 'The Content-MD5 you specified did not match what we received.' )
+        sha = self.headers.get('x-amz-checksum-sha256', '')
+        if sha and base64.b64decode(sha) != hashlib.sha256(data).digest():
+            return self.error( 400, 'BadDigest', 'The SHA256 you specified did not match what we received.' )
+
+        if 'uploadId' in query:
+            # UploadPart
+            part_dir = srv.upload_path( query['uploadId'] )
+            if not os.path.isdir( part_dir ):
+                return self.error( 404, 'NoSuchUpload', 'The specified upload does not exist.' )
+            with open(part_dir + '/%05d' % int(query['partNumber']), 'wb') as f:
+                f.write( data )
+            return self.reply( 200, headers={'ETag': '"%s"' % md5.hexdigest()} )
+
+        etag = srv.object_store( bucket, key, data, md5.hexdigest(), sha )
+        self.reply( 200, headers={'ETag': '"%s"' % etag} )
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def do_POST( self ):
+        if self.throttled():
+            return
+        srv = self.server
+        bucket, key, query = self.parse()
+        S3_body_read( self )
+
+        if 'uploads' in query:
+            # CreateMultipartUpload
+            with srv.lock:
+                srv.counts['uploads'] += 1
+                upload_id = '%d-%d' % (os.getpid(), srv.counts['uploads'])
+            os.makedirs( srv.upload_path(upload_id) )
+            return self.reply( 200, '<?xml version="1.0" encoding="UTF-8"?>\n<InitiateMultipartUploadResult xmlns="%s">'
+                                    '<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId></InitiateMultipartUploadResult>'
+                                    % (S3_ns, escape(bucket), escape(key), upload_id) )
+
+        if 'uploadId' in query:
+            # CompleteMultipartUpload: parts are concatenated in part-number order
+            part_dir = srv.upload_path( query['uploadId'] )
+            if not os.path.isdir( part_dir ):
+                return self.error( 404, 'NoSuchUpload', 'The specified upload does not exist.' )
+            parts = sorted( os.listdir(part_dir) )
+            data  = b''
+            md5s  = b''
+            for p in parts:
+                with open(part_dir + '/' + p, 'rb') as f:
+                    chunk = f.read()
+                data += chunk
+                md5s += hashlib.md5( chunk ).digest()
+                os.remove( part_dir + '/' + p )
+            os.rmdir( part_dir )
+            etag = srv.object_store( bucket, key, data, '%s-%d' % (hashlib.md5(md5s).hexdigest(), len(parts)), '' )
+            return self.reply( 200, '<?xml version="1.0" encoding="UTF-8"?>\n<CompleteMultipartUploadResult xmlns="%s">'
+                                    '<Bucket>%s</Bucket><Key>%s</Key><ETag>"%s"</ETag></CompleteMultipartUploadResult>'
+                                    % (S3_ns, escape(bucket), escape(key), etag) )
+
+        self.error( 400, 'InvalidRequest', 'Unsupported POST' )
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def do_HEAD( self ):
+        self.do_GET( head_only=True )
+
+    def do_GET( self, head_only=False ):
+        if self.throttled():
+            return
+        srv = self.server
+        bucket, key, query = self.parse()
+
+        if not key:
+            return self.reply( 200, srv.object_list_xml(bucket, query), head_only=head_only )
+
+        meta = srv.object_meta( bucket, key )
+        if not meta:
+            if head_only:
+                return self.reply( 404, head_only=True )
+            return self.error( 404, 'NoSuchKey', 'The specified key does not exist.' )
+
+        headers = {'ETag': '"%s"' % meta['etag'], 'Last-Modified': meta['last_modified_http']}
+        if meta.get('sha256'):
+            headers['x-amz-checksum-sha256'] = meta['sha256']
+        if head_only:
+            return self.reply( 200, headers=headers, content_type='binary/octet-stream', head_only=True, length=meta['size'] )
+        with open(srv.object_path(bucket, key), 'rb') as f:
+            self.reply( 200, f.read(), headers=headers, content_type='binary/octet-stream' )
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def do_DELETE( self ):
+        if self.throttled():
+            return
+        srv = self.server
+        bucket, key, query = self.parse()
+        if 'uploadId' in query:
+            part_dir = srv.upload_path( query['uploadId'] )
+            if os.path.isdir( part_dir ):
+                for p in os.listdir(part_dir):
+                    os.remove( part_dir + '/' + p )
+                os.rmdir( part_dir )
+        else:
+            for fname in [srv.object_path(bucket, key), srv.meta_path(bucket, key)]:
+                if os.path.isfile( fname ):
+                    os.remove( fname )
+        self.reply( 204 )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+class S3_Server( http.server.ThreadingHTTPServer ):
+    daemon_threads = True
+
+    def object_path( self, bucket, key ):
+        return os.path.join( self.state_dir, 's3', bucket, key )
+
+    def meta_path( self, bucket, key ):
+        return os.path.join( self.state_dir, 's3_meta', bucket, key + '.json' )
+
+    def upload_path( self, upload_id ):
+        return os.path.join( self.state_dir, 's3_uploads', os.path.basename(upload_id) )
+
+    def object_store( self, bucket, key, data, etag, sha256 ):
+        fname = self.object_path( bucket, key )
+        os.makedirs( os.path.dirname(fname), exist_ok=True )
+        with open(fname + '.part', 'wb') as f:
+            f.write( data )
+        os.replace( fname + '.part', fname )
+
+        now  = time.time()
+        meta = {'size': len(data), 'etag': etag, 'sha256': sha256,
+                'last_modified': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(now)),
+                'last_modified_http': time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(now))}
+        mname = self.meta_path( bucket, key )
+        os.makedirs( os.path.dirname(mname), exist_ok=True )
+        with open(mname, 'w') as f:
+            json.dump( meta, f )
+        with self.lock:
+            self.counts['objects_stored'] += 1
+            self.counts['bytes_stored']   += len(data)
+        return etag
+
+    def object_meta( self, bucket, key ):
+        try:
+            with open(self.meta_path(bucket, key), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def object_list_xml( self, bucket, query ):
+        # ListObjects (V1 marker, or V2 continuation-token / start-after), keys in lexicographic order, 1000 per page
+        prefix    = query.get('prefix', '')
+        max_keys  = int( query.get('max-keys', 1000) )
+        start     = query.get('continuation-token', '') or query.get('start-after', '') or query.get('marker', '')
+        meta_root = os.path.join( self.state_dir, 's3_meta', bucket )
+
+        keys = []
+        for dirpath, dirnames, filenames in os.walk( meta_root ):
+            for fn in filenames:
+                k = os.path.relpath( os.path.join(dirpath, fn), meta_root )[:-len('.json')]
+                if k.startswith(prefix) and k > start:
+                    keys.append( k )
+        keys.sort()
+        truncated = len(keys) > max_keys
+        keys = keys[:max_keys]
+
+        xml = ['<?xml version="1.0" encoding="UTF-8"?>\n<ListBucketResult xmlns="%s">' % S3_ns,
+               '<Name>%s</Name><Prefix>%s</Prefix><MaxKeys>%d</MaxKeys><KeyCount>%d</KeyCount><IsTruncated>%s</IsTruncated>'
+               % (escape(bucket), escape(prefix), max_keys, len(keys), 'true' if truncated else 'false')]
+        for k in keys:
+            m = self.object_meta( bucket, k )
+            xml.append( '<Contents><Key>%s</Key><LastModified>%s</LastModified><ETag>"%s"</ETag><Size>%d</Size>'
+                        '<StorageClass>STANDARD</StorageClass></Contents>' % (escape(k), m['last_modified'], m['etag'], m['size']) )
+        if truncated:
+            if query.get('list-type') == '2':
+                xml.append( '<NextContinuationToken>%s</NextContinuationToken>' % escape(keys[-1]) )
+            else:
+                xml.append( '<NextMarker>%s</NextMarker>' % escape(keys[-1]) )
+        xml.append( '</ListBucketResult>' )
+        return ''.join( xml )
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Self_Signed_Cert_get( state_dir ):
+    # Certificate and key for https://127.0.0.1 / localhost, created once with openssl
+    cert = state_dir + '/standin_cert.pem'
+    key  = state_dir + '/standin_key.pem'
+    if not (os.path.isfile(cert) and os.path.isfile(key)):
+        rs = subprocess.run( ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '365',
+                              '-keyout', key, '-out', cert, '-subj', '/CN=localhost',
+                              '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE )
+        if rs.returncode != 0:
+            print('Error: unable to create self-signed certificate:', rs.stderr.decode('utf-8') )
+            sys.exit(0)
+    return cert, key
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Standin_Services_Start( state_dir, minda_port=8443, s3_port=9000, latency=0.2, jitter=0.1, error_rate=0.0,
+                            s3_error_rate=0.0, tls=False ):
+    # Start both servers in background threads. Returns a dictionary with the servers, and the share_config.json entries
+    # that point the share script to them
+    os.makedirs( state_dir, exist_ok=True )
+
+    minda = http.server.ThreadingHTTPServer( ('127.0.0.1', minda_port), miNDA_Handler )
+    minda.daemon_threads = True
+    minda.latency    = latency
+    minda.jitter     = jitter
+    minda.error_rate = error_rate
+    minda.lock       = threading.Lock()
+    minda.counts     = {'requests': 0, 'accepted': 0, 'errors': 0}
+    minda.packages_fname = state_dir + '/minda_packages.jsonl'
+
+    scheme = 'http'
+    verify = True
+    if tls:
+        cert, key = Self_Signed_Cert_get( state_dir )
+        ctx = ssl.SSLContext( ssl.PROTOCOL_TLS_SERVER )
+        ctx.load_cert_chain( cert, key )
+        minda.socket = ctx.wrap_socket( minda.socket, server_side=True )
+        scheme = 'https'
+        verify = cert
+
+    s3 = S3_Server( ('127.0.0.1', s3_port), S3_Handler )
+    s3.state_dir  = state_dir
+    s3.error_rate = s3_error_rate
+    s3.lock       = threading.Lock()
+    s3.counts     = {'requests': 0, 'errors': 0, 'uploads': 0, 'objects_stored': 0, 'bytes_stored': 0}
+
+    for srv in [minda, s3]:
+        threading.Thread( target=srv.serve_forever, daemon=True ).start()
+
+    return {'minda': minda, 's3': s3,
+            'config': {'miNDA_url':        '%s://127.0.0.1:%d/api/mindar/import' % (scheme, minda.server_address[1]),
+                       'miNDA_verify':     verify,
+                       'AWS_endpoint_url': 'http://127.0.0.1:%d' % s3.server_address[1]} }
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Standin_Services_Stop( services ):
+    for name in ['minda', 's3']:
+        services[name].shutdown()
+        services[name].server_close()
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    o = command_line_get_variables()
+
+    services = Standin_Services_Start( o['state_dir'], o['minda_port'], o['s3_port'], o['latency'], o['jitter'],
+                                       o['error_rate'], o['s3_error_rate'], o['tls'] )
+
+    print('Stand-in services running; use these entries in share_config.json:')
+    print( json.dumps( services['config'], indent=2 ) )
+    print('and set AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY to any value. Ctrl-C to stop.')
+
+    try:
+        while True:
+            time.sleep(60)
+            print( time.strftime('%H:%M:%S'), 'miNDA:', json.dumps(services['minda'].counts), ' S3:', json.dumps(services['s3'].counts) )
+    except KeyboardInterrupt:
+        Standin_Services_Stop( services )
+        print()
+# ========================================================================================================================================================
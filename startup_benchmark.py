@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import sys, os, getopt, json, subprocess, time
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Startup-time benchmark: runs each script without arguments (it only prints its usage), several times, and reports the
+# median wall time, plus the cumulative import time of every top-level module (python -X importtime).
+# The scripts import pandas, scipy.io and requests only in the stages that use them; the benchmark fails (exit status 1)
+# if the median startup time of any script exceeds the target, or if one of those heavy modules is loaded at startup.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Scripts = ['share_min_proc_fMRI_dMRI_BOLD_T1T2.py', 'series_process_info_get.py']
+
+Heavy_modules = ['pandas', 'scipy', 'numpy', 'requests']
+
+Here = os.path.dirname( os.path.abspath(__file__) )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Measure the startup time of the share scripts (time to print their usage) and the modules they import')
+    print()
+    print('Usage:')
+    print('  ./startup_benchmark.py  [--repeat N]  [--target Seconds]  [--json Results]')
+    print()
+    print('where:')
+    print('  N          Runs per script (default 10); the median is reported')
+    print('  Seconds    Maximum median startup time per script (default 0.3)')
+    print('  Results    Write results to this .json file')
+    print()
+    print('Exit status is 1 if a script exceeds the target or loads one of', Heavy_modules, 'at startup')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def command_line_get_variables():
+    repeat     = 10
+    target     = 0.3
+    json_fname = ''
+
+    try:
+        opts,args = getopt.getopt(sys.argv[1:], "hn:t:j:", ["repeat=", "target=", "json="])
+    except getopt.GetoptError as err:
+        print("Error parsing arguments: %s" % str(err))
+        program_description()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            program_description()
+            sys.exit()
+        elif opt in ("-n", "--repeat"):
+            repeat = max( 1, int(arg) )
+        elif opt in ("-t", "--target"):
+            target = float(arg)
+        elif opt in ("-j", "--json"):
+            json_fname = arg
+
+    return repeat, target, json_fname
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def median( values ):
+    v = sorted( values )
+    n = len(v)
+    return v[n//2] if n % 2  else  (v[n//2 - 1] + v[n//2]) / 2
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Startup_Time_get( script, repeat ):
+    # Wall times (s) of running script with no arguments
+    times = []
+    for k in range( repeat ):
+        start_time = time.time()
+        subprocess.run( [sys.executable, script], cwd=Here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+        times.append( time.time() - start_time )
+    return times
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Import_Times_get( script ):
+    # Cumulative import time (s) of each top-level module imported when starting script, from python -X importtime
+    proc = subprocess.run( [sys.executable, '-X', 'importtime', script], cwd=Here,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True )
+    imports = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        parts = line[len('import time:'):].split('|')
+        name = parts[2].rstrip()
+        if name.startswith(' ') and not name.startswith('  '):    # one space: top-level import
+            try:
+                imports[ name.strip() ] = int( parts[1] ) / 1e6
+            except ValueError:
+                pass
+    return imports
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Startup_Benchmark( repeat, target ):
+    results = {}
+    for script in Scripts:
+        times   = Startup_Time_get( script, repeat )
+        imports = Import_Times_get( script )
+        heavy   = [ m  for m in imports  if m.split('.')[0] in Heavy_modules ]
+        results[ script ] = {'median': median(times), 'min': min(times), 'max': max(times), 'runs': len(times),
+                             'imports': imports, 'heavy_imports': heavy,
+                             'ok': median(times) <= target and not heavy}
+    return results
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Startup_Benchmark_print( results, target, top=8 ):
+    for script, r in results.items():
+        print('%-42s  median %.3f s  (min %.3f, max %.3f, %d runs)  %s'
+              % (script, r['median'], r['min'], r['max'], r['runs'], 'ok' if r['ok'] else 'FAILED') )
+        for m, t in sorted( r['imports'].items(), key=lambda x: -x[1] )[:top]:
+            print('    %-36s %8.4f s' % (m, t) )
+        if r['heavy_imports']:
+            print('    Heavy modules loaded at startup:', ', '.join(r['heavy_imports']) )
+        print()
+    print('Target: %.3f s' % target )
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    repeat, target, json_fname  =  command_line_get_variables()
+
+    results = Startup_Benchmark( repeat, target )
+    Startup_Benchmark_print( results, target )
+
+    if json_fname:
+        with open(json_fname, 'w') as f:
+            json.dump( {'target': target, 'results': results}, f, indent=2 )
+        print('Results written to', json_fname )
+
+    if not all( r['ok']  for r in results.values() ):
+        sys.exit(1)
+# ========================================================================================================================================================
@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+
+import sys, os, getopt, json, csv, gzip, struct, random, datetime
+
+import numpy as np
+from scipy.io import savemat
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Builds a fake, ABCD-like file system under one root directory, so that discovery and sharing can be measured
+# without the production NFS servers:
+#
+#   Root/ProjInfo/MMIL_ProjInfo.csv                 Global location of processed files (ProjID DAL_ABCD)
+#   Root/MetaData/DAL_ABCD/DAL_ABCD_pcinfo.csv      Series information, one row per series
+#   Root/proc/MRIPROC_*_<subj>_*/                   ContainerInfo.mat (SeriesInfo, ScanInfo.MPR/.XetaT2), MPR_res.mgz, T2w_res.mgz
+#   Root/proc_dti/DTIPROC_*_<subj>_*/               ContainerInfo.mat (ScanInfo.DTI), exportDTIforFSL/DTI<n>/{DTI<n>.nii.gz, bvals.txt, bvecs.txt},
+#                                                   DTI1_corr_regT1_regT1.mat (and a "rev" one, to be ignored)
+#   Root/proc_bold/BOLDPROC_*_<subj>_*/             ContainerInfo.mat (ScanInfo.BOLD), BOLD<n>_for_corr_resBOLD.mgz, BOLD<n>_..._motion.1D,
+#                                                   BOLD1_for_corr_resBOLD_regT1.mat, stim_<task>/<task>_run<t>_events.tsv
+#   Root/fast-track/<site>/NDAR<subj>_<event>_ABCD-<type>_<date><time>.tgz
+#   Root/image03.txt                                NDA package listing the fast-track files
+#   Root/Subjs_synthetic.csv                        List of participants to share (pGUID, ..., site, event_rc, dob, gender)
+#   Root/dataset_description.json, Root/login_credentials.json
+#
+# Images are NIfTI-1 files (also under .mgz names) with realistic headers, truncated to a configurable number of data bytes.
+# The same seed always produces the same data set.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Sites = ['chla', 'cub', 'fiu', 'laureate', 'musc', 'ohsu', 'pitt', 'sri', 'ucla', 'ucsd',
+         'umb', 'umich', 'umn', 'utah', 'uvm', 'uwm', 'vcu', 'wustl', 'yale']
+
+Manufacturers = ['SIEMENS', 'GE MEDICAL SYSTEMS', 'Philips Medical Systems']
+
+Event = 'baseline_year_1_arm_1'
+
+# Acquisition parameters per modality:  TR (ms), TE (ms), FlipAngle (deg), nreps, ndiffdirs, TI (ms)
+Acq_params = {'T1':              {'TR': 2500, 'TE':   2.88, 'FlipAngle':   8, 'nreps':   1, 'ndiffdirs':  0, 'TI': 1060},
+              'T2':              {'TR': 3200, 'TE': 565,    'FlipAngle': 120, 'nreps':   1, 'ndiffdirs':  0},
+              'dMRI':            {'TR': 4100, 'TE':  88,    'FlipAngle':  90, 'nreps': 103, 'ndiffdirs': 96},
+              'rsfMRI':          {'TR':  800, 'TE':  30,    'FlipAngle':  52, 'nreps': 383, 'ndiffdirs':  0},
+              'fMRI_MID_task':   {'TR':  800, 'TE':  30,    'FlipAngle':  52, 'nreps': 411, 'ndiffdirs':  0},
+              'fMRI_SST_task':   {'TR':  800, 'TE':  30,    'FlipAngle':  52, 'nreps': 445, 'ndiffdirs':  0},
+              'fMRI_nBack_task': {'TR':  800, 'TE':  30,    'FlipAngle':  52, 'nreps': 370, 'ndiffdirs':  0} }
+
+BOLD_runs   = [('rsfMRI', 2), ('fMRI_MID_task', 2), ('fMRI_SST_task', 2), ('fMRI_nBack_task', 2), ('rsfMRI', 2)]   # Acquisition order
+BOLD_task   = {'rsfMRI': '', 'fMRI_MID_task': 'MID', 'fMRI_SST_task': 'SST', 'fMRI_nBack_task': 'nBack'}
+FsTk_type   = {'T1': 'T1', 'T2': 'T2', 'dMRI': 'DTI', 'rsfMRI': 'rsfMRI',
+               'fMRI_MID_task': 'MID-fMRI', 'fMRI_SST_task': 'SST-fMRI', 'fMRI_nBack_task': 'nBack-fMRI'}
+
+Image_dims  = {'MPR': (256, 256, 256, 1), 'XetaT2': (256, 256, 256, 1), 'DTI': (140, 140, 81, 103), 'BOLD': (90, 90, 60, 383)}
+
+PCInfo_columns = ['pGUID', 'VisitID', 'EventName', 'SessionType', 'SiteName', 'SeriesType', 'ABCD_Compliant', 'SeriesDescription',
+                  'Completed', 'AdditionalInfo', 'NumberOfFiles', 'ImagesInAcquisition', 'AcquisitionTime', 'NumberOfTemporalPositions',
+                  'AcquisitionMatrix', 'Rows', 'PercentPhaseFieldOfView', 'NumberOfPhaseEncodingSteps', 'RepetitionTime', 'EchoTime',
+                  'SeriesNumber', 'Manufacturer', 'SequenceName', 'ImageType', 'PatientID', 'PatientFamilyName', 'StudyInstanceUID',
+                  'SeriesInstanceUID', 'StudyDate', 'StudyTime', 'SeriesTime', 'version', 'SiteID', 'PixelBandwidth', 'Channel', 'CoilType',
+                  'fname_json', 'fname_pc_json', 'StudyInstanceUID_SeriesTime']
+
+Image03_columns = ['image03_id', 'collection_id', 'dataset_id', 'collection_title', 'subjectkey', 'src_subject_id',
+                   'interview_date', 'interview_age', 'gender', 'comments_misc', 'image_file', 'image_thumbnail_file',
+                   'image_description', 'experiment_id', 'scan_type', 'scan_object', 'image_file_format', 'data_file2',
+                   'data_file2_type', 'image_modality', 'scanner_manufacturer_pd', 'scanner_type_pd', 'scanner_software_versions_pd',
+                   'magnetic_field_strength', 'mri_repetition_time_pd', 'mri_echo_time_pd', 'flip_angle', 'visit']
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Create a synthetic ABCD-like data set (ProjInfo, pcinfo, PROC containers, fast-track mirror, NDA image03 package,')
+    print('list of participants) to measure discovery and sharing performance without production NFS.')
+    print()
+    print('Usage:')
+    print('  ./synthetic_dataset_create.py  --root Root  [--subjects N]  [--sites S]  [--seed Seed]  [--image-bytes B]')
+    print()
+    print('where:')
+    print('  Root           Output directory; created if needed')
+    print('  N              Number of participants (default 100)')
+    print('  S              Comma-separated ABCD sites (default all %d)' % len(Sites) )
+    print('  Seed           Random seed (default 1)')
+    print('  B              Image data bytes written after each NIfTI header (default 65536)')
+    print()
+    print('Example:')
+    print('  ./synthetic_dataset_create.py  --root /scratch/abcd_synth_10k  --subjects 10000')
+    print('  ./discovery_benchmark.py       --root /scratch/abcd_synth_10k  --sample 200')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def command_line_get_variables():
+    root        = ''
+    n_subjects  = 100
+    sites       = Sites
+    seed        = 1
+    image_bytes = 65536
+
+    try:
+        opts,args = getopt.getopt(sys.argv[1:], "hr:n:s:e:b:", ["root=", "subjects=", "sites=", "seed=", "image-bytes="])
+    except getopt.GetoptError as err:
+        print("Error parsing arguments: %s" % str(err))
+        program_description()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            program_description()
+            sys.exit()
+        elif opt in ("-r", "--root"):
+            root = arg
+        elif opt in ("-n", "--subjects"):
+            n_subjects = int(arg)
+        elif opt in ("-s", "--sites"):
+            sites = arg.split(',')
+        elif opt in ("-e", "--seed"):
+            seed = int(arg)
+        elif opt in ("-b", "--image-bytes"):
+            image_bytes = int(arg)
+
+    if not root:
+        program_description()
+        sys.exit()
+
+    return os.path.abspath(root), n_subjects, sites, seed, image_bytes
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+#                                                   Participants and their series
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Subjects_make( rng, n_subjects, sites ):
+    # One baseline session per participant; each with T1, T2, one (two for Philips) DTI, and ten BOLD series
+    alphabet = '0123456789ABCDEFGHJKLMNPRSTUVWXYZ'
+    subjects = []
+    used = set()
+
+    for j in range(n_subjects):
+        subj = ''
+        while not subj or subj in used:
+            subj = 'INV' + ''.join( rng.choice(alphabet) for k in range(8) )
+        used.add( subj )
+
+        site  = sites[ j % len(sites) ]
+        manuf = rng.choice( Manufacturers )
+        study_day = datetime.date(2016, 9, 1) + datetime.timedelta( days=rng.randrange(0, 700) )
+        dob       = study_day - datetime.timedelta( days=rng.randrange(int(9*365.25), int(11*365.25)) )
+        study_uid = '1.2.840.113619.2.%d.%d' % (j+1, rng.randrange(10**8))
+
+        t_sec  = 3600*rng.randrange(8, 17) + 60*rng.randrange(0, 60)
+        series = []
+        def add_series( modality, scantype ):
+            nonlocal t_sec
+            t_sec += 60*rng.randrange(3, 9) + rng.randrange(0, 60)
+            hms = '%02d%02d%02d' % (t_sec // 3600, (t_sec // 60) % 60, t_sec % 60)
+            series.append( {'modality':  modality,
+                            'scantype':  scantype,
+                            'SeriesNumber': len(series) + 1,
+                            'SeriesInstanceUID': '%s.%d' % (study_uid, len(series) + 1),
+                            'SeriesDate': study_day.strftime('%Y%m%d'),
+                            'SeriesTime': '%s.%06d' % (hms, rng.randrange(0, 1000)*1000),
+                            'nreps':      Acq_params[modality]['nreps'] } )
+
+        add_series('T1', 'MPR')
+        add_series('T2', 'XetaT2')
+        for k in range( 2 if manuf.startswith('Philips') else 1 ):
+            add_series('dMRI', 'DTI')
+        for modality, n in BOLD_runs:
+            for k in range(n):
+                add_series( modality, 'BOLD' )
+        # An aborted task run: present in ContainerInfo, below the nreps threshold, absent from pcinfo
+        if rng.random() < 0.1:
+            add_series('fMRI_MID_task', 'BOLD')
+            series[-1]['nreps']   = rng.randrange(10, 90)
+            series[-1]['aborted'] = True
+
+        subjects.append( {'subj': subj, 'site': site, 'manuf': manuf, 'dob': dob.strftime('%Y-%m-%d'),
+                          'gender': rng.choice(['F', 'M']), 'study_uid': study_uid,
+                          'StudyDate': study_day.strftime('%Y%m%d'), 'series': series} )
+    return subjects
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def FasTrk_name( s, ser ):
+    event_sec = Event.split('_')
+    event = event_sec[0] + ''.join( [e.capitalize() for e in event_sec[1:]] )
+    return 'NDAR%s_%s_ABCD-%s_%s%s.tgz' % (s['subj'], event, FsTk_type[ser['modality']], ser['SeriesDate'], ser['SeriesTime'].split('.')[0])
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+#                                                          File writers
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def nifti1_bytes( dims, pixdim, TR, data_bytes ):
+    # NIfTI-1 single file: 348-byte header, 4-byte extension flag, then data_bytes of zeros (truncated image)
+    ndim = 4 if dims[3] > 1 else 3
+    dim = [ndim] + list(dims) + [1]*(7 - len(dims))
+    pix = [1.0] + list(pixdim) + [TR/1000.0] + [0.0]*(7 - len(pixdim) - 1)
+    hdr = struct.pack('<i10s18sihsB', 348, b'', b'', 0, 0, b'r', 0)
+    hdr += struct.pack('<8h', *dim)
+    hdr += struct.pack('<3f', 0.0, 0.0, 0.0)                    # intent_p1..p3
+    hdr += struct.pack('<hhhh', 0, 4, 16, 0)                    # intent_code, datatype (int16), bitpix, slice_start
+    hdr += struct.pack('<8f', *pix)
+    hdr += struct.pack('<ff', 352.0, 1.0)                       # vox_offset, scl_slope
+    hdr += struct.pack('<fhbb', 0.0, 0, 0, 10)                  # scl_inter, slice_end, slice_code, xyzt_units (mm, s)
+    hdr += struct.pack('<ffffii', 0.0, 0.0, 0.0, 0.0, 0, 0)     # cal_max, cal_min, slice_duration, toffset, glmax, glmin
+    hdr += struct.pack('<80s24s', b'ABCD synthetic', b'')
+    hdr += struct.pack('<hh', 0, 1)                             # qform_code, sform_code
+    hdr += struct.pack('<6f', 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    hdr += struct.pack('<4f', pixdim[0], 0.0, 0.0, 0.0)
+    hdr += struct.pack('<4f', 0.0, pixdim[1], 0.0, 0.0)
+    hdr += struct.pack('<4f', 0.0, 0.0, pixdim[2], 0.0)
+    hdr += struct.pack('<16s4s', b'', b'n+1\x00')
+    assert len(hdr) == 348
+    return hdr + b'\x00'*4 + b'\x00'*data_bytes
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Struct_array( records, fields ):
+    # MATLAB 1xN structure array from a list of dictionaries
+    arr = np.zeros( (1, len(records)), dtype=[(f, 'O') for f in fields] )
+    for j, rec in enumerate(records):
+        for f in fields:
+            arr[0, j][f] = rec[f]
+    return arr
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def ContainerInfo_write( fdir, s, ctype, series, scan_fields ):
+    # series: the subject's series belonging to this container, in acquisition order.
+    # scan_fields: ScanInfo fields (MPR, XetaT2, DTI, BOLD) to fill, in this order
+    SeriesInfo = []
+    for ser in series:
+        if s['manuf'].startswith('Philips') and ser['scantype'] == 'MPR':
+            info = {'Private_2001_101b': float(Acq_params['T1']['TI'])}     # Philips keeps TI in a private tag
+        else:
+            info = {'SeriesDescription': 'ABCD_' + ser['modality']}
+        SeriesInfo.append( {'SeriesNumber':      ser['SeriesNumber'],
+                            'SeriesType':        ser['scantype'],
+                            'SeriesDescription': 'ABCD_' + ser['modality'],
+                            'SeriesInstanceUID': ser['SeriesInstanceUID'],
+                            'SeriesDate':        ser['SeriesDate'],
+                            'SeriesTime':        ser['SeriesTime'],
+                            'Manufacturer':      s['manuf'],
+                            'PatientID':         'NDAR_' + s['subj'] + '_' + Event,
+                            'info':              info} )
+    SeriesInfo = Struct_array( SeriesInfo, ['SeriesNumber', 'SeriesType', 'SeriesDescription', 'SeriesInstanceUID',
+                                            'SeriesDate', 'SeriesTime', 'Manufacturer', 'PatientID', 'info'] )
+
+    ScanInfo = {}
+    for st in scan_fields:
+        recs = []
+        for j, ser in enumerate(series):
+            if ser['scantype'] != st:
+                continue
+            p = Acq_params[ ser['modality'] ]
+            rec = {'SeriesIndex': j+1, 'TR': float(p['TR']), 'TE': float(p['TE']), 'FlipAngle': float(p['FlipAngle']),
+                   'nreps': ser['nreps'], 'ndiffdirs': p['ndiffdirs']}
+            if st == 'MPR':
+                rec['TI'] = float('nan') if s['manuf'].startswith('Philips') else float(p['TI'])
+            recs.append( rec )
+        fields = ['SeriesIndex', 'nreps', 'ndiffdirs', 'TR', 'TE', 'FlipAngle'] + (['TI'] if st == 'MPR' else [])
+        ScanInfo[st] = Struct_array( recs, fields )
+
+    CntrInfo = {'SourceDir':             '/space/incoming/%s/%s' % (s['site'], s['subj']),
+                'ContainerType':         ctype,
+                'ContainerUID':          s['study_uid'] + '.' + ctype,
+                'ContainerCreationDate': s['StudyDate'],
+                'VisitID':               s['subj'] + '_' + Event,
+                'StudyDate':             s['StudyDate'],
+                'StudyTime':             series[0]['SeriesTime'],
+                'StudyInstanceUID':      s['study_uid'],
+                'MagneticFieldStrength': 3.0,
+                'SeriesInfo':            SeriesInfo,
+                'Manufacturer':          s['manuf'],
+                'ManufacturersModelName': 'synthetic',
+                'ScanInfo':              ScanInfo,
+                'Updated':               0,
+                'ProjID':                'DAL_ABCD',
+                'MMPSVER':               '248'}
+
+    savemat( fdir + '/ContainerInfo.mat', {'ContainerInfo': CntrInfo}, do_compression=True )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def RegInfo_write( fname, rng ):
+    M = np.eye(4)
+    M[0:3, 3] = [rng.uniform(-5, 5) for k in range(3)]
+    savemat( fname, {'RegInfo': {'M_T1_to_T2': M, 'M_T2_to_T1': np.linalg.inv(M)}} )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def file_write( fname, content, mode='wb' ):
+    d = os.path.dirname( fname )
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    with open(fname, mode) as f:
+        f.write(content)
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Containers_write( root, s, rng, image_bytes ):
+    cname = '%s_%s_%s_%s.%s_1' % (s['site'].upper(), s['subj'], Event, s['StudyDate'], s['series'][0]['SeriesTime'].replace('.', ''))
+
+    # --------------------------- Structural: MPR_res.mgz and T2w_res.mgz -------------------------------
+    mri = [ser for ser in s['series'] if ser['scantype'] in ['MPR', 'XetaT2']]
+    fdir = root + '/proc/MRIPROC_' + cname
+    os.makedirs( fdir, exist_ok=True )
+    ContainerInfo_write( fdir, s, 'MRIPROC', mri, ['MPR', 'XetaT2'] )
+    file_write( fdir + '/MPR_res.mgz', nifti1_bytes(Image_dims['MPR'], (1.0, 1.0, 1.0), Acq_params['T1']['TR'], image_bytes) )
+    file_write( fdir + '/T2w_res.mgz', nifti1_bytes(Image_dims['XetaT2'], (1.0, 1.0, 1.0), Acq_params['T2']['TR'], image_bytes) )
+
+    # --------------------------- Diffusion: exportDTIforFSL and registration ---------------------------
+    dti = [ser for ser in s['series'] if ser['scantype'] == 'DTI']
+    fdir = root + '/proc_dti/DTIPROC_' + cname
+    os.makedirs( fdir, exist_ok=True )
+    ContainerInfo_write( fdir, s, 'DTIPROC', dti, ['DTI'] )
+    p = Acq_params['dMRI']
+    for n in range(1, len(dti)+1):
+        ddir = fdir + '/exportDTIforFSL/DTI%d' % n
+        image = nifti1_bytes(Image_dims['DTI'], (1.7, 1.7, 1.7), p['TR'], image_bytes)
+        file_write( ddir + '/DTI%d.nii.gz' % n, gzip.compress(image, 1) )
+        bvals = [0]*(p['nreps'] - p['ndiffdirs']) + [ [500, 1000, 2000, 3000][k % 4] for k in range(p['ndiffdirs']) ]
+        file_write( ddir + '/bvals.txt', ' '.join(str(b) for b in bvals) + '\n', 'w' )
+        bvecs = [[rng.uniform(-1, 1) if b else 0.0 for b in bvals] for k in range(3)]
+        file_write( ddir + '/bvecs.txt', ''.join(' '.join('%.6f' % v for v in row) + '\n' for row in bvecs), 'w' )
+    RegInfo_write( fdir + '/DTI1_corr_regT1_regT1.mat', rng )
+    RegInfo_write( fdir + '/DTI1rev_corr_regT1_regT1.mat', rng )
+
+    # --------------------------- fMRI: BOLD images, motion, registration, events ------------------------
+    bold = [ser for ser in s['series'] if ser['scantype'] == 'BOLD']
+    fdir = root + '/proc_bold/BOLDPROC_' + cname
+    os.makedirs( fdir, exist_ok=True )
+    ContainerInfo_write( fdir, s, 'BOLDPROC', bold, ['BOLD'] )
+    t_ord = {}
+    for n, ser in enumerate(bold, start=1):
+        modality = ser['modality']
+        dims = Image_dims['BOLD'][0:3] + (ser['nreps'],)
+        file_write( fdir + '/BOLD%d_for_corr_resBOLD.mgz' % n, nifti1_bytes(dims, (2.4, 2.4, 2.4), Acq_params[modality]['TR'], image_bytes) )
+        motion = ''.join( '%d %s 0 0\n' % (t, ' '.join('%.5f' % rng.gauss(0, 0.2) for k in range(6))) for t in range(1, ser['nreps']+1) )
+        file_write( fdir + '/BOLD%d_for_corr_resBOLD_motion.1D' % n, motion, 'w' )
+        if ser.get('aborted'):
+            continue
+        t_ord[modality] = t_ord.get(modality, 0) + 1
+        task = BOLD_task[modality]
+        if task:
+            events = 'onset\tduration\ttrial_type\n' + ''.join( '%.3f\t%.3f\tcue\n' % (10.0 + 6*k, 2.0) for k in range(40) )
+            file_write( fdir + '/stim_%s/%s_run%d_events.tsv' % (task, task, t_ord[modality]), events, 'w' )
+    RegInfo_write( fdir + '/BOLD1_for_corr_resBOLD_regT1.mat', rng )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def ProjInfo_write( root ):
+    # DAL_ABCD must be the first row: series_process_info_get uses label 0
+    rows = [ {'ProjID': 'DAL_ABCD', 'raw': root + '/raw', 'proc': root + '/proc', 'proc_dti': root + '/proc_dti',
+              'proc_bold': root + '/proc_bold', 'fsurf': root + '/fsurf'},
+             {'ProjID': 'OTHER',    'raw': '/dev/null', 'proc': '/dev/null', 'proc_dti': '/dev/null',
+              'proc_bold': '/dev/null', 'fsurf': '/dev/null'} ]
+    os.makedirs( root + '/ProjInfo', exist_ok=True )
+    with open(root + '/ProjInfo/MMIL_ProjInfo.csv', 'w', newline='') as f:
+        w = csv.DictWriter( f, fieldnames=list(rows[0].keys()) )
+        w.writeheader()
+        w.writerows( rows )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def PCInfo_write( root, subjects ):
+    os.makedirs( root + '/MetaData/DAL_ABCD', exist_ok=True )
+    with open(root + '/MetaData/DAL_ABCD/DAL_ABCD_pcinfo.csv', 'w', newline='') as f:
+        w = csv.writer( f )
+        w.writerow( PCInfo_columns )
+        for s in subjects:
+            for ser in s['series']:
+                if ser.get('aborted'):
+                    continue
+                p = Acq_params[ ser['modality'] ]
+                row = {c: '' for c in PCInfo_columns}
+                row.update( {'pGUID':     'NDAR_' + s['subj'],
+                             'VisitID':   s['subj'] + '_' + Event,
+                             'EventName': Event,
+                             'SessionType': 'MRI',
+                             'SiteName':  s['site'].upper(),
+                             'SeriesType': ser['modality'],
+                             'ABCD_Compliant': 'Yes',
+                             'SeriesDescription': 'ABCD_' + ser['modality'],
+                             'Completed': 1,
+                             'NumberOfFiles': ser['nreps'],
+                             'NumberOfTemporalPositions': ser['nreps'],
+                             'RepetitionTime': p['TR'],
+                             'EchoTime':  p['TE'],
+                             'SeriesNumber': ser['SeriesNumber'],
+                             'Manufacturer': s['manuf'],
+                             'PatientID': 'NDAR_' + s['subj'] + '_' + Event,
+                             'StudyInstanceUID':  s['study_uid'],
+                             'SeriesInstanceUID': ser['SeriesInstanceUID'],
+                             'StudyDate':  s['StudyDate'],
+                             'SeriesTime': ser['SeriesTime'],
+                             'version':    '2.0',
+                             'fname_json': '/space/json/%s_%s.json' % (s['subj'], ser['SeriesInstanceUID']),
+                             'StudyInstanceUID_SeriesTime': s['study_uid'] + '_' + ser['SeriesTime']} )
+                w.writerow( [row[c] for c in PCInfo_columns] )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def FastTrack_and_NDA_write( root, subjects, rng ):
+    # Fast-track mirror (empty .tgz placeholders), and the NDA image03 package that lists them
+    image03_id = 100000
+    with open(root + '/image03.txt', 'w', newline='') as f:
+        w = csv.writer( f, delimiter='\t' )
+        w.writerow( Image03_columns )
+        w.writerow( ['Description of ' + c for c in Image03_columns] )
+
+        for s in subjects:
+            fdir = root + '/fast-track/' + s['site']
+            os.makedirs( fdir, exist_ok=True )
+            study_day = datetime.datetime.strptime( s['StudyDate'], '%Y%m%d' )
+            age_months = round( (study_day - datetime.datetime.strptime(s['dob'], '%Y-%m-%d')).days / 365.25 * 12 )
+            for ser in s['series']:
+                if ser.get('aborted'):
+                    continue
+                fname = FasTrk_name( s, ser )
+                open(fdir + '/' + fname, 'wb').close()
+
+                # A few fast-track series never reached NDA; a few were submitted twice
+                if rng.random() < 0.02:
+                    continue
+                for k in range( 2 if rng.random() < 0.01 else 1 ):
+                    image03_id += 1
+                    p = Acq_params[ ser['modality'] ]
+                    row = {c: '' for c in Image03_columns}
+                    row.update( {'image03_id':     image03_id,
+                                 'collection_id':  2573,
+                                 'dataset_id':     rng.randrange(10000, 20000),
+                                 'collection_title': 'Adolescent Brain Cognitive Development (ABCD)',
+                                 'subjectkey':     'NDAR_' + s['subj'],
+                                 'src_subject_id': 'NDAR_' + s['subj'],
+                                 'interview_date': study_day.strftime('%m/%d/%Y'),
+                                 'interview_age':  age_months,
+                                 'gender':         s['gender'],
+                                 'image_file':     's3://NDAR_Central_1/submission_%d/%s' % (13000 + image03_id % 97, fname),
+                                 'image_description': 'ABCD-' + FsTk_type[ser['modality']],
+                                 'experiment_id':  '',
+                                 'scan_type':      ser['modality'],
+                                 'image_file_format': 'DICOM',
+                                 'scanner_manufacturer_pd': s['manuf'],
+                                 'magnetic_field_strength': 3,
+                                 'mri_repetition_time_pd':  p['TR']/1000,
+                                 'mri_echo_time_pd':        p['TE']/1000,
+                                 'flip_angle':     p['FlipAngle'],
+                                 'visit':          Event} )
+                    w.writerow( [row[c] for c in Image03_columns] )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Subjects_write( root, subjects ):
+    with open(root + '/Subjs_synthetic.csv', 'w', newline='') as f:
+        w = csv.writer( f )
+        w.writerow( ['pGUID', 'mrif_score', 'site', 'dir', 'event_rc', 'manuf', 'release', 'dob', 'gender'] )
+        for s in subjects:
+            w.writerow( ['NDAR_' + s['subj'], 1, s['site'], s['subj'], Event, s['manuf'], 'synthetic', s['dob'], s['gender']] )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Aux_files_write( root ):
+    with open(root + '/dataset_description.json', 'w') as f:
+        json.dump( {'Name': 'ABCD synthetic minimally-processed data', 'BIDSVersion': '1.0.2'}, f, indent=2 )
+    with open(root + '/login_credentials.json', 'w') as f:
+        json.dump( {'miNDAR': {'username': 'synthetic', 'password': 'synthetic'}}, f, indent=2 )
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Synthetic_Dataset_Create( root, n_subjects=100, sites=Sites, seed=1, image_bytes=65536, verbose=True ):
+    # Returns the list of participants (dictionaries with subj, site, manuf, dob, gender, series)
+    rng = random.Random( seed )
+    os.makedirs( root, exist_ok=True )
+
+    subjects = Subjects_make( rng, n_subjects, sites )
+
+    ProjInfo_write( root )
+    PCInfo_write( root, subjects )
+    Subjects_write( root, subjects )
+    Aux_files_write( root )
+    for j, s in enumerate(subjects):
+        Containers_write( root, s, rng, image_bytes )
+        if verbose and (j+1) % 500 == 0:
+            print('  %d/%d participants written' % (j+1, n_subjects) )
+    FastTrack_and_NDA_write( root, subjects, rng )
+
+    return subjects
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    root, n_subjects, sites, seed, image_bytes  =  command_line_get_variables()
+
+    print('Creating synthetic data set with %d participants under %s' % (n_subjects, root) )
+    subjects = Synthetic_Dataset_Create( root, n_subjects, sites, seed, image_bytes )
+
+    print('Participants:        ', root + '/Subjs_synthetic.csv' )
+    print('NDA package:         ', root + '/image03.txt' )
+    print('Series per modality: ', json.dumps( {m: sum(1 for s in subjects for ser in s['series'] if ser['modality'] == m)
+                                                for m in Acq_params} ) )
+# ========================================================================================================================================================
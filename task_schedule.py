@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+import sys, os, getopt, heapq, sqlite3, statistics
+import multiprocessing
+
+import series_process_info_get as spi
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+# Order of the tasks (participant, modality) of a worker pool: longest processing time first, so that the longest tasks start
+# early and the batch does not end with one long DTI or multi-run BOLD participant running alone.
+#
+# The cost of a task is estimated from what discovery finds (series_process_info_get.Get_File_Names_and_Process_Info): the size
+# of each run's MinProc_file (or, if it cannot be read, the median size of the batch's runs of the same modality scaled by
+# nreps or ndiffdirs), times the seconds per input byte of that modality, plus a fixed per-task time. Both rates come from
+# past runs (table stage_usage of metadata.sqlite: wall time of each run's stages, over the bytes read by its NIfTI
+# conversion), or the median of the other modalities' where a modality has none; without any history, a task costs its
+# input bytes.
+#
+# Tasks whose runs are known (found by the discovery of the estimate, or read from a share plan) are split into one task per
+# run (Run_Tasks_get), which Subject_Share shares alone (its plan_runs), so that the longest runs start first wherever they
+# are, and the runs of a multi-run DTI or BOLD participant go to different workers instead of one after another at the end
+# of the batch. A task whose discovery failed is dispatched whole, and discovered again by its worker.
+#
+# Tasks of priority participants are dispatched first, longest first among themselves.
+# ---------------------------------------------------------------------------------------------------------------------------------
+Run_stages = ['nda_lookup', 'scratch_reserve', 'nifti_convert', 'outdir_reserve', 'bids_archive', 'minda_upload', 's3_upload']
+Task_stages = ['subject_info', 'discovery', 'sidecars']
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def program_description():
+    print()
+    print('Estimate the cost of each task (participant, modality) of a site and the makespan of the batch, in the listed order')
+    print('and longest first (the order used by share_pool.py)')
+    print()
+    print('Usage:')
+    print('  ./task_schedule.py  --demog SubjsFile  --site Site  --modality M1,M2,...  [--outdir OutDir]  [--workers N]  [--priority S1,S2,...]')
+    print()
+    print('where:')
+    print('  SubjsFile   Table (.csv) listing pGUIDs; participants are the lines containing Site')
+    print('  OutDir      Output directory whose metadata.sqlite holds the timings of past runs (stage_usage)')
+    print('  N           Workers (default: number of CPUs)')
+    print('  S1,S2,...   Participants dispatched first')
+    print()
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def command_line_get_variables():
+    subjs_fname = ''
+    site        = ''
+    modalities  = []
+    outdir      = ''
+    workers     = os.cpu_count() or 1
+    priority    = []
+
+    try:
+        opts,args = getopt.getopt(sys.argv[1:], "hd:s:m:o:p:r:", ["demog=", "site=", "modality=", "outdir=", "workers=", "priority="])
+    except getopt.GetoptError as err:
+        print("Error parsing arguments: %s" % str(err))
+        program_description()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            program_description()
+            sys.exit()
+        elif opt in ("-d", "--demog"):
+            subjs_fname = arg
+        elif opt in ("-s", "--site"):
+            site = arg
+        elif opt in ("-m", "--modality"):
+            modalities = arg.split(',')
+        elif opt in ("-o", "--outdir"):
+            outdir = arg
+        elif opt in ("-p", "--workers"):
+            workers = max( 1, int(arg) )
+        elif opt in ("-r", "--priority"):
+            priority = arg.split(',')
+
+    if not (subjs_fname and site and modalities):
+        program_description()
+        sys.exit()
+
+    return subjs_fname, site, modalities, outdir, workers, priority
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Tasks_get( subjs_fname, site, modalities ):
+    # (subject, modality) of the lines of subjs_fname that contain site, modality by modality
+    subjects = []
+    with open(subjs_fname, 'r') as f:
+        for line in f:
+            if site in line:
+                subjects.append( line.split(',')[0].split('_')[-1] )
+    return [ (subj, modality)  for modality in modalities  for subj in subjects ]
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Task_Runs_get( task ):
+    # Runs of a task as found by discovery: [(input bytes, nreps, ndiffdirs), ...]. Runs in a pool worker.
+    return Task_Discover( task )[0]
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Task_Discover( task ):
+    # Runs of a task as found by discovery: ([(input bytes, nreps, ndiffdirs), ...], {'Run-01': Run_Record, ...}), with
+    # records None if discovery failed. Runs in a pool worker.
+    subj, modality = task[:2]
+    try:
+        Proc_files = spi.Get_File_Names_and_Process_Info( subj, modality, records=True )
+    except Exception:
+        return [], None
+    return Runs_Sizes_get( Proc_files ), Proc_files
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Runs_Sizes_get( Proc_files ):
+    # [(input bytes, nreps, ndiffdirs), ...] of the runs of Proc_files, in run order
+    runs = []
+    for key in sorted( Proc_files ):
+        run = Proc_files[key]
+        try:
+            size = os.path.getsize( run.get('MinProc_file', '') )
+        except OSError:
+            size = 0
+        runs.append( (size, count_get( run.get('nreps') ), count_get( run.get('ndiffdirs') )) )
+    return runs
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Tasks_Discover( tasks, workers, records=False ):
+    # Task_Runs_get of every task, in the order of tasks, in forked worker processes; with records, also the Run_Records
+    # of every task (None where discovery failed), so that the tasks can be shared without discovering them again
+    ctx = multiprocessing.get_context( 'fork' )
+    with ctx.Pool( processes=workers ) as pool:
+        if not records:
+            return pool.map( Task_Runs_get, tasks, chunksize=4 )
+        found = pool.map( Task_Discover, tasks, chunksize=4 )
+    return [ f[0]  for f in found ], [ f[1]  for f in found ]
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Run_Tasks_get( tasks, task_runs, task_records ):
+    # One task per run, task + (run key,) with its [(input bytes, nreps, ndiffdirs)], for each task whose Run_Records are in
+    # task_records ({task: {'Run-01': Run_Record, ...}}); other tasks are kept whole. Returns (tasks, task_runs).
+    run_tasks = []
+    run_runs  = []
+    for task, runs in zip( tasks, task_runs ):
+        records = task_records.get( task )
+        if records and len(records) == len(runs):
+            for key, run in zip( sorted(records), runs ):
+                run_tasks.append( tuple(task) + (key,) )
+                run_runs.append( [run] )
+        else:
+            run_tasks.append( task )
+            run_runs.append( runs )
+    return run_tasks, run_runs
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def count_get( value ):
+    try:
+        value = float( value )
+    except (TypeError, ValueError):
+        return 0
+    return int( value )  if value == value and value > 0  else 0
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def History_get( metadatadir ):
+    # Per modality, from past runs: {'task_s': per-task time, 's_per_byte': run time per input byte}; {} without history
+    sqlite_file = ''.join([metadatadir, '/', 'metadata.sqlite'])
+    if not os.path.isfile( sqlite_file ):
+        return {}
+    try:
+        conn = sqlite3.connect( sqlite_file, timeout=30 )
+        rows = conn.execute( 'SELECT batch_id, subject, modality, bids_run, stage, wall_s, rchar FROM stage_usage' ).fetchall()
+        conn.close()
+    except sqlite3.Error:
+        return {}
+
+    tasks = {}     # (batch, subject, modality) -> seconds
+    runs  = {}     # (batch, subject, modality, bids_run) -> [seconds, bytes read by conversion]
+    for batch_id, subject, modality, bids_run, stage, wall_s, rchar in rows:
+        if stage in Task_stages:
+            tasks[ (batch_id, subject, modality) ] = tasks.get( (batch_id, subject, modality), 0.0 ) + float(wall_s or 0)
+        elif stage in Run_stages:
+            run = runs.setdefault( (batch_id, subject, modality, bids_run), [0.0, 0] )
+            run[0] += float( wall_s or 0 )
+            if stage == 'nifti_convert':
+                run[1] += int( rchar or 0 )
+
+    history = {}
+    for modality in set( k[2]  for k in list(tasks) + list(runs) ):
+        task_s = [ s  for k, s in tasks.items()  if k[2] == modality ]
+        rates  = [ s / nbytes  for k, (s, nbytes) in runs.items()  if k[2] == modality and nbytes > 0 ]
+        history[ modality ] = {'task_s':     statistics.median( task_s )  if task_s  else 0.0,
+                               's_per_byte': statistics.median( rates )  if rates  else 0.0}
+    return history
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Task_Costs_get( tasks, task_runs, history={} ):
+    # Estimated cost (s, or input bytes without history) of each task; task_runs in the order of tasks
+    sizes = {}
+    for task, runs in zip( tasks, task_runs ):
+        sizes.setdefault( task[1], [] ).extend( (size, max(nreps, ndiffdirs))  for size, nreps, ndiffdirs in runs  if size )
+
+    # Modalities without history take the median rates of those with history, so all costs are in seconds
+    rates = [ h['s_per_byte']  for h in history.values()  if h['s_per_byte'] ]
+    default = {'task_s':     statistics.median( h['task_s']  for h in history.values() )  if history  else 0.0,
+               's_per_byte': statistics.median( rates )  if rates  else 1.0}
+
+    costs = []
+    for task, runs in zip( tasks, task_runs ):
+        h = history.get( task[1], default )
+        s_per_byte = h['s_per_byte'] or default['s_per_byte']
+        known = sizes.get( task[1], [] )
+        total = 0
+        for size, nreps, ndiffdirs in runs:
+            if not size and known:
+                # Unreadable input: median of the batch, scaled by the number of volumes where both are known
+                size = statistics.median( s  for s, v in known )
+                volumes = max( nreps, ndiffdirs )
+                per_volume = [ s / v  for s, v in known  if v ]
+                if volumes and per_volume:
+                    size = statistics.median( per_volume ) * volumes
+            total += size
+        costs.append( h['task_s'] + s_per_byte * total )
+    return costs
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def LPT_Order( tasks, costs, priority_subjects=[] ):
+    # Tasks of priority_subjects first, then the others; longest first within each group (ties keep the listed order)
+    priority = set( s.replace('NDAR_', '')  for s in priority_subjects )
+    order = sorted( range(len(tasks)), key=lambda i: (tasks[i][0] not in priority, -costs[i], i) )
+    return [ tasks[i]  for i in order ], [ costs[i]  for i in order ]
+# ---------------------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------
+def Makespan_estimate( costs, workers ):
+    # Time to run tasks of the given costs, dispatched in this order to the first free of workers
+    finish = [0.0] * max( 1, min(workers, len(costs)) )
+    for c in costs:
+        heapq.heapreplace( finish, finish[0] + c )
+    return max( finish )  if costs  else 0.0
+# ---------------------------------------------------------------------------------------------------------------------------------
+# ========================================================================================================================================================
+
+
+
+# ========================================================================================================================================================
+if __name__ == "__main__":
+
+    subjs_fname, site, modalities, outdir, workers, priority  =  command_line_get_variables()
+
+    tasks = Tasks_get( subjs_fname, site, modalities )
+    costs = Task_Costs_get( tasks, Tasks_Discover( tasks, workers ), History_get( outdir ) )
+    lpt_tasks, lpt_costs = LPT_Order( tasks, costs, priority )
+
+    for (subj, modality), c in zip( lpt_tasks, lpt_costs ):
+        print('%-16s %-16s %12.1f' % (subj, modality, c) )
+    print()
+    print('Estimated makespan with %d workers:  listed order %.1f,  longest first %.1f'
+          % (workers, Makespan_estimate( costs, workers ), Makespan_estimate( lpt_costs, workers )) )
+# ========================================================================================================================================================